@@ -1,7 +1,16 @@
+from datetime import timedelta
+
+from django.conf import settings
 from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
 
-from imagefilter.models import File, Image, Product
-from imagefilter.tasks import create_product_and_image, filter_image, generate_product_description
+from imagefilter.exceptions import ExcelFormatException
+from imagefilter.models import File, FileStage, FileUpload, Image, ImageAnnotation, Product
+from imagefilter.tasks import check_file_header, create_product_and_image, filter_image, \
+    generate_product_description, generate_product_description_incremental, get_file_queue
+from imagefilter.utils import upload
+from imagefilter.utils.read_xlsx import probe_schema
 
 
 def check_file_async(file_id):
@@ -15,13 +24,43 @@ def check_file_async(file_id):
         else:
             if file.status != 0:
                 return {'result': False, 'message': '[파일업로드] 상태의 파일만 검증할 수 있습니다.'}
+            # 헤더와 처음 몇 행만 읽어서 형식이 틀린 파일은 worker에 보내지 않고 바로 실패 처리
+            try:
+                probe_schema(file.original.path)
+            except ExcelFormatException as e:
+                file.status = 2
+                file.error = 0
+                file.error_message = str(e)
+                file.save()
+                return {'result': False, 'message': '파일 형식 오류\n{}'.format(e), 'errors': e.error_dict}
             file.status = 1
             file.error = None
+            file.error_message = None
             file.save()
-            create_product_and_image.delay(file_id)
+            create_product_and_image.apply_async((file_id,), queue=get_file_queue(file, 'ingest'))
             return {'result': True, 'message': '요청되었습니다.'}
 
 
+def complete_upload(upload_id):
+    # 모든 조각을 받은 업로드를 파일로 등록하고 바로 백그라운드 검증 시작 (요청은 파일 이동만 하고 끝남)
+    with transaction.atomic():
+        try:
+            file_upload = FileUpload.objects.select_for_update().get(id=upload_id)
+        except FileUpload.DoesNotExist:
+            return {'result': False, 'message': '존재하지 않는 업로드입니다.'}
+        if file_upload.file_id:
+            return {'result': True, 'message': '등록되었습니다.', 'file_id': file_upload.file_id}
+        missing_chunks = file_upload.get_missing_chunks()
+        if missing_chunks:
+            return {'result': False, 'message': '받지 못한 조각이 있습니다.', 'missing_chunks': missing_chunks}
+        file = File.objects.create(title=file_upload.title, user=file_upload.user,
+                                   original=upload.move_to_file(file_upload), status=1)
+        file_upload.file = file
+        file_upload.save()
+        transaction.on_commit(lambda: check_file_header.apply_async((file.id,), queue=get_file_queue(file, 'ingest')))
+        return {'result': True, 'message': '등록되었습니다. 파일 검증을 시작합니다.', 'file_id': file.id}
+
+
 def filter_image_async(file_id):
     with transaction.atomic():
         try:
@@ -35,12 +74,49 @@ def filter_image_async(file_id):
                 return {'result': False, 'message': '[상품/이미지 등록 완료] 상태의 파일만 분류할 수 있습니다.'}
             file.status = 4
             file.error = None
+            file.filter_progress_dt = timezone.now()
+            file.filter_run += 1
+            file.refresh_image_count()
+            file.backfill_image_uri_hash()
             file.save()
-            filter_image.delay(file_id, 'zh')
+            # filter_image 가 커밋된 실행 번호를 읽도록 커밋 후 요청
+            queue = get_file_queue(file, 'ocr')
+            run = file.filter_run
+            transaction.on_commit(lambda: filter_image.apply_async((file_id, 'zh', run), queue=queue))
             # filter_image.delay(file_id, 'zh')
             return {'result': True, 'message': '요청되었습니다.'}
 
 
+def resume_filter_image_async(file_id):
+    # 중단된 분류를 남은 이미지만 이어서 진행
+    with transaction.atomic():
+        try:
+            file = File.objects.select_for_update().get(id=file_id)
+        except File.DoesNotExist:
+            return {'result': False, 'message': '존재하지 않는 파일입니다.'}
+        else:
+            if file.status != 4:
+                return {'result': False, 'message': '[이미지 분류중] 상태의 파일만 이어서 분류할 수 있습니다.'}
+            if not file.is_filter_stale():
+                return {'result': False, 'message': '분류가 진행중입니다. 잠시 후 다시 시도하세요.'}
+            file.backfill_image_file()
+            file.backfill_image_uri_hash()
+            # 종료된 worker가 잡고 있던 이미지는 다시 분류 전으로
+            # (분류 속도 제한으로 늦어지는 등 아직 처리중일 수 있는 최근 batch는 그대로 두고 해당 task가 마무리)
+            expire_dt = timezone.now() - timedelta(seconds=settings.IMAGEFILTER_FILTER_STALE_TIMEOUT)
+            Image.objects.filter(Q(file_id=file_id) & Q(type=2) & (
+                Q(claim_dt__isnull=True) | Q(claim_dt__lt=expire_dt))).update(type=0)
+            file.filter_progress_dt = timezone.now()
+            # 이전 실행의 batch task가 남아있으면 다음 batch부터 종료되도록 실행 번호 변경
+            file.filter_run += 1
+            file.refresh_image_count()
+            file.save()
+            queue = get_file_queue(file, 'ocr')
+            run = file.filter_run
+            transaction.on_commit(lambda: filter_image.apply_async((file_id, 'zh', run), queue=queue))
+            return {'result': True, 'message': '요청되었습니다.'}
+
+
 def delete_file(file_id):
     with transaction.atomic():
         file = File.objects.select_for_update().get(id=file_id)
@@ -48,8 +124,12 @@ def delete_file(file_id):
         if file_status not in [0, 2, 3]:
             return {'result': False, 'message': '파일업로드, 파일 검증 실패, 상품/이미지 등록 완료 건만 삭제할 수 있습니다.'}
 
-        # 삭제 순서 주의
-        Image.objects.filter(product__file_id=file_id).delete()
+        # 삭제 순서 주의 (file_id 가 비어있는 이전 이미지도 함께 삭제되도록 먼저 보정)
+        file.backfill_image_file()
+        ImageAnnotation.objects.filter(file_id=file_id).delete()
+        FileStage.objects.filter(file_id=file_id).delete()
+        FileUpload.objects.filter(file_id=file_id).delete()
+        Image.objects.filter(file_id=file_id).delete()
         Product.objects.filter(file_id=file_id).delete()
         file.delete()
         return {'result': True, 'message': '파일 삭제 완료.'}
@@ -63,9 +143,17 @@ def generate_file(file_id):
             return {'result': False, 'message': '해당 파일을 찾을 수 없습니다.'}
         else:
             file_status = file.status
-            if file_status != 5:
-                return {'result': False, 'message': '이미지 분류 완료건만 생성할 수 있습니다.'}
+            if file_status == 7:
+                # 이미 생성된 파일은 분류가 바뀐 상품만 반영
+                if not Product.objects.filter(Q(file_id=file_id) & Q(dirty=True)).exists():
+                    return {'result': False, 'message': '변경된 이미지가 없습니다.'}
+                file.status = 6
+                file.save()
+                generate_product_description_incremental.apply_async((file_id,), queue=get_file_queue(file, 'generate'))
+                return {'result': True, 'message': '요청되었습니다.'}
+            if file_status not in [5, 8]:
+                return {'result': False, 'message': '이미지 분류 완료, 파일 생성 오류건만 생성할 수 있습니다.'}
             file.status = 6
             file.save()
-            generate_product_description.delay(file_id)
+            generate_product_description.apply_async((file_id,), queue=get_file_queue(file, 'generate'))
             return {'result': True, 'message': '요청되었습니다.'}
\ No newline at end of file
@@ -1,18 +1,45 @@
 from django.contrib import admin
 
-from imagefilter.models import File, Product, Image
+from imagefilter.models import File, FileStage, FileUpload, Product, Image, ImageAnnotation, OcrCache
 
 
 @admin.register(File)
 class FileAdmin(admin.ModelAdmin):
-    list_display = ['user', 'title', 'num_product', 'num_image', 'status', 'error', 'timestamp']
+    list_display = ['user', 'title', 'num_product', 'num_image', 'num_include', 'num_exclude', 'num_error',
+                    'cache_hit_rate', 'prefilter_skip_rate', 'status', 'error', 'timestamp']
     list_filter = ['user__company', 'user', 'status']
+    actions = ['refresh_image_count', 'backfill_image_file']
+
+    def refresh_image_count(self, request, queryset):
+        for file in queryset:
+            file.refresh_image_count()
+
+    refresh_image_count.short_description = '이미지 수 다시 계산'
+
+    def backfill_image_file(self, request, queryset):
+        # Image.file 컬럼 추가 전에 등록된 이미지 보정
+        for file in queryset:
+            file.backfill_image_file()
+
+    backfill_image_file.short_description = '이미지 파일 정보 채우기'
 
     # def get_queryset(self, request):
     #     queryset = super(FileAdmin, self).get_queryset(request)
     #     return queryset.values('user', 'title', 'num_product', 'num_image', 'status', 'error', 'timestamp')
 
 
+@admin.register(FileStage)
+class FileStageAdmin(admin.ModelAdmin):
+    list_display = ['file', 'stage', 'start_dt', 'end_dt', 'num_item', 'duration', 'throughput']
+    list_filter = ['stage']
+
+
+@admin.register(FileUpload)
+class FileUploadAdmin(admin.ModelAdmin):
+    list_display = ['user', 'title', 'file_name', 'size', 'num_chunk', 'file', 'created_dt', 'updated_dt']
+    exclude = ['received_chunks']
+
+
 @admin.register(Product)
 class ProductAdmin(admin.ModelAdmin):
     pass
@@ -22,3 +49,28 @@ class ProductAdmin(admin.ModelAdmin):
 class ImageAdmin(admin.ModelAdmin):
     list_display = ['product', 'uri', 'type', 'filter_dt', 'error']
     list_filter = ['product', 'type']
+
+
+@admin.register(ImageAnnotation)
+class ImageAnnotationAdmin(admin.ModelAdmin):
+    list_display = ['file', 'uri']
+    exclude = ['data']
+    readonly_fields = ['annotation']
+
+    def annotation(self, obj):
+        return obj.get_data()
+
+    annotation.short_description = '분석 결과'
+
+
+@admin.register(OcrCache)
+class OcrCacheAdmin(admin.ModelAdmin):
+    list_display = ['uri', 'num_hit', 'created_dt', 'last_hit_dt']
+    search_fields = ['uri']
+    exclude = ['data']
+    readonly_fields = ['annotation']
+
+    def annotation(self, obj):
+        return obj.get_data()
+
+    annotation.short_description = '분석 결과'
@@ -1,6 +1,8 @@
 class ExcelFormatException(Exception):
-    def __init__(self, msg):
+    def __init__(self, msg, error_dict=None):
         self.msg = msg
+        # 항목별 진단 {항목: 메시지}
+        self.error_dict = error_dict or {}
 
     def __str__(self):
         return self.msg or '엑셀 파일을 읽을 수 없습니다.'
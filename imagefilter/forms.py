@@ -1,9 +1,34 @@
+import os
+
 from django import forms
+from django.conf import settings
 
-from imagefilter.models import File, Image
+from imagefilter.models import File, FileUpload, Image
 
 
 class FileCreateForm(forms.ModelForm):
     class Meta:
         model = File
-        fields = ['title', 'original']
\ No newline at end of file
+        fields = ['title', 'original']
+
+
+class FileUploadForm(forms.ModelForm):
+    class Meta:
+        model = FileUpload
+        fields = ['title', 'file_name', 'size']
+
+    def clean_file_name(self):
+        # 브라우저/OS에 따라 경로가 붙어서 올 수 있으므로 파일 이름만 사용 ('../' 로 MEDIA_ROOT 밖을 가리키지 않도록)
+        file_name = os.path.basename(self.cleaned_data['file_name'].replace('\\', '/')).strip()
+        if not file_name:
+            raise forms.ValidationError('파일 이름을 확인하세요.')
+        if file_name.rsplit('.', 1)[-1].lower() not in ['xlsx', 'xls']:
+            raise forms.ValidationError('xlsx, xls 파일만 등록할 수 있습니다.')
+        return file_name
+
+    def clean_size(self):
+        size = self.cleaned_data['size']
+        if not 0 < size <= settings.IMAGEFILTER_UPLOAD_MAX_BYTES:
+            raise forms.ValidationError('파일 크기를 확인하세요. (최대 {}MB)'.format(
+                settings.IMAGEFILTER_UPLOAD_MAX_BYTES // 1024 // 1024))
+        return size
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from imagefilter.models import File, Image
+
+
+class Command(BaseCommand):
+    help = 'Image.file, Image.uri_hash 컬럼 추가 전에 등록된 이미지 정보를 채움 (배포 후 한번 실행, 여러번 실행해도 됨)'
+
+    def handle(self, *args, **options):
+        file_id_list = Image.objects.filter(file__isnull=True).order_by().values_list(
+            'product__file_id', flat=True).distinct()
+        for file in File.objects.filter(id__in=list(file_id_list)):
+            self.stdout.write('{} : {}건'.format(file.id, file.backfill_image_file()))
+        file_id_list = Image.objects.filter(Q(uri_hash__isnull=True) & Q(file__isnull=False)).order_by().values_list(
+            'file_id', flat=True).distinct()
+        for file in File.objects.filter(id__in=list(file_id_list)):
+            self.stdout.write('{} : uri_hash {}건'.format(file.id, file.backfill_image_uri_hash()))
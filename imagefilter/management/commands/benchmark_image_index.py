@@ -0,0 +1,100 @@
+import time
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Count
+
+from imagefilter.models import File, Image, Product
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = '합성 데이터로 Image 조회 쿼리의 실행계획을 product 조인 방식과 file_id 방식으로 비교 (실행 후 롤백)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--images', type=int, default=1000000, help='전체 이미지 수')
+        parser.add_argument('--files', type=int, default=50, help='파일 수')
+        parser.add_argument('--images-per-product', type=int, default=10, help='상품당 이미지 수')
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError('postgresql 에서만 실행할 수 있습니다.')
+
+        with transaction.atomic():
+            start = time.time()
+            file_id = self.create_dataset(options['images'], options['files'], options['images_per_product'])
+            self.stdout.write('데이터 생성 : {:.1f}s'.format(time.time() - start))
+
+            for name, old_queryset, new_queryset in self.get_query_list(file_id):
+                self.stdout.write('\n== {}'.format(name))
+                old_time = self.explain('product 조인', old_queryset)
+                new_time = self.explain('file_id', new_queryset)
+                self.stdout.write('-> {:.2f}ms / {:.2f}ms'.format(old_time, new_time))
+
+            transaction.set_rollback(True)
+
+    def create_dataset(self, num_image, num_file, images_per_product):
+        user = User.objects.create_user('benchmark-{}@rawlabs.io'.format(int(time.time())), 'benchmark')
+        file_list = [File.objects.create(title='benchmark', user=user, original='benchmark.xlsx', status=3)
+                     for _ in range(num_file)]
+        file_id_list = [file.id for file in file_list]
+        products_per_file = max(num_image // images_per_product // num_file, 1)
+
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'INSERT INTO {product} (file_id, product_code, name, original_description, status, dirty) '
+                'SELECT f.id, g::text, %s || g, %s, 0, false '
+                'FROM unnest(%s::int[]) AS f(id), generate_series(1, %s) AS g'.format(
+                    product=Product._meta.db_table),
+                ['product ', '', file_id_list, products_per_file])
+            # 분류 전(0)은 일부만 남기고 대부분 분류 완료 상태로 생성
+            cursor.execute(
+                'INSERT INTO {image} (product_id, file_id, uri, type) '
+                'SELECT p.id, p.file_id, %s || floor(random() * %s)::int || %s, '
+                '(ARRAY[0, 1, 3, 3, 4, 4, 4, 4, 4, 4])[1 + floor(random() * 10)::int] '
+                'FROM {product} p, generate_series(1, %s) AS g WHERE p.file_id = ANY(%s)'.format(
+                    image=Image._meta.db_table, product=Product._meta.db_table),
+                ['https://img.example.com/', products_per_file * images_per_product // 2, '.jpg',
+                 images_per_product, file_id_list])
+            # imagefilter.utils.ocr_cache.get_uri_hash 와 같은 값 ('https:' 를 뺀 uri 의 sha256)
+            cursor.execute(
+                "UPDATE {image} SET uri_hash = encode(sha256(convert_to(substring(uri from 7), 'UTF8')), 'hex') "
+                'WHERE file_id = ANY(%s)'.format(image=Image._meta.db_table), [file_id_list])
+            cursor.execute('ANALYZE {}'.format(Product._meta.db_table))
+            cursor.execute('ANALYZE {}'.format(Image._meta.db_table))
+        return file_id_list[len(file_id_list) // 2]
+
+    def get_query_list(self, file_id):
+        old = Image.objects.filter(product__file_id=file_id)
+        new = Image.objects.filter(file_id=file_id)
+        claim_size = settings.IMAGEFILTER_CLAIM_SIZE
+        return [
+            ('분류 대상 uri (claim_image_uri)',
+             old.filter(type=0).values_list('uri_hash', flat=True).order_by('uri_hash')[:claim_size],
+             new.filter(type=0).values_list('uri_hash', flat=True).order_by('uri_hash')[:claim_size]),
+            ('이미지 목록 첫 페이지 (ImageListView)',
+             old.only('id', 'uri', 'type', 'error', 'product_id').order_by('-product_id', '-id')[:50],
+             new.only('id', 'uri', 'type', 'error', 'product_id').order_by('-product_id', '-id')[:50]),
+            ('분류결과 필터 (ImageTypeFilter)',
+             old.filter(type=3).only('id', 'uri').order_by('-product_id', '-id')[:50],
+             new.filter(type=3).only('id', 'uri').order_by('-product_id', '-id')[:50]),
+            ('분류결과별 이미지 수',
+             old.values('type').annotate(count=Count('id')).order_by(),
+             new.values('type').annotate(count=Count('id')).order_by()),
+        ]
+
+    def explain(self, name, queryset):
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN (ANALYZE, BUFFERS) ' + sql, params)
+            plan = [row[0] for row in cursor.fetchall()]
+        self.stdout.write('-- {}'.format(name))
+        execution_time = 0
+        for line in plan:
+            self.stdout.write('   ' + line)
+            if line.startswith('Execution Time'):
+                execution_time = float(line.split(':')[1].strip().split(' ')[0])
+        return execution_time
@@ -0,0 +1,265 @@
+import os
+import queue
+import random
+import resource
+import threading
+import time
+import zlib
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.models import Q
+from django.test.utils import override_settings
+from django.utils import timezone
+from google.api_core.exceptions import ResourceExhausted
+from google.cloud import vision_v1
+from openpyxl import Workbook
+
+from account.models import Company
+from imagefilter import tasks
+from imagefilter.models import File, FileStage, Image, ImageAnnotation, OcrCache, Product
+from imagefilter.utils import ocr
+from imagefilter.utils.ocr import GoogleVisionBackend
+from rawlabs.celery import app
+
+User = get_user_model()
+
+# 실행마다 같은 uri (같은 seed 면 같은 엑셀/분류 결과)
+BENCHMARK_URI_PREFIX = 'https://benchmark.example.com/'
+
+
+class FakeImageAnnotatorClient(object):
+    # vision_v1.ImageAnnotatorClient 대신 사용 (네트워크/과금 없음)
+    # batch마다 latency 만큼 대기하고, quota_error_rate 확률로 RESOURCE_EXHAUSTED, 이미지마다 error_rate 확률로 오류 반환
+    # 글자 유무/언어/이미지 오류는 seed 와 uri 로 정해지므로 같은 옵션이면 실행마다 같은 결과
+    # (batch가 동시에 여러개 요청되므로 호출 순서에 따라 달라지는 난수로 정하지 않음)
+    # 대기 시간/quota 오류는 seed 로 만든 client 전용 난수 (다른 코드의 random 사용과 섞이지 않음, thread 간에는 lock)
+    def __init__(self, latency, error_rate, quota_error_rate, text_rate, seed):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.quota_error_rate = quota_error_rate
+        self.text_rate = text_rate
+        self.seed = seed
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.num_call = 0
+        self.num_image = 0
+
+    def batch_annotate_images(self, requests):
+        with self.lock:
+            self.num_call += 1
+            self.num_image += len(requests)
+            latency = self.latency * self.random.uniform(0.5, 1.5)
+            quota_error = self.random.random() < self.quota_error_rate
+        time.sleep(latency)
+        if quota_error:
+            raise ResourceExhausted('benchmark quota')
+        return vision_v1.types.BatchAnnotateImagesResponse(
+            responses=[self.annotate(request.image) for request in requests])
+
+    def annotate(self, image):
+        key = zlib.crc32(image.content or image.source.image_uri.encode('utf-8'))
+        if random.Random('{}:{}'.format(self.seed, key)).random() < self.error_rate:
+            return vision_v1.types.AnnotateImageResponse(error={'code': 14, 'message': 'benchmark error'})
+        if key % 100 >= self.text_rate * 100:
+            return vision_v1.types.AnnotateImageResponse()
+        locale = 'zh' if key % 2 else 'ko'
+        return vision_v1.types.AnnotateImageResponse(
+            text_annotations=[{'locale': locale, 'description': 'benchmark {}'.format(key)}])
+
+
+class BenchmarkVisionBackend(GoogleVisionBackend):
+    client = None
+
+    def __init__(self):
+        pass
+
+
+class LocalBroker(object):
+    # celery broker 대신 filter_image_claim 을 in-process 큐로 받아서 여러 thread(worker)로 실행
+    def __init__(self, task):
+        self.task = task
+        self.queue = queue.Queue()
+
+    def apply_async(self, args=None, kwargs=None, **options):
+        self.queue.put(args)
+
+    def run(self, num_worker, query_counter):
+        def worker():
+            with connection.execute_wrapper(query_counter):
+                while True:
+                    try:
+                        args = self.queue.get(timeout=0.1)
+                    except queue.Empty:
+                        if not self.queue.unfinished_tasks:
+                            break
+                        continue
+                    try:
+                        self.task.run(*args)
+                    finally:
+                        self.queue.task_done()
+            connection.close()
+
+        thread_list = [threading.Thread(target=worker) for _ in range(num_worker)]
+        for thread in thread_list:
+            thread.start()
+        for thread in thread_list:
+            thread.join()
+
+
+class QueryCounter(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        with self.lock:
+            self.count += 1
+        return execute(sql, params, many, context)
+
+
+class Command(BaseCommand):
+    help = '합성 샵링커 엑셀과 가짜 vision api 로 상품 등록/이미지 분류/파일 생성 전체를 실행하고 단계별 성능을 출력'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=1000, help='상품 수')
+        parser.add_argument('--images-per-product', type=int, default=10, help='상세설명당 이미지 수')
+        parser.add_argument('--duplicate-rate', type=float, default=0.3, help='이미 나온 uri를 다시 사용할 확률')
+        parser.add_argument('--workers', type=int, default=4, help='이미지 분류 worker(thread) 수')
+        parser.add_argument('--latency', type=float, default=0.3, help='vision api batch 응답 시간(초)')
+        parser.add_argument('--error-rate', type=float, default=0.01, help='이미지별 vision api 오류 확률')
+        parser.add_argument('--quota-error-rate', type=float, default=0.0, help='batch별 RESOURCE_EXHAUSTED 확률')
+        parser.add_argument('--text-rate', type=float, default=0.4, help='글자가 있는 이미지 비율')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--keep', action='store_true', help='생성한 데이터를 삭제하지 않음')
+
+    def handle(self, *args, **options):
+        run_id = timezone.now().strftime('%Y%m%d%H%M%S')
+        client = FakeImageAnnotatorClient(options['latency'], options['error_rate'], options['quota_error_rate'],
+                                          options['text_rate'], options['seed'])
+        BenchmarkVisionBackend.client = client
+        backend_path = '{}.{}'.format(__name__, BenchmarkVisionBackend.__name__)
+        ocr._backend_dict.pop(backend_path, None)
+
+        path = os.path.join(settings.MEDIA_ROOT, 'benchmark', 'benchmark_{}.xlsx'.format(run_id))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        start = time.time()
+        self.create_workbook(path, options['rows'], options['images_per_product'], options['duplicate_rate'],
+                             random.Random(options['seed']))
+        # uri 는 실행마다 같으므로 이전 실행(--keep)의 캐시를 지우고 시작 (캐시 사용률이 실행마다 달라지지 않도록)
+        OcrCache.objects.filter(Q(uri__startswith=BENCHMARK_URI_PREFIX)).delete()
+        self.stdout.write('엑셀 생성 : {:.1f}s, {:.1f}MB'.format(time.time() - start, os.path.getsize(path) / 2 ** 20))
+
+        company = Company.objects.create(company_name='benchmark-{}'.format(run_id), contact='-', is_approved=True)
+        user = User.objects.create_user('benchmark-{}@rawlabs.io'.format(run_id), 'benchmark')
+        user.company = company
+        user.save()
+        file = File.objects.create(title='benchmark', user=user, original=os.path.relpath(path, settings.MEDIA_ROOT),
+                                   status=1)
+
+        # 분류 task 외에는 celery eager 모드로 바로 실행, 외부 호출/요청 제한은 끔
+        eager = app.conf.task_always_eager
+        app.conf.task_always_eager = True
+        try:
+            with override_settings(IMAGEFILTER_OCR_BACKEND=backend_path, IMAGEFILTER_FETCH_INLINE=False,
+                                   IMAGEFILTER_PREFILTER=False, IMAGEFILTER_VISION_IMAGES_PER_MINUTE=None,
+                                   IMAGEFILTER_OCR_IMAGES_PER_MINUTE=None, IMAGEFILTER_COMPANY_IMAGES_PER_MINUTE=None):
+                report = self.run_pipeline(file, client, options['workers'])
+        finally:
+            app.conf.task_always_eager = eager
+            if not options['keep']:
+                self.cleanup(file, user, company)
+
+        # peak RSS 는 프로세스 시작 후 최대값 (ru_maxrss), 증가는 단계 중에 그 최대값이 늘어난 양
+        # (앞 단계보다 적게 쓴 단계는 0)
+        self.stdout.write('\n{:<10}{:>10}{:>14}{:>18}{:>10}{:>12}{:>12}'.format(
+            'stage', 'wall(s)', 'peak RSS(MB)', 'peak increase(MB)', 'queries', 'api calls', 'api images'))
+        for row in report:
+            self.stdout.write('{:<10}{:>10.2f}{:>14.1f}{:>18.1f}{:>10}{:>12}{:>12}'.format(*row))
+
+    def create_workbook(self, path, num_row, images_per_product, duplicate_rate, rand):
+        workbook = Workbook(write_only=True)
+        sheet = workbook.create_sheet()
+        header = list(tasks.SHOPLINKER_COLUMN_TYPE.keys())
+        column = {name: idx for idx, name in enumerate(header)}
+        sheet.append(header)
+        num_uri = 0
+        for row_no in range(num_row):
+            uri_list = []
+            for _ in range(images_per_product):
+                if num_uri and rand.random() < duplicate_rate:
+                    uri_no = rand.randrange(num_uri)
+                else:
+                    uri_no = num_uri
+                    num_uri += 1
+                uri_list.append('{}{}.jpg'.format(BENCHMARK_URI_PREFIX, uri_no))
+            row = [None] * len(header)
+            row[column['고객사상품코드']] = 'BM{:08d}'.format(row_no)
+            row[column['상품명']] = '벤치마크 상품 {}'.format(row_no)
+            row[column['쇼핑몰판매가']] = 10000
+            row[column['상품상세설명']] = '<div>{}</div>'.format(
+                ''.join('<p><img src="{}"></p>'.format(uri) for uri in uri_list))
+            sheet.append(row)
+        workbook.save(path)
+
+    def run_pipeline(self, file, client, num_worker):
+        report = []
+
+        def measure(stage, func):
+            counter = QueryCounter()
+            num_call, num_image = client.num_call, client.num_image
+            start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+            start = time.time()
+            with connection.execute_wrapper(counter):
+                func(counter)
+            peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+            report.append((stage, time.time() - start, peak_rss, peak_rss - start_rss, counter.count,
+                           client.num_call - num_call, client.num_image - num_image))
+
+        measure('ingest', lambda counter: tasks.create_product_and_image(file.id))
+        file.refresh_from_db()
+        self.stdout.write('상품 {}개, 이미지 {}개'.format(file.num_product, file.num_image))
+
+        # filter_image_async 와 같이 상태를 바꾸고, 분류 batch task는 in-process 큐로 여러 worker가 처리
+        file.status = 4
+        file.filter_progress_dt = timezone.now()
+        file.filter_run += 1
+        file.refresh_image_count()
+        file.save()
+        broker = LocalBroker(tasks.filter_image_claim)
+
+        def filter_stage(counter):
+            tasks.filter_image_claim.apply_async = broker.apply_async
+            try:
+                tasks.filter_image(file.id, 'zh', file.filter_run)
+                broker.run(num_worker, counter)
+            finally:
+                del tasks.filter_image_claim.apply_async
+
+        measure('filter', filter_stage)
+        file.refresh_from_db()
+        self.stdout.write('포함 {} / 제외 {} / 오류 {}, 캐시 사용률 {}%'.format(
+            file.num_include, file.num_exclude, file.num_error, file.cache_hit_rate()))
+
+        file.status = 6
+        file.save()
+        measure('generate', lambda counter: tasks.generate_product_description(file.id))
+        file.refresh_from_db()
+        self.stdout.write('파일 생성 : {}'.format(file.get_status_display()))
+        return report
+
+    def cleanup(self, file, user, company):
+        file.refresh_from_db()
+        for field in [file.original, file.filtered]:
+            if field and os.path.exists(field.path):
+                os.remove(field.path)
+        ImageAnnotation.objects.filter(file=file).delete()
+        FileStage.objects.filter(file=file).delete()
+        Image.objects.filter(file=file).delete()
+        Product.objects.filter(file=file).delete()
+        file.delete()
+        user.delete()
+        company.delete()
+        OcrCache.objects.filter(Q(uri__startswith=BENCHMARK_URI_PREFIX)).delete()
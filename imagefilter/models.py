@@ -1,15 +1,21 @@
+import json
+import os
+import zlib
+
+from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.contrib.postgres.fields import JSONField
 from django.core.validators import FileExtensionValidator
 from django.db import models
-from django.db.models import Count, Case, Sum, When
+from django.db.models import Count, Case, Q, Sum, When
+from django.utils import timezone
 
 User = get_user_model()
 
 FILE_STATUS_CHOICES = ((0, '파일업로드'),
                        (1, '파일 검증중'), (2, '파일 검증 실패'), (3, '상품/이미지 등록 완료'),
                        (4, '이미지 분류중'), (5, '이미지 분류 완료'),
-                       (6, '파일 생성중'), (7, '파일 생성 완료'))
+                       (6, '파일 생성중'), (7, '파일 생성 완료'), (8, '파일 생성 오류'))
 
 FILE_ERROR_CHOICES = ((0, '파일 읽기 에러'), (1, '상품/이미지 추출 에러'), (2, '알 수 없는 오류'))
 
@@ -30,14 +36,84 @@ class File(models.Model):
     filtered = models.FileField(max_length=500, null=True, blank=True, verbose_name='필터링된 파일', editable=False)
     num_product = models.IntegerField(null=True, blank=True, verbose_name='상품 수')
     num_image = models.IntegerField(null=True, blank=True, verbose_name='이미지 수')
+    num_include = models.IntegerField(default=0, verbose_name='포함 이미지 수', editable=False)
+    num_exclude = models.IntegerField(default=0, verbose_name='제외 이미지 수', editable=False)
+    num_error = models.IntegerField(default=0, verbose_name='오류 이미지 수', editable=False)
+    num_processed = models.IntegerField(default=0, verbose_name='분류된 이미지 수', editable=False)
+    num_cache_hit = models.IntegerField(default=0, verbose_name='캐시 사용 이미지 수', editable=False)
+    num_cache_miss = models.IntegerField(default=0, verbose_name='캐시 미사용 이미지 수', editable=False)
+    num_prefilter = models.IntegerField(default=0, verbose_name='사전 분류 이미지 수', editable=False)
+    num_prefilter_skip = models.IntegerField(default=0, verbose_name='사전 분류로 OCR 생략한 이미지 수', editable=False)
+    num_filter_batch = models.IntegerField(default=0, verbose_name='분류 완료 batch 수', editable=False)
+    filter_progress_dt = models.DateTimeField(null=True, blank=True, verbose_name='분류 진행 일시', editable=False)
+    # 분류를 시작/이어서 할 때마다 증가 (이전 실행의 batch task는 번호가 달라서 다시 큐에 넣지 않고 종료)
+    filter_run = models.IntegerField(default=0, verbose_name='분류 실행 번호', editable=False)
 
     status = models.IntegerField(choices=FILE_STATUS_CHOICES, default=0, null=False, blank=False, verbose_name='상태',
                                  editable=False)
     error = models.IntegerField(choices=FILE_ERROR_CHOICES, null=True, blank=True, verbose_name='에러', editable=False)
+    error_message = models.TextField(null=True, blank=True, verbose_name='에러 내용', editable=False)
 
     def __str__(self):
         return self.original.path.split('/')[-1]
 
+    def prefilter_skip_rate(self):
+        if not self.num_prefilter:
+            return None
+        return round(self.num_prefilter_skip * 100 / self.num_prefilter, 1)
+
+    prefilter_skip_rate.short_description = 'OCR 생략률(%)'
+
+    def cache_hit_rate(self):
+        if not self.num_cache_hit + self.num_cache_miss:
+            return None
+        return round(self.num_cache_hit * 100 / (self.num_cache_hit + self.num_cache_miss), 1)
+
+    cache_hit_rate.short_description = '캐시 사용률(%)'
+
+    def is_filter_stale(self):
+        # 분류중인데 IMAGEFILTER_FILTER_STALE_TIMEOUT 동안 진행된 batch가 없으면 worker가 종료된 것으로 판단
+        if self.status != 4:
+            return False
+        if self.filter_progress_dt is None:
+            return True
+        return (timezone.now() - self.filter_progress_dt).total_seconds() > settings.IMAGEFILTER_FILTER_STALE_TIMEOUT
+
+    def backfill_image_file(self):
+        # Image.file 컬럼 추가 전에 등록된 이미지 보정 (file_id 로 조회하는 작업 전에 호출)
+        # 보정이 끝난 뒤에는 image_file_null_idx (비어있는 partial index) 만 확인하므로 비용이 거의 없음
+        if not Image.objects.filter(file__isnull=True).order_by().exists():
+            return 0
+        return Image.objects.filter(Q(file__isnull=True) & Q(product__file=self)).update(file=self)
+
+    def backfill_image_uri_hash(self):
+        # Image.uri_hash 컬럼 추가 전에 등록된 이미지 보정 (uri_hash 로 분류 대상을 가져오기 전에 호출)
+        # 보정이 끝난 뒤에는 image_uri_hash_null_idx (비어있는 partial index) 만 확인하므로 비용이 거의 없음
+        from imagefilter.utils.ocr_cache import get_uri_hash
+        num_updated = 0
+        while True:
+            image_list = list(Image.objects.filter(Q(file=self) & Q(uri_hash__isnull=True)).order_by().only(
+                'id', 'uri')[:settings.IMAGEFILTER_IMAGE_BULK_SIZE])
+            if not image_list:
+                return num_updated
+            for image in image_list:
+                image.uri_hash = get_uri_hash(image.uri)
+            Image.objects.bulk_update(image_list, ['uri_hash'])
+            num_updated += len(image_list)
+
+    def refresh_image_count(self):
+        # 분류 결과별 이미지 수를 Image 테이블에서 다시 계산 (기존 데이터 보정용)
+        self.backfill_image_file()
+        count = Image.objects.filter(file=self).aggregate(
+            num_include=Count('id', filter=Q(type=4)),
+            num_exclude=Count('id', filter=Q(type=3)),
+            num_error=Count('id', filter=Q(type=1)))
+        self.num_include = count['num_include']
+        self.num_exclude = count['num_exclude']
+        self.num_error = count['num_error']
+        self.num_processed = self.num_include + self.num_exclude + self.num_error
+        self.save(update_fields=['num_include', 'num_exclude', 'num_error', 'num_processed'])
+
     def has_permission(self, user):
         if user.is_company_admin:
             if self.user.company == user.company:
@@ -48,6 +124,80 @@ class File(models.Model):
         return False
 
 
+class FileUpload(models.Model):
+    # 큰 파일을 여러 조각으로 나눠 올리는 업로드 (조각마다 sha256 확인, 끊겨도 받지 못한 조각만 다시 전송)
+    # 조각은 MEDIA_ROOT 아래 임시 파일의 해당 위치에 바로 기록하고, 모두 받으면 File.original 경로로 옮긴다.
+    class Meta:
+        verbose_name = '파일 업로드'
+        verbose_name_plural = verbose_name
+        ordering = ('-created_dt',)
+
+    user = models.ForeignKey(User, null=False, blank=False, on_delete=models.PROTECT, verbose_name='사용자',
+                             editable=False)
+    title = models.CharField(max_length=100, verbose_name='작업명')
+    file_name = models.CharField(max_length=255, verbose_name='파일명')
+    size = models.BigIntegerField(verbose_name='파일 크기')
+    chunk_size = models.IntegerField(verbose_name='조각 크기')
+    received_chunks = JSONField(default=list, verbose_name='받은 조각')
+    file = models.OneToOneField(File, null=True, blank=True, on_delete=models.SET_NULL, verbose_name='파일',
+                                editable=False)
+    created_dt = models.DateTimeField(auto_now_add=True, verbose_name='생성일시')
+    updated_dt = models.DateTimeField(auto_now=True, verbose_name='수정일시')
+
+    def __str__(self):
+        return self.file_name
+
+    @property
+    def num_chunk(self):
+        return max((self.size + self.chunk_size - 1) // self.chunk_size, 1)
+
+    def get_chunk_length(self, index):
+        return min(self.chunk_size, self.size - index * self.chunk_size)
+
+    def get_missing_chunks(self):
+        received = set(self.received_chunks)
+        return [index for index in range(self.num_chunk) if index not in received]
+
+    def get_part_path(self):
+        return os.path.join(settings.MEDIA_ROOT, 'imagefilter', 'upload', '{}.part'.format(self.id))
+
+
+FILE_STAGE_CHOICES = (('ingest', '상품 등록'), ('extract', '이미지 추출'), ('filter', '이미지 분류'), ('generate', '파일 생성'))
+
+
+class FileStage(models.Model):
+    class Meta:
+        verbose_name = '파일 처리 단계'
+        verbose_name_plural = verbose_name
+        unique_together = (('file', 'stage'),)
+        ordering = ('start_dt',)
+
+    file = models.ForeignKey(File, null=False, blank=False, verbose_name='파일', on_delete=models.PROTECT,
+                             editable=False)
+    stage = models.CharField(max_length=20, choices=FILE_STAGE_CHOICES, verbose_name='단계')
+    start_dt = models.DateTimeField(verbose_name='시작일시')
+    end_dt = models.DateTimeField(null=True, blank=True, verbose_name='종료일시')
+    num_item = models.IntegerField(null=True, blank=True, verbose_name='처리 건수')
+
+    def __str__(self):
+        return self.get_stage_display()
+
+    def duration(self):
+        if self.end_dt is None:
+            return None
+        return (self.end_dt - self.start_dt).total_seconds()
+
+    duration.short_description = '소요시간(초)'
+
+    def throughput(self):
+        duration = self.duration()
+        if not duration or self.num_item is None:
+            return None
+        return round(self.num_item / duration, 1)
+
+    throughput.short_description = '초당 처리 건수'
+
+
 class Product(models.Model):
     class Meta:
         verbose_name = '상품'
@@ -64,6 +214,7 @@ class Product(models.Model):
     original_description = models.TextField(null=True, blank=True, verbose_name='원본 상세설명')
     filtered_description = models.TextField(null=True, blank=True, verbose_name='필터링후 상세설명')
     status = models.IntegerField(choices=STATUS_CHOICES, null=False, blank=False, verbose_name='필터링 후 변동')
+    dirty = models.BooleanField(default=False, db_index=True, verbose_name='재생성 필요', editable=False)
 
     def __str__(self):
         return self.name
@@ -79,6 +230,8 @@ class Product(models.Model):
 
 
 IMAGE_TYPE_CHOICES = ((0, '분류 전'), (1, '분류 실패'), (2, '분류중'), (3, '제외'), (4, '포함'),)
+# 분류결과별로 갱신되는 File의 이미지 수 필드
+IMAGE_TYPE_COUNT_FIELD = {1: 'num_error', 3: 'num_exclude', 4: 'num_include'}
 
 
 class Image(models.Model):
@@ -86,15 +239,43 @@ class Image(models.Model):
         verbose_name = '이미지'
         verbose_name_plural = verbose_name
         ordering = ('-product', '-id',)
+        indexes = [
+            models.Index(fields=['file', 'type'], name='image_file_type_idx'),
+            models.Index(fields=['file', 'product', 'id'], name='image_file_product_id_idx'),
+            # 분류 전/분류중 이미지만 담는 partial index (분류 대상 uri 조회/결과 반영)
+            # uri 는 길이 제한이 없어서 (data: uri, 서명된 긴 url 등) btree 에 넣을 수 없으므로 고정 길이 uri_hash 사용
+            models.Index(fields=['file', 'uri_hash'], name='image_unclassified_idx', condition=Q(type__in=[0, 2])),
+            # Image.file 이 비어있는 (컬럼 추가 전) 이미지만 담는 partial index (File.backfill_image_file)
+            models.Index(fields=['product'], name='image_file_null_idx', condition=Q(file__isnull=True)),
+            # Image.uri_hash 가 비어있는 (컬럼 추가 전) 이미지만 담는 partial index (File.backfill_image_uri_hash)
+            models.Index(fields=['file'], name='image_uri_hash_null_idx', condition=Q(uri_hash__isnull=True)),
+        ]
 
     filter_dt = models.DateTimeField(null=True, blank=True, verbose_name='분류일시', editable=False)
+    # 분류중(2)으로 변경한 일시 (이어서 분류할 때 오래된 것만 다시 분류 전으로)
+    claim_dt = models.DateTimeField(null=True, blank=True, verbose_name='분류 시작 일시', editable=False)
     product = models.ForeignKey(Product, null=False, blank=False, verbose_name='상품', on_delete=models.PROTECT,
                                 db_index=True)
+    # product__file 조인 없이 파일 단위로 조회하기 위한 중복 컬럼 (인덱스는 Meta.indexes)
+    file = models.ForeignKey(File, null=True, blank=True, verbose_name='파일', on_delete=models.PROTECT,
+                             editable=False, db_index=False)
     uri = models.TextField(null=False, blank=False, verbose_name='이미지 uri')
-    extracted_text = JSONField(null=True, blank=True, verbose_name='이미지 분석 결과')
+    # imagefilter.utils.ocr_cache.get_uri_hash(uri) (인덱스는 Meta.indexes, 저장할 때 채움)
+    uri_hash = models.CharField(max_length=64, null=True, blank=True, verbose_name='uri 해시', editable=False)
+    # 이전에 저장된 vision api 전체 결과 (새 결과는 ImageAnnotation에 저장)
+    extracted_text = JSONField(null=True, blank=True, verbose_name='이미지 분석 결과', editable=False)
+    locale = models.CharField(max_length=20, null=True, blank=True, verbose_name='인식 언어', editable=False)
+    text_length = models.IntegerField(null=True, blank=True, verbose_name='인식 글자 수', editable=False)
+    languages = JSONField(null=True, blank=True, verbose_name='언어 분포', editable=False)
     type = models.IntegerField(choices=IMAGE_TYPE_CHOICES, default=0, verbose_name='분류결과')
     error = models.TextField(null=True, blank=True, verbose_name='에러')
 
+    def save(self, *args, **kwargs):
+        # bulk_create 로 등록할 때는 uri_hash 를 직접 채워야 함
+        from imagefilter.utils.ocr_cache import get_uri_hash
+        self.uri_hash = get_uri_hash(self.uri)
+        super().save(*args, **kwargs)
+
     def has_permission(self, user):
         if user.is_company_admin:
             if self.product.file.user.company == user.company:
@@ -105,4 +286,69 @@ class Image(models.Model):
         return False
 
     def error_str(self):
-        return self.error
\ No newline at end of file
+        return self.error
+
+    def get_annotation(self):
+        # vision api 전체 결과는 필요할 때만 ImageAnnotation에서 읽는다.
+        from imagefilter.utils.ocr_cache import get_uri_hash
+        annotation = ImageAnnotation.objects.filter(Q(file_id=self.file_id) & Q(uri_hash=get_uri_hash(self.uri))).first()
+        if annotation:
+            return annotation.get_data()
+        # 캐시로 분류된 이미지는 ImageAnnotation 없이 캐시의 요약 결과만 있음
+        cache = OcrCache.objects.filter(uri_hash=get_uri_hash(self.uri)).first()
+        if cache:
+            return cache.get_data()
+        return self.extracted_text
+
+
+def compress_json(data_dict):
+    return zlib.compress(json.dumps(data_dict, ensure_ascii=False).encode('utf-8'))
+
+
+def decompress_json(data):
+    return json.loads(zlib.decompress(bytes(data)).decode('utf-8'))
+
+
+class ImageAnnotation(models.Model):
+    class Meta:
+        verbose_name = '이미지 분석 결과'
+        verbose_name_plural = verbose_name
+        unique_together = (('file', 'uri_hash'),)
+
+    file = models.ForeignKey(File, null=False, blank=False, verbose_name='파일', on_delete=models.PROTECT,
+                             editable=False)
+    uri_hash = models.CharField(max_length=64, verbose_name='uri 해시')
+    uri = models.TextField(null=False, blank=False, verbose_name='이미지 uri')
+    data = models.BinaryField(verbose_name='분석 결과(zlib 압축 json)')
+
+    def __str__(self):
+        return self.uri
+
+    @staticmethod
+    def compress_data(data_dict):
+        return compress_json(data_dict)
+
+    def get_data(self):
+        return decompress_json(self.data)
+
+
+class OcrCache(models.Model):
+    class Meta:
+        verbose_name = 'OCR 캐시'
+        verbose_name_plural = verbose_name
+        ordering = ('-last_hit_dt',)
+
+    uri_hash = models.CharField(max_length=64, unique=True, verbose_name='uri 해시')
+    uri = models.TextField(null=False, blank=False, verbose_name='이미지 uri')
+    content_hash = models.CharField(max_length=64, null=True, blank=True, db_index=True, verbose_name='이미지 해시')
+    # 분류에 필요한 값만 남긴 결과 (imagefilter.utils.classify.compact_filter_result)
+    data = models.BinaryField(verbose_name='분석 결과(zlib 압축 json)')
+    created_dt = models.DateTimeField(auto_now_add=True, db_index=True, verbose_name='생성일시')
+    last_hit_dt = models.DateTimeField(auto_now_add=True, db_index=True, verbose_name='최근 사용일시')
+    num_hit = models.IntegerField(default=0, verbose_name='사용 횟수')
+
+    def __str__(self):
+        return self.uri
+
+    def get_data(self):
+        return decompress_json(self.data)
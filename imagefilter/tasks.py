@@ -1,27 +1,29 @@
 from __future__ import absolute_import
 
-import json
-import time
+import logging
+import os
+from itertools import islice
 from time import sleep
 
 import pandas as pd
 import numpy as np
-import xlrd
-from bs4 import BeautifulSoup as bs
-from celery import chain, group
+from celery import chord
 from django.conf import settings
-from django.db import transaction
-from django.db.models import Q
+from django.db import DatabaseError, transaction
+from django.contrib.postgres.fields import JSONField
+from django.db.models import Case, CharField, F, IntegerField, Max, Min, Q, TextField, Value, When
 from django.utils import timezone
-from google.cloud.vision_v1.proto.image_annotator_pb2 import AnnotateImageRequest
 
 from imagefilter import exceptions
-from imagefilter.models import Image, Product, File
+from imagefilter.models import Image, ImageAnnotation, Product, File
+from imagefilter.utils import fetch, metrics, ocr, ocr_cache, prefilter, progress, rate_limit, upload
+from imagefilter.utils.classify import classify_filter_result, summarize_filter_result
+from imagefilter.utils.extract_image import extract_image_uri, remove_image
+from imagefilter.utils.read_xlsx import iter_product_rows, iter_sheet_rows, normalize_cell, probe_schema
+from imagefilter.utils.write_xls import write_xls
 from rawlabs.celery import app
-from google.oauth2 import service_account
-from google.cloud import vision_v1
-from imagefilter.models import Image
-from google.protobuf.json_format import MessageToDict
+
+logger = logging.getLogger(__name__)
 
 
 @app.task
@@ -30,110 +32,420 @@ def add(x, y):
     return x + y
 
 
+@app.task
+def check_file_header(file_id):
+    # 조각 업로드가 끝난 파일은 헤더와 처음 몇 행만 읽어 형식을 확인하고, 통과하면 상품/이미지 등록을 이어서 실행
+    file = File.objects.get(Q(id=file_id) & Q(status=1))
+    try:
+        probe_schema(file.original.path)
+    except exceptions.ExcelFormatException as e:
+        file.status = 2
+        file.error = 0
+        file.error_message = str(e)
+        file.save()
+    else:
+        create_product_and_image.apply_async((file_id,), queue=get_file_queue(file, 'ingest'))
+
+
 @app.task
 def create_product_and_image(file_id):
     from imagefilter.models import File
     from imagefilter.models import Product
     file = File.objects.get(Q(id=file_id) & Q(status=1))
+    metrics.start_stage(file_id, 'ingest')
+    progress.start_progress(file_id, 'ingest')
     try:
-        data_list = excel_to_dict(file.original.path)
-    except exceptions.ExcelFormatException:
+        if settings.IMAGEFILTER_STREAMING_INGEST:
+            data_list = iter_product_rows(file.original.path)
+        else:
+            data_list = excel_to_dict(file.original.path)
+        with transaction.atomic():
+            # 상품은 일정한 크기로 나눠서 등록해 파일 크기와 관계없이 메모리 사용량을 유지
+            num_product = 0
+            for data_chunk in iter_chunker(data_list, settings.IMAGEFILTER_INGEST_BATCH_SIZE):
+                Product.objects.bulk_create([Product(file_id=file_id, status=0, **data) for data in data_chunk])
+                num_product += len(data_chunk)
+                progress.add_progress(file_id, len(data_chunk))
+    except exceptions.ExcelFormatException as e:
+        file.status = 2
+        file.error = 0
+        file.error_message = str(e)
+        file.save()
+    except DatabaseError as e:
+        # 행 검사로 걸러지지 않은 값(형식 등)이 등록에 실패한 경우, 등록 내용은 rollback 되었으므로 검증 실패로 처리
+        logger.exception('file %s : 상품 등록 실패', file_id)
         file.status = 2
         file.error = 0
+        file.error_message = '상품을 등록할 수 없는 값이 있습니다. ({})'.format(str(e).splitlines()[0])
         file.save()
     else:
+        file.num_product = num_product
+        file.save()
+        metrics.finish_stage(file_id, 'ingest', num_product)
+        extract_image.apply_async((file_id,), queue=get_file_queue(file, 'ingest'))
+
+
+@app.task
+def extract_image(file_id):
+    # 상품 id 구간을 나눠 여러 worker에서 이미지를 추출하고, 모두 끝나면 extract_image_callback 실행
+    metrics.start_stage(file_id, 'extract')
+    file = File.objects.get(id=file_id)
+    progress.start_progress(file_id, 'extract', file.num_product)
+    queue = get_file_queue(file, 'ingest')
+    range_list = split_product_range(file_id, settings.IMAGEFILTER_EXTRACT_CHUNK_SIZE)
+    if not range_list:
+        extract_image_callback.apply_async(([], file_id), queue=queue)
+        return
+    chord([extract_image_range.s(file_id, start_id, end_id).set(queue=queue) for start_id, end_id in range_list])(
+        extract_image_callback.s(file_id).set(queue=queue))
+
+
+def get_file_queue(file, queue):
+    # 작은 파일은 큰 파일의 task 뒤에서 기다리지 않도록 우선처리 큐로 보냄
+    if file.num_image is not None:
+        is_small = file.num_image <= settings.IMAGEFILTER_PRIORITY_MAX_IMAGES
+    else:
+        try:
+            is_small = file.original.size <= settings.IMAGEFILTER_PRIORITY_MAX_BYTES
+        except (OSError, ValueError):
+            is_small = False
+    return settings.IMAGEFILTER_PRIORITY_QUEUE if is_small else queue
+
+
+def split_product_range(file_id, chunk_size):
+    # 파일의 상품 id를 [start_id, end_id) 구간 목록으로 나눈다.
+    id_range = Product.objects.filter(file_id=file_id).aggregate(start_id=Min('id'), end_id=Max('id'))
+    if id_range['start_id'] is None:
+        return []
+    return [(start_id, start_id + chunk_size) for start_id in range(id_range['start_id'], id_range['end_id'] + 1, chunk_size)]
+
+
+@app.task(ignore_result=False)
+def extract_image_range(file_id, start_id, end_id):
+    product_list = Product.objects.values_list('id', 'original_description').filter(
+        Q(file_id=file_id) & Q(id__gte=start_id) & Q(id__lt=end_id))
+    bulk_size = settings.IMAGEFILTER_IMAGE_BULK_SIZE
+    try:
         with transaction.atomic():
-            try:
-                Product.objects.bulk_create([Product(file_id=file_id, **data) for data in data_list])
-                product_list = Product.objects.values('id', 'original_description').filter(file_id=file_id)
-                for product in product_list:
-                    product_to_image(product)
-            except exceptions.ExtractImageException:
-                file.status = 2
-                file.error = 1
-                file.save()
-            else:
-                file.status = 3
-                file.num_product = product_list.count()
-                file.num_image = Image.objects.filter(product__file=file).count()
-                file.error = None
-                file.save()
+            # 여러 상품의 이미지를 모아서 한번에 등록
+            image_list = []
+            num_product = 0
+            for product_id, description in product_list.iterator():
+                num_product += 1
+                image_list.extend(Image(product_id=product_id, file_id=file_id, uri=uri,
+                                        uri_hash=ocr_cache.get_uri_hash(uri))
+                                  for uri in extract_image_uri(description))
+                if len(image_list) >= bulk_size:
+                    Image.objects.bulk_create(image_list, batch_size=bulk_size)
+                    image_list = []
+            Image.objects.bulk_create(image_list, batch_size=bulk_size)
+    except Exception:
+        # 구간 하나가 실패해도 chord callback 이 실행되어 파일 상태가 정리되도록 False 반환
+        logger.exception('file %s : 상품 %s ~ %s 이미지 추출 실패', file_id, start_id, end_id)
+        return False
+    progress.add_progress(file_id, num_product)
+    return True
+
+
+@app.task
+def extract_image_callback(results, file_id):
+    file = File.objects.get(id=file_id)
+    if all(results):
+        file.status = 3
+        file.num_image = Image.objects.filter(file=file).count()
+        file.error = None
+        file.save()
+        metrics.finish_stage(file_id, 'extract', file.num_image)
+    else:
+        # 일부 구간이 실패하면 등록된 상품/이미지를 모두 정리 (삭제 순서 주의)
+        with transaction.atomic():
+            Image.objects.filter(file_id=file_id).delete()
+            Product.objects.filter(file_id=file_id).delete()
+            file.status = 2
+            file.error = 1
+            file.error_message = '이미지 추출에 실패한 상품 구간이 있습니다. ({}/{}개 구간)'.format(
+                results.count(False), len(results))
+            file.num_product = None
+            file.save()
 
 
 def chunker(seq, size):
     return (seq[pos:pos + size] for pos in range(0, len(seq), size))
 
 
+def iter_chunker(iterable, size):
+    # 길이를 알 수 없는 generator를 size 단위 list로 나눈다.
+    iterator = iter(iterable)
+    chunk = list(islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, size))
+
+
 @app.task
-def filter_image(file_id, excluded_locales):
-    from imagefilter.models import Image
-    from imagefilter.models import File
-    image_list = list(Image.objects.values('id', 'uri').filter(Q(product__file_id=file_id) & Q(type=0)))
-    image_chunk = chunker(image_list, 5)
-    with open(settings.GOOGLE_VISION_API_CREDENTIAL_PATH, 'r') as json_credential:
-        google_credential_info = json.loads(json_credential.read())
-
-    credentials = service_account.Credentials.from_service_account_info(google_credential_info)
-    client = vision_v1.ImageAnnotatorClient(credentials=credentials)
-    features = [vision_v1.types.Feature(type=vision_v1.enums.Feature.Type.TEXT_DETECTION)]
-    for chunk in image_chunk:
-        requests = []
-        for image_instance in chunk:
-            # result = filter_single_image.delay(image_id, excluded_locales, google_client=client)
-            uri = image_instance.get('uri')
-            image = vision_v1.types.Image()
-            image.source.image_uri = uri
-            image_request = vision_v1.types.AnnotateImageRequest(image=image, features=features)
-            requests.append(image_request)
-
-            response = client.batch_annotate_images(requests)
-
-            for idx, annotate_response in enumerate(response.responses):
-                image_id = chunk[idx]['id']
-                try:
-                    data_dict = MessageToDict(annotate_response)
-                    error = None
-                except Exception as e:
-                    data_dict = None
-                    error = e
-                filter_image_callback.delay(image_id, excluded_locales, data_dict, error)
+def filter_image(file_id, excluded_locales, run=None):
+    # 파일마다 IMAGEFILTER_FILTER_CONCURRENCY 개의 batch task를 시작
+    # 각 task는 batch 하나를 분류한 뒤 자신을 다시 큐 뒤에 넣으므로 여러 파일의 batch가 번갈아 처리되고,
+    # 한 파일의 batch는 여러 worker(서버)에서 동시에 처리된다.
+    # run : 요청할 때의 File.filter_run (그 사이 다시 요청되었으면 시작하지 않음)
+    file = File.objects.get(id=file_id)
+    if run != file.filter_run:
+        return
+    metrics.start_stage(file_id, 'filter')
+    # 이어서 분류하는 경우 이미 분류한 이미지 수부터 표시
+    progress.set_progress(file_id, 'filter', file.num_processed, file.num_image)
+    queue = get_file_queue(file, 'ocr')
+    for _ in range(settings.IMAGEFILTER_FILTER_CONCURRENCY):
+        filter_image_claim.apply_async((file_id, excluded_locales, run), queue=queue)
 
 
 @app.task
-def filter_image_callback(image_id, excluded_locales, data_dict, error):
-    _image_instance = Image.objects.select_related('product', 'product__file').get(id=image_id)
-    if data_dict == None:
-        _image_instance.type = 2
-        _image_instance.error = str(error)
-    else:
-        _image_instance.extracted_text = data_dict
-        _image_instance.save()
-        text_annotations = data_dict.get('textAnnotations', None)
-        error = data_dict.get('error', None)
-        if text_annotations:  # 텍스트 인식 성공
-            locale = text_annotations[0]['locale']
-            if locale in [excluded_locales] if isinstance(excluded_locales, str) else excluded_locales:
-                _image_instance.type = 3
-            else:
-                _image_instance.type = 4
-        elif error:
-            error = error
-            _image_instance.type = 1
-            _image_instance.error = error['message']
-        elif data_dict == {}:
-            # vision api가 빈 dictionary를 반환하면 글자가 없다고 판단한 것
-            _image_instance.type = 4
+def filter_image_claim(file_id, excluded_locales, run=None):
+    # 분류 전 이미지를 uri 단위 batch로 가져와서(분류중으로 변경) 분류하고, batch마다 진행상황을 기록
+    # 중간에 worker가 종료되어도 분류가 끝난 batch는 다시 요청하지 않음 (resume_filter_image_async)
+    file = File.objects.select_related('user').get(id=file_id)
+    # 이어서 분류가 요청된 뒤의 이전 task는 종료 (같은 파일의 task 수가 계속 늘어나지 않도록)
+    if run != file.filter_run:
+        return
+    queue = get_file_queue(file, 'ocr')
+    uri_list = claim_image_uri(file_id, settings.IMAGEFILTER_CLAIM_SIZE)
+    if not uri_list:
+        finish_filter_image(file_id)
+        return
+    # 가져온 batch는 분류중(2)이므로 분류하지 못하면 (redis 오류 포함) 다시 분류 전으로 되돌림
+    try:
+        # 전체/업체별 분당 이미지 수를 넘으면 batch를 돌려놓고 다음 1분에 다시 시도 (worker를 점유하지 않음)
+        # 캐시로 분류되는 이미지도 포함해서 계산하므로 실제 api 호출량보다 보수적
+        countdown = rate_limit.acquire([('ocr', settings.IMAGEFILTER_OCR_IMAGES_PER_MINUTE),
+                                        ('company:{}'.format(file.user.company_id),
+                                         settings.IMAGEFILTER_COMPANY_IMAGES_PER_MINUTE)], len(uri_list))
+        if countdown:
+            release_image_uri(file_id, uri_list)
+            # 기다리는 동안 중단된 것으로 보이지 않도록 진행 일시를 갱신
+            File.objects.filter(id=file_id).update(filter_progress_dt=timezone.now())
+            filter_image_claim.apply_async((file_id, excluded_locales, run), queue=queue, countdown=countdown)
+            return
+        filter_image_batch(file_id, uri_list, excluded_locales, ocr.get_backend())
+    except Exception:
+        release_image_uri(file_id, uri_list)
+        raise
+    File.objects.filter(id=file_id).update(num_filter_batch=F('num_filter_batch') + 1,
+                                           filter_progress_dt=timezone.now())
+    filter_image_claim.apply_async((file_id, excluded_locales, run), queue=queue)
+
+
+def claim_image_uri(file_id, size):
+    # 분류 전(0) 이미지 중 다른 worker가 잡고 있지 않은 것을 골라 같은 uri의 이미지 전체를 분류중(2)으로 변경
+    # uri 대신 고정 길이 uri_hash 순서로 가져옴 (image_unclassified_idx)
+    uri_list = []
+    with transaction.atomic():
+        hash_list = list(dict.fromkeys(Image.objects.select_for_update(skip_locked=True).filter(
+            Q(file_id=file_id) & Q(type=0)).order_by('uri_hash').values_list('uri_hash', flat=True)[:size]))
+        if hash_list:
+            # 경계의 uri는 다른 worker도 일부 잡고 있을 수 있으므로 잠긴 행은 건너뜀 (결과 반영은 uri 기준이라 중복되지 않음)
+            row_list = list(Image.objects.select_for_update(skip_locked=True).filter(
+                Q(file_id=file_id) & Q(type=0) & Q(uri_hash__in=hash_list)).order_by().values_list('id', 'uri'))
+            Image.objects.filter(id__in=[id for id, _ in row_list]).update(type=2, claim_dt=timezone.now())
+            uri_list = list(dict.fromkeys(uri for _, uri in row_list))
+    return uri_list
+
+
+def uri_filter(uri_list):
+    # uri 목록 조건 (image_unclassified_idx 를 사용하도록 uri_hash 조건도 함께)
+    return Q(uri_hash__in=list({ocr_cache.get_uri_hash(uri) for uri in uri_list})) & Q(uri__in=uri_list)
+
+
+def release_image_uri(file_id, uri_list):
+    # 분류하지 못한 batch는 다시 분류 전(0)으로 되돌림
+    Image.objects.filter(Q(file_id=file_id) & Q(type=2) & uri_filter(uri_list)).update(type=0)
+
+
+def finish_filter_image(file_id):
+    # 남은 이미지가 없으면 (이미지 수가 맞지 않더라도) 분류 완료
+    if Image.objects.filter(Q(file_id=file_id) & Q(type__in=[0, 2])).exists():
+        return
+    with transaction.atomic():
+        file = File.objects.select_for_update().get(id=file_id)
+        if file.status == 4:
+            file.refresh_image_count()
+            file.status = 5
+            file.save(update_fields=['status'])
+    metrics.finish_stage(file_id, 'filter', file.num_image)
+
+
+def filter_image_batch(file_id, uri_list, excluded_locales, backend):
+    # 같은 파일에서 반복되는 uri는 한번만 분류하고 결과를 같은 uri의 이미지 전체에 반영
+    bulk_size = settings.IMAGEFILTER_RESULT_BULK_SIZE
+
+    # 캐시에 있는 이미지는 api 호출 없이 바로 분류
+    miss_list = []
+    for uri_chunk in chunker(uri_list, bulk_size):
+        cached_dict = ocr_cache.get_cached_result(uri_chunk)
+        hit_list = [(uri, cached_dict[uri], None) for uri in uri_chunk if uri in cached_dict]
+        miss_list.extend(uri for uri in uri_chunk if uri not in cached_dict)
+        File.objects.filter(id=file_id).update(num_cache_hit=F('num_cache_hit') + len(hit_list),
+                                               num_cache_miss=F('num_cache_miss') + len(uri_chunk) - len(hit_list))
+        metrics.inc('imagefilter_ocr_cache_total', len(hit_list), result='hit')
+        metrics.inc('imagefilter_ocr_cache_total', len(uri_chunk) - len(hit_list), result='miss')
+        if hit_list:
+            save_filter_result(file_id, hit_list, excluded_locales, annotate=False)
+
+    # IMAGEFILTER_OCR_BACKEND (기본은 google vision api) 로 글자 인식
+    if settings.IMAGEFILTER_FETCH_INLINE:
+        miss_list = filter_image_content(file_id, miss_list, excluded_locales, backend)
+    elif settings.IMAGEFILTER_PREFILTER:
+        miss_list = prefilter_image(file_id, miss_list, excluded_locales)
+
+    result_list = []
+    for result in backend.iter_text_detection([(uri, uri) for uri in miss_list]):
+        result_list.append(result)
+        if len(result_list) >= bulk_size:
+            ocr_cache.set_cached_result([(uri, data_dict, None) for uri, data_dict, _ in result_list])
+            save_filter_result(file_id, result_list, excluded_locales)
+            result_list = []
+    ocr_cache.set_cached_result([(uri, data_dict, None) for uri, data_dict, _ in result_list])
+    save_filter_result(file_id, result_list, excluded_locales)
+
+
+def filter_image_content(file_id, uri_list, excluded_locales, backend):
+    # 이미지를 직접 받아서 bytes 로 글자 인식하고, 받지 못한 uri 목록을 반환 (uri 로 다시 요청)
+    # 작은 이미지는 받는 도중에 포함(4) 처리, 내용이 같은 이미지는 캐시 결과를 사용
+    fetcher = fetch.get_fetcher()
+    remain_list = []
+    for uri_chunk in chunker(uri_list, settings.IMAGEFILTER_FETCH_CHUNK_SIZE):
+        skip_list = []
+        hit_list = []
+        content_dict = {}
+        num_prefilter = 0
+        for image in fetcher.iter_fetch(uri_chunk):
+            if image.error:
+                remain_list.append(image.uri)
+                continue
+            if image.is_tiny():
+                # 작은 이미지도 OCR 을 생략한 사전 분류 이미지로 계산 (OCR 생략률이 100%를 넘지 않도록)
+                num_prefilter += 1
+                skip_list.append((image.uri, {'prefilter': {'width': image.width, 'height': image.height}}, None))
+                continue
+            if image.content_hash in content_dict:
+                # 내용이 같은 이미지는 한번만 글자 인식
+                content_dict[image.content_hash][1].append(image.uri)
+                continue
+            cached = ocr_cache.get_cached_result_by_content(image.content_hash)
+            if cached is not None:
+                hit_list.append((image.uri, cached, None))
+                continue
+            if settings.IMAGEFILTER_PREFILTER:
+                num_prefilter += 1
+                edge_ratio = prefilter.get_edge_ratio_content(image.content)
+                if prefilter.is_no_text(edge_ratio):
+                    skip_list.append((image.uri, {'prefilter': {'edgeRatio': edge_ratio}}, None))
+                    continue
+            content_dict[image.content_hash] = (image.content, [image.uri])
+
+        result_list = []
+        cache_list = []
+        for content_hash, data_dict, error in backend.iter_text_detection_content(
+                [(content_hash, content) for content_hash, (content, _) in content_dict.items()]):
+            same_uri_list = content_dict[content_hash][1]
+            result_list.extend((uri, data_dict, error) for uri in same_uri_list)
+            cache_list.append((same_uri_list[0], data_dict, content_hash))
+        del content_dict
+        ocr_cache.set_cached_result(cache_list)
+        if hit_list:
+            save_filter_result(file_id, hit_list, excluded_locales, annotate=False)
+        save_filter_result(file_id, skip_list + result_list, excluded_locales)
+        File.objects.filter(id=file_id).update(num_cache_hit=F('num_cache_hit') + len(hit_list),
+                                               num_cache_miss=F('num_cache_miss') - len(hit_list),
+                                               num_prefilter=F('num_prefilter') + num_prefilter,
+                                               num_prefilter_skip=F('num_prefilter_skip') + len(skip_list))
+    return remain_list
+
+
+def prefilter_image(file_id, uri_list, excluded_locales):
+    # 글자가 없는 것이 확실한 이미지는 OCR 없이 포함(4) 처리하고, 나머지 uri 목록을 반환
+    bulk_size = settings.IMAGEFILTER_RESULT_BULK_SIZE
+    remain_list = []
+    skip_list = []
+    for uri, edge_ratio in prefilter.iter_prefilter(uri_list):
+        if prefilter.is_no_text(edge_ratio):
+            skip_list.append((uri, {'prefilter': {'edgeRatio': edge_ratio}}, None))
         else:
-            _image_instance.type = 1
-            _image_instance.error = '관리자 문의'
-    _image_instance.filter_dt = timezone.now()
-    _image_instance.save()
-    all_image = list(set(Image.objects.values_list('type', flat=True).filter(product__file=_image_instance.product.file)))
-
-    if all_image.count(2) == 0 and all_image.count(0) == 0:
-        file = _image_instance.product.file
-        file.status = 5
-        file.save()
+            remain_list.append(uri)
+        if len(skip_list) >= bulk_size:
+            save_filter_result(file_id, skip_list, excluded_locales)
+            skip_list = []
+    if skip_list:
+        save_filter_result(file_id, skip_list, excluded_locales)
+    File.objects.filter(id=file_id).update(num_prefilter=F('num_prefilter') + len(uri_list),
+                                           num_prefilter_skip=F('num_prefilter_skip') + len(uri_list) - len(remain_list))
+    return remain_list
+
+
+@app.task
+def prune_ocr_cache():
+    ocr_cache.prune_cache()
+
+
+@app.task
+def prune_file_upload():
+    upload.prune_upload()
+
+
+@app.task
+def filter_image_callback(image_id, excluded_locales, data_dict, error):
+    _image = Image.objects.values('uri', 'product__file_id').get(id=image_id)
+    save_filter_result(_image['product__file_id'], [(_image['uri'], data_dict, error)], excluded_locales)
+
+
+def save_filter_result(file_id, result_list, excluded_locales, annotate=True):
+    # result_list : [(uri, data_dict, error), ...]
+    # 분류 결과를 메모리에서 한번에 판정하고, 같은 uri를 가진 이미지 전체를 분류결과별 한번의 UPDATE로 반영
+    # Image에는 분류에 필요한 요약만 저장하고, 전체 결과는 ImageAnnotation에 압축해서 저장
+    # annotate=False : 캐시 결과 (캐시에 있는 요약 결과를 파일마다 다시 저장하지 않음, Image.get_annotation)
+    # 파일의 이미지 수(포함/제외/오류/분류완료)는 UPDATE된 행 수로 갱신
+    type_dict = {}
+    annotation_dict = {}
+    for uri, data_dict, error in result_list:
+        type, error = classify_filter_result(data_dict, error, excluded_locales)
+        locale, text_length, languages = summarize_filter_result(data_dict)
+        type_dict.setdefault(type, []).append((uri, error, locale, text_length, languages))
+        if annotate and data_dict is not None:
+            uri_hash = ocr_cache.get_uri_hash(uri)
+            annotation_dict[uri_hash] = ImageAnnotation(file_id=file_id, uri_hash=uri_hash, uri=uri,
+                                                        data=ImageAnnotation.compress_data(data_dict))
+
+    filter_dt = timezone.now()
+    with transaction.atomic():
+        num_updated = {}
+        for type, type_result_list in type_dict.items():
+            error_when, locale_when, length_when, languages_when = [], [], [], []
+            for uri, error, locale, text_length, languages in type_result_list:
+                error_when.append(When(uri=uri, then=Value(error)))
+                locale_when.append(When(uri=uri, then=Value(locale)))
+                length_when.append(When(uri=uri, then=Value(text_length)))
+                languages_when.append(When(uri=uri, then=Value(languages, output_field=JSONField())))
+            num_updated[type] = Image.objects.filter(
+                Q(file_id=file_id) & uri_filter([result[0] for result in type_result_list]) & Q(type__in=[0, 2])). \
+                update(type=type,
+                       error=Case(*error_when, default=F('error'), output_field=TextField()),
+                       locale=Case(*locale_when, default=F('locale'), output_field=CharField()),
+                       text_length=Case(*length_when, default=F('text_length'), output_field=IntegerField()),
+                       languages=Case(*languages_when, default=F('languages'), output_field=JSONField()),
+                       filter_dt=filter_dt)
+        ImageAnnotation.objects.bulk_create(annotation_dict.values(), ignore_conflicts=True)
+        file = File.objects.select_for_update().get(id=file_id)
+        file.num_error += num_updated.get(1, 0)
+        file.num_exclude += num_updated.get(3, 0)
+        file.num_include += num_updated.get(4, 0)
+        file.num_processed += sum(num_updated.values())
+        if file.status == 4 and file.num_processed >= (file.num_image or 0):
+            file.status = 5
+        file.save(update_fields=['num_error', 'num_exclude', 'num_include', 'num_processed', 'status'])
+    # 여러 batch task가 동시에 저장하므로 잠금 안에서 읽은 누적값을 그대로 기록
+    progress.set_progress(file_id, 'filter', file.num_processed, file.num_image)
+    for type, count in num_updated.items():
+        metrics.inc('imagefilter_classified_total', count, type=type)
+
 
 def excel_to_dict(path, full=False, dict=True):
     if full:
@@ -165,106 +477,215 @@ def excel_to_dict(path, full=False, dict=True):
 
 
 def product_to_image(product):
-    from bs4 import BeautifulSoup as bs
     from imagefilter.models import Image
-    try:
-        soup = bs(product['original_description'], 'html.parser')
-        image_soup_list = soup.find_all('img')
-    except Exception as e:
-        # TODO product_id : n 의 이미지 추출 실패 로깅
-        raise exceptions.ExtractImageException('이미지 추출 실패')
-    else:
-        Image.objects.bulk_create([Image(product_id=product['id'], uri=soup.attrs['src']) for soup in image_soup_list])
+    Image.objects.bulk_create([Image(product_id=product['id'], file_id=product.get('file_id'), uri=uri,
+                                     uri_hash=ocr_cache.get_uri_hash(uri))
+                               for uri in extract_image_uri(product['original_description'])])
 
 
 @app.task
 def generate_single_product_description(product_id):
     product = Product.objects.get(id=product_id)
-    original = bs(product.original_description, 'html.parser')
-    image_list = Image.objects.values('uri').filter(Q(product=product) & Q(type=3))
-    if image_list.exists():
-        product.change = True
+    uri_set = set(Image.objects.values_list('uri', flat=True).filter(Q(product=product) & Q(type=3)))
+    if uri_set:
+        product.status = 1
+        product.filtered_description = remove_image(product.original_description, uri_set)
     else:
-        product.change = False
-    for image in image_list:
-        element = original.find('img', attrs={'src': image['uri']})
-        if element:
-            element.decompose()
-    product.filtered_description = str(original)
+        product.status = 2
+        product.filtered_description = product.original_description
     product.save()
 
 
+SHOPLINKER_COLUMN_TYPE = {'샵링커상품코드': str, '고객사상품코드': str, '상품명': str, '약어': str,
+                          '샵링커카테고리코드': str, '모델명': str, '모델No': str, '쇼핑몰시작가': np.int32, '쇼핑몰공급가': np.int32,
+                          '쇼핑몰판매가': np.int32, '쇼핑몰시중가': np.int32, '수량': np.int32, '과세': str, '매입처ID': str,
+                          '제조사': str,
+                          '원산지': str, '판매지역': str, '남여구분': str, '판매상태': str, '옵션명1': str, '옵션항목1': str,
+                          '옵션명2': str, '옵션항목2': str, '옵션명3': str, '옵션항목3': str, '상품대표이미지': str,
+                          '배송비형태': str, '배송비': str, '상품요약설명': str, '상품상세설명': str, '신 상세설명': str,
+                          '추가구성 상세': str, '광고홍보 상세설명': str, '브랜드': str, '고객사대분류코드': str,
+                          '고객사중분류코드': str, '고객사소분류코드': str, '고객사세분류코드': str, '매입처공급가': int,
+                          '매입처판매가': int, '매입처시중가': int, '옥션&지마켓용 이미지': str, '쿠팡 외 이미지': str,
+                          '11번가용 이미지': str, '종합몰용이미지': str, '카운터 사용여부': str, '배송정보': str, 'A/S정보': str,
+                          '부가이미지6': str,
+                          '부가이미지7': str, '부가이미지8': str, '부가이미지9': str, '부가이미지10': str, '부가이미지11': str,
+                          '부가이미지12': str,
+                          '옥션&지마켓 추가이미지1': str, '옥션&지마켓 추가이미지2': str, '위메프(460*460, 500*500)': str,
+                          '위메프(580*320)': str,
+                          '발행일/제조일': str, 'W컨셉용이미지': str, '인증번호': str, '롯데홈(사용안함)': str,
+                          '롯데홈(사용안함).1': str,
+                          '롯데홈(사용안함).2': str, '유효기간': None, '성인상품여부': str, '반품지주소': str, '반품지우편번호': str,
+                          '출하지주소': str,
+                          '출하지우편번호': str, '옥션 이미지 삭제': str, '지마켓 이미지 삭제': str, '11번가 이미지 삭제': str,
+                          '종합몰 이미지 삭제': str,
+                          '품목고시 코드': str, '품목 값1': str, '품목 값2': str, '품목 값3': str, '품목 값4': str,
+                          '품목 값5': str, '품목 값6': str,
+                          '품목 값7': str, '품목 값8': str, '품목 값9': str, '품목 값10': str, '품목 값11': str,
+                          '품목 값12': str,
+                          '품목 값13': str, '품목 값14': str, '품목 값15': str, '인증항목 코드1': str, '기관명1': str,
+                          '인증번호(심의번호)1': str,
+                          '신고번호1': str, '인증발급일자1': None, '유효시작일자1': None, '유효종료일자1': None, '인증정보이미지1': str,
+                          '인증항목 코드2': str,
+                          '기관명2': str, '인증번호(심의번호)2': str, '신고번호2': str, '인증발급일자2': None, '유효시작일자2': None,
+                          '유효종료일자2': None,
+                          '인증정보이미지2': str, '인증항목 코드3': str, '기관명3': str, '인증번호(심의번호)3': str, '신고번호3': str,
+                          '인증발급일자3': None,
+                          '유효시작일자3': None, '유효종료일자3': None, '인증정보이미지3': str, '인증항목 코드4': str, '기관명4': str,
+                          '인증번호(심의번호)4': str,
+                          '신고번호4': str, '인증발급일자4': None, '유효시작일자4': None, '유효종료일자4': None, '인증정보이미지4': str,
+                          '인증항목 코드5': str,
+                          '기관명5': str, '인증번호(심의번호)5': str, '신고번호5': str, '인증발급일자5': None, '유효시작일자5': None,
+                          '유효종료일자5': None,
+                          '인증정보이미지5': str, '하프클럽 가로배너\nGS/이지웰 모바일 이미지\nB쇼핑 MC이미지': str, '품질표시 TAG': str,
+                          '무게': str}
+
+
+def normalize_product_code(code):
+    code = str(code).strip()
+    if code.endswith('.0'):
+        code = code[:-2]
+    return code
+
+
+def write_filtered_file(file, product_filter=Q(status=1), base_path=None):
+    # product_filter 에 해당하는 상품의 상세설명만 base_path(기본은 원본) 엑셀에 반영해서 _filtered.xls 파일을 만든다.
+    product_list = Product.objects.values_list('product_code', 'filtered_description').filter(
+        Q(file_id=file.id) & product_filter)
+    description_dict = {normalize_product_code(code): description for code, description in product_list.iterator()}
+    base_path = base_path or file.original.path
+    new_file_name = os.path.splitext(file.original.path)[0] + '_filtered.xls'
+    # 이전 결과 파일을 읽으면서 덮어쓰지 않도록 임시 파일에 쓰고 교체
+    temp_file_name = os.path.splitext(file.original.path)[0] + '_filtered.tmp.xls'
+    if settings.IMAGEFILTER_STREAMING_GENERATE:
+        write_filtered_excel_streaming(base_path, temp_file_name, description_dict)
+    else:
+        write_filtered_excel(base_path, temp_file_name, description_dict)
+    os.replace(temp_file_name, new_file_name)
+    return new_file_name
+
+
+def write_filtered_excel(path, new_file_name, description_dict):
+    data_list = pd.read_excel(path, dtype=SHOPLINKER_COLUMN_TYPE)
+    # 상품코드 기준으로 한번에 매핑 (상품마다 전체 컬럼을 비교하지 않음)
+    new_description = data_list['고객사상품코드'].map(normalize_product_code).map(description_dict)
+    changed = new_description.notna()
+    data_list.loc[changed, '상품상세설명'] = new_description[changed]
+    data_list.to_excel(new_file_name, index=False, columns=list(SHOPLINKER_COLUMN_TYPE.keys()))
+
+
+def write_filtered_excel_streaming(path, new_file_name, description_dict):
+    # 원본을 한 행씩 읽어서 상세설명 셀만 바꿔 그대로 쓴다. (컬럼 구성/순서는 원본 유지)
+    rows = iter_sheet_rows(path)
+    try:
+        header = list(next(rows))
+        code_idx = header.index('고객사상품코드')
+        description_idx = header.index('상품상세설명')
+    except (StopIteration, ValueError):
+        raise exceptions.ExcelFormatException('파일에서 [고객사상품코드, 상품상세설명] 항목을 확인하세요.')
+
+    def patch_row(row):
+        row = [normalize_cell(value) for value in row]
+        if len(row) > code_idx and row[code_idx] is not None:
+            code = normalize_product_code(row[code_idx])
+            if code in description_dict:
+                row += [None] * (description_idx + 1 - len(row))
+                row[description_idx] = description_dict[code]
+        return row
+
+    write_xls(new_file_name, header, (patch_row(row) for row in rows))
+
+
 @app.task
 def generate_product_description(file_id):
+    # 상품 구간별 task가 모두 끝나면 generate_product_description_callback 에서 바로 파일을 만든다. (polling 없음)
+    metrics.start_stage(file_id, 'generate')
     file = File.objects.get(id=file_id)
-    product_list = Product.objects.values('id').filter(file_id=file_id)
-    product_result = []
-    for product in product_list:
-        result = generate_single_product_description.delay(product_id=product['id'])
-        product_result.append(result)
-
-    is_finish = False
-
-    while is_finish is False:
-        product_result = [p for p in product_result if p.state not in ['FAILURE', 'SUCCESS']]
-        if len(product_result) == 0:
-            type_dict = {'샵링커상품코드': np.str, '고객사상품코드': np.str, '상품명': np.str, '약어': np.str,
-                         '샵링커카테고리코드': np.str, '모델명': np.str, '모델No': np.str, '쇼핑몰시작가': np.int32, '쇼핑몰공급가': np.int32,
-                         '쇼핑몰판매가': np.int32, '쇼핑몰시중가': np.int32, '수량': np.int32, '과세': np.str, '매입처ID': np.str,
-                         '제조사': np.str,
-                         '원산지': np.str, '판매지역': np.str, '남여구분': np.str, '판매상태': np.str, '옵션명1': np.str, '옵션항목1': np.str,
-                         '옵션명2': np.str, '옵션항목2': np.str, '옵션명3': np.str, '옵션항목3': np.str, '상품대표이미지': np.str,
-                         '배송비형태': np.str, '배송비': np.str, '상품요약설명': np.str, '상품상세설명': np.str, '신 상세설명': np.str,
-                         '추가구성 상세': np.str, '광고홍보 상세설명': np.str, '브랜드': np.str, '고객사대분류코드': np.str,
-                         '고객사중분류코드': np.str, '고객사소분류코드': np.str, '고객사세분류코드': np.str, '매입처공급가': np.int,
-                         '매입처판매가': np.int, '매입처시중가': np.int, '옥션&지마켓용 이미지': np.str, '쿠팡 외 이미지': np.str,
-                         '11번가용 이미지': np.str, '종합몰용이미지': np.str, '카운터 사용여부': np.str, '배송정보': np.str, 'A/S정보': np.str,
-                         '부가이미지6': np.str,
-                         '부가이미지7': np.str, '부가이미지8': np.str, '부가이미지9': np.str, '부가이미지10': np.str, '부가이미지11': np.str,
-                         '부가이미지12': np.str,
-                         '옥션&지마켓 추가이미지1': np.str, '옥션&지마켓 추가이미지2': np.str, '위메프(460*460, 500*500)': np.str,
-                         '위메프(580*320)': np.str,
-                         '발행일/제조일': np.str, 'W컨셉용이미지': np.str, '인증번호': np.str, '롯데홈(사용안함)': np.str,
-                         '롯데홈(사용안함).1': np.str,
-                         '롯데홈(사용안함).2': np.str, '유효기간': None, '성인상품여부': np.str, '반품지주소': np.str, '반품지우편번호': np.str,
-                         '출하지주소': np.str,
-                         '출하지우편번호': np.str, '옥션 이미지 삭제': np.str, '지마켓 이미지 삭제': np.str, '11번가 이미지 삭제': np.str,
-                         '종합몰 이미지 삭제': np.str,
-                         '품목고시 코드': np.str, '품목 값1': np.str, '품목 값2': np.str, '품목 값3': np.str, '품목 값4': np.str,
-                         '품목 값5': np.str, '품목 값6': np.str,
-                         '품목 값7': np.str, '품목 값8': np.str, '품목 값9': np.str, '품목 값10': np.str, '품목 값11': np.str,
-                         '품목 값12': np.str,
-                         '품목 값13': np.str, '품목 값14': np.str, '품목 값15': np.str, '인증항목 코드1': np.str, '기관명1': np.str,
-                         '인증번호(심의번호)1': np.str,
-                         '신고번호1': np.str, '인증발급일자1': None, '유효시작일자1': None, '유효종료일자1': None, '인증정보이미지1': np.str,
-                         '인증항목 코드2': np.str,
-                         '기관명2': np.str, '인증번호(심의번호)2': np.str, '신고번호2': np.str, '인증발급일자2': None, '유효시작일자2': None,
-                         '유효종료일자2': None,
-                         '인증정보이미지2': np.str, '인증항목 코드3': np.str, '기관명3': np.str, '인증번호(심의번호)3': np.str, '신고번호3': np.str,
-                         '인증발급일자3': None,
-                         '유효시작일자3': None, '유효종료일자3': None, '인증정보이미지3': np.str, '인증항목 코드4': np.str, '기관명4': np.str,
-                         '인증번호(심의번호)4': np.str,
-                         '신고번호4': np.str, '인증발급일자4': None, '유효시작일자4': None, '유효종료일자4': None, '인증정보이미지4': np.str,
-                         '인증항목 코드5': np.str,
-                         '기관명5': np.str, '인증번호(심의번호)5': np.str, '신고번호5': np.str, '인증발급일자5': None, '유효시작일자5': None,
-                         '유효종료일자5': None,
-                         '인증정보이미지5': np.str, '하프클럽 가로배너\nGS/이지웰 모바일 이미지\nB쇼핑 MC이미지': np.str, '품질표시 TAG': np.str,
-                         '무게': np.str}
-            data_list = pd.read_excel(file.original.path, dtype=type_dict)
-            # data_list = excel_to_dict(file.original.path, full=True, dict=False)
-            new_product_list = Product.objects.values('product_code', 'filtered_description').filter(
-                Q(file_id=file_id) & Q(change=True))
-            for new_product in new_product_list:
-                data_list.loc[data_list['고객사상품코드'] == int(new_product['product_code']), '상품상세설명'] = new_product[
-                    'filtered_description']
-            new_file_name = file.original.path.split('.xlsx')[0] + '_filtered.xls'
-            data_list.to_excel(new_file_name, index=False, columns=list(type_dict.keys()))
-
-            # 파일 정리
-            file.filtered = new_file_name.split('/media/')[1]
-            file.status = 7
-            file.save()
-            is_finish = True
+    progress.start_progress(file_id, 'generate', file.num_product)
+    queue = get_file_queue(file, 'generate')
+    range_list = split_product_range(file_id, settings.IMAGEFILTER_GENERATE_CHUNK_SIZE)
+    if not range_list:
+        generate_product_description_callback.apply_async(([], file_id), queue=queue)
+        return
+    chord([generate_product_description_range.s(file_id, start_id, end_id).set(queue=queue)
+           for start_id, end_id in range_list])(generate_product_description_callback.s(file_id).set(queue=queue))
+
+
+@app.task(ignore_result=False)
+def generate_product_description_range(file_id, start_id, end_id):
+    try:
+        num_product = render_product_description(Q(file_id=file_id) & Q(id__gte=start_id) & Q(id__lt=end_id))
+    except Exception as e:
+        # 실패한 구간은 파일에 기록하고, callback 에서 파일 생성 오류로 처리
+        logger.exception('file %s : 상품 %s ~ %s 상세설명 생성 실패', file_id, start_id, end_id)
+        File.objects.filter(id=file_id).update(
+            error_message='상품 {} ~ {} 상세설명 생성 실패 : {}'.format(start_id, end_id - 1, e))
+        return False
+    progress.add_progress(file_id, num_product)
+    return True
+
+
+def render_product_description(product_filter):
+    # 상품과 제외 이미지를 각각 한번에 조회하고, 결과는 bulk_update로 저장
+    excluded_dict = {}
+    excluded_list = Image.objects.values_list('product_id', 'uri').filter(
+        Q(product__in=Product.objects.filter(product_filter).values('id')) & Q(type=3)).order_by()
+    for product_id, uri in excluded_list:
+        excluded_dict.setdefault(product_id, set()).add(uri)
+
+    product_list = []
+    for product_id, description in Product.objects.values_list('id', 'original_description').filter(
+            product_filter).order_by():
+        if product_id in excluded_dict:
+            product_list.append(Product(id=product_id, status=1, dirty=False,
+                                        filtered_description=remove_image(description, excluded_dict[product_id])))
         else:
-            time.sleep(5)
-            continue
+            product_list.append(Product(id=product_id, status=2, dirty=False, filtered_description=description))
+    Product.objects.bulk_update(product_list, ['status', 'filtered_description', 'dirty'],
+                                batch_size=settings.IMAGEFILTER_GENERATE_CHUNK_SIZE)
+    return len(product_list)
+
+
+@app.task
+def generate_product_description_callback(results, file_id):
+    file = File.objects.get(id=file_id)
+    if not all(results):
+        file.status = 8
+        file.save()
+        return
+    try:
+        new_file_name = write_filtered_file(file)
+    except Exception as e:
+        file.status = 8
+        file.error_message = '파일 생성 실패 : {}'.format(e)
+        file.save()
+        raise
+    # 파일 정리
+    file.filtered = new_file_name.split('/media/')[1]
+    file.status = 7
+    file.error_message = None
+    file.save()
+    metrics.finish_stage(file_id, 'generate', file.num_product)
+
+
+@app.task
+def generate_product_description_incremental(file_id):
+    # 이미지 분류가 바뀐 상품(dirty)만 다시 만들고, 이전 결과 파일에서 해당 셀만 교체
+    file = File.objects.get(id=file_id)
+    metrics.start_stage(file_id, 'generate')
+    try:
+        product_id_list = list(Product.objects.values_list('id', flat=True).filter(Q(file_id=file_id) & Q(dirty=True)))
+        progress.start_progress(file_id, 'generate', len(product_id_list))
+        for product_id_chunk in chunker(product_id_list, settings.IMAGEFILTER_GENERATE_CHUNK_SIZE):
+            progress.add_progress(file_id,
+                                  render_product_description(Q(file_id=file_id) & Q(id__in=product_id_chunk)))
+        new_file_name = write_filtered_file(file, product_filter=Q(id__in=product_id_list), base_path=file.filtered.path)
+    except Exception as e:
+        file.status = 8
+        file.error_message = '변경분 반영 실패 : {}'.format(e)
+        file.save()
+        raise
+    file.filtered = new_file_name.split('/media/')[1]
+    file.status = 7
+    file.error_message = None
+    file.save()
+    metrics.finish_stage(file_id, 'generate', len(product_id_list))
@@ -1,3 +1,703 @@
-from django.test import TestCase
+import hashlib
+import os
+import shutil
+import tempfile
+from datetime import datetime, timedelta
+from io import BytesIO
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+import openpyxl
+import redis
+import xlrd
+from PIL import Image as PILImage
+from django.contrib.auth import get_user_model
+from django.db.models import Q
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from account.models import Company
+from imagefilter.actions import resume_filter_image_async
+from imagefilter.exceptions import ExcelFormatException
+from imagefilter.models import File, FileUpload, Image, ImageAnnotation, OcrCache, Product
+from imagefilter.tasks import claim_image_uri, extract_image_range, filter_image, filter_image_batch, \
+    filter_image_claim, generate_product_description_callback, generate_product_description_incremental, \
+    release_image_uri, render_product_description, save_filter_result, write_filtered_excel_streaming
+from imagefilter.utils import fetch, ocr, ocr_cache, rate_limit
+from imagefilter.utils.classify import classify_filter_result, summarize_filter_result
+from imagefilter.utils.extract_image import extract_image_uri, remove_image
+from imagefilter.utils.ocr import OcrBackend
+from imagefilter.utils.read_xlsx import iter_product_rows, probe_schema, read_sheet_head
+from imagefilter.views import parse_image_cursor
+
+User = get_user_model()
+
+HEADER = ['고객사상품코드', '상품명', '쇼핑몰판매가', '상품상세설명']
+
+
+class WorkbookTestMixin(object):
+    def setUp(self):
+        super().setUp()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+
+    def create_workbook(self, row_list, name='test.xlsx'):
+        path = os.path.join(self.tmp_dir, name)
+        workbook = openpyxl.Workbook()
+        sheet = workbook.active
+        for row in row_list:
+            sheet.append(row)
+        workbook.save(path)
+        return path
+
+
+class ProbeSchemaTest(WorkbookTestMixin, TestCase):
+    def test_valid(self):
+        path = self.create_workbook([HEADER, ['A1', '상품1', 1000, '<img src="a.jpg">'], [2, '상품2', 2000, None]])
+        self.assertEqual(probe_schema(path, num_row=10), HEADER)
+
+    def test_header_with_space(self):
+        path = self.create_workbook([['고객사상품코드', '상품 명', '상품상세설명'], ['A1', '상품1', '']])
+        with self.assertRaises(ExcelFormatException) as context:
+            probe_schema(path, num_row=10)
+        self.assertEqual(list(context.exception.error_dict), ['상품명'])
+        self.assertIn('공백', context.exception.error_dict['상품명'])
+        self.assertIn('B열', context.exception.error_dict['상품명'])
+
+    def test_missing_header(self):
+        path = self.create_workbook([['고객사상품코드', '상품명', '상세설명'], ['A1', '상품1', '']])
+        with self.assertRaises(ExcelFormatException) as context:
+            probe_schema(path, num_row=10)
+        self.assertEqual(context.exception.error_dict, {'상품상세설명': "항목이 없습니다. 비슷한 항목 : '상세설명' (C열)"})
+
+        path = self.create_workbook([['고객사상품코드', '상품명', '가격'], ['A1', '상품1', 0]], name='other.xlsx')
+        with self.assertRaises(ExcelFormatException) as context:
+            probe_schema(path, num_row=10)
+        self.assertTrue(context.exception.error_dict['상품상세설명'].startswith('항목이 없습니다.'))
+
+    def test_empty_and_duplicate_value(self):
+        path = self.create_workbook([HEADER, ['A1', '상품1', 0, ''], ['A1', None, 0, ''], ['A2', '상품3', 0, '']])
+        with self.assertRaises(ExcelFormatException) as context:
+            probe_schema(path, num_row=10)
+        error_dict = context.exception.error_dict
+        self.assertEqual(error_dict['고객사상품코드'], 'A열 중복된 값이 있습니다. (2, 3행)')
+        self.assertEqual(error_dict['상품명'], 'B열 값이 없습니다. (3행)')
+
+    def test_no_product(self):
+        path = self.create_workbook([HEADER, [None, None, None, None]])
+        with self.assertRaisesMessage(ExcelFormatException, '상품이 없습니다.'):
+            probe_schema(path, num_row=10)
+
+    def test_read_sheet_head_matches_openpyxl(self):
+        row_list = [HEADER, ['A1', '상품1', 1000, '<p>설명</p>'], [], [123, '상품2', 1.5, True], ['A3', '상품1', None, 'x']]
+        path = self.create_workbook(row_list)
+        head = read_sheet_head(path, 10)
+        self.assertEqual(head[0], HEADER)
+        # 빈 행은 건너뛰고 실제 행 번호를 유지
+        self.assertEqual([row_no for row_no, _ in head[1:]], [2, 4, 5])
+        sheet = openpyxl.load_workbook(path, read_only=True).worksheets[0]
+        expected = [list(row) for row in sheet.iter_rows(values_only=True)]
+        for row_no, row in head[1:]:
+            self.assertEqual(row + [None] * (len(HEADER) - len(row)), expected[row_no - 1])
+
+
+class IterProductRowsTest(WorkbookTestMixin, TestCase):
+    def test_rows(self):
+        path = self.create_workbook([HEADER, ['A1', '상품1', 0, '<img src="a.jpg">'], [None, None, None, None],
+                                     [1234.0, '상품2', 0, None]])
+        self.assertEqual(list(iter_product_rows(path)), [
+            {'product_code': 'A1', 'name': '상품1', 'original_description': '<img src="a.jpg">'},
+            {'product_code': 1234, 'name': '상품2', 'original_description': None}])
+
+    def test_row_error(self):
+        path = self.create_workbook([HEADER, ['A1', '상품1', 0, ''], ['A2', '', 0, '']])
+        rows = iter_product_rows(path)
+        self.assertEqual(next(rows)['product_code'], 'A1')
+        with self.assertRaisesMessage(ExcelFormatException, '[상품명] B열 3행 값이 없습니다.'):
+            next(rows)
+
+    def test_duplicate_code(self):
+        path = self.create_workbook([HEADER, ['A1', '상품1', 0, ''], ['A1', '상품2', 0, '']])
+        with self.assertRaisesMessage(ExcelFormatException, '3행 상품코드가 2행과 중복됩니다.'):
+            list(iter_product_rows(path))
+
+
+class ExtractImageTest(TestCase):
+    def test_extract_image_uri(self):
+        description = '<div><img src="a.jpg"><p><img src="b.jpg"><img alt="x"></p><img src="a.jpg"></div>'
+        self.assertEqual(extract_image_uri(description), ['a.jpg', 'b.jpg', 'a.jpg'])
+        self.assertEqual(extract_image_uri(None), [])
+        self.assertEqual(extract_image_uri(''), [])
+        self.assertEqual(extract_image_uri('텍스트만 있는 설명'), [])
+
+    def test_remove_image(self):
+        description = '<div><img src="a.jpg"/><p>설명</p><img src="b.jpg"/><img src="a.jpg"/></div>'
+        self.assertEqual(remove_image(description, {'a.jpg'}), '<div><p>설명</p><img src="b.jpg"/></div>')
+        self.assertEqual(remove_image(description, set()), description)
+
+
+class ClassifyFilterResultTest(TestCase):
+    def test_text(self):
+        data_dict = {'textAnnotations': [{'locale': 'zh', 'description': '中文'}]}
+        self.assertEqual(classify_filter_result(data_dict, None, 'zh'), (3, None))
+        self.assertEqual(classify_filter_result(data_dict, None, ['ko']), (4, None))
+
+    def test_no_text(self):
+        self.assertEqual(classify_filter_result({}, None, 'zh'), (4, None))
+        self.assertEqual(classify_filter_result({'prefilter': 'blank'}, None, 'zh'), (4, None))
+
+    def test_error(self):
+        self.assertEqual(classify_filter_result(None, 'timeout', 'zh'), (1, 'timeout'))
+        self.assertEqual(classify_filter_result({'error': {'code': 3, 'message': 'bad image'}}, None, 'zh'),
+                         (1, 'bad image'))
+        self.assertEqual(classify_filter_result({'unknown': 1}, None, 'zh'), (1, '관리자 문의'))
+
+
+class FileTestMixin(object):
+    def setUp(self):
+        super().setUp()
+        company = Company.objects.create(company_name='test', contact='-', is_approved=True)
+        self.user = User.objects.create_user('test@rawlabs.io', 'test')
+        self.user.company = company
+        self.user.save()
+        self.file = File.objects.create(title='test', user=self.user, original='test.xlsx')
+
+
+class SaveFilterResultTest(FileTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        product = Product.objects.create(file=self.file, product_code='A1', name='상품1', status=0)
+        # 같은 uri 의 이미지는 결과 하나로 함께 분류
+        for uri in ['zh.jpg', 'zh.jpg', 'ko.jpg', 'blank.jpg', 'error.jpg']:
+            Image.objects.create(product=product, file=self.file, uri=uri, type=2)
+        File.objects.filter(id=self.file.id).update(status=4, num_image=5)
+
+    def test_counter(self):
+        save_filter_result(self.file.id, [
+            ('zh.jpg', {'textAnnotations': [{'locale': 'zh', 'description': '中文'}]}, None),
+            ('ko.jpg', {'textAnnotations': [{'locale': 'ko', 'description': '한글'}]}, None),
+        ], 'zh')
+        self.file.refresh_from_db()
+        self.assertEqual((self.file.num_exclude, self.file.num_include, self.file.num_error), (2, 1, 0))
+        self.assertEqual((self.file.num_processed, self.file.status), (3, 4))
+
+        save_filter_result(self.file.id, [('blank.jpg', {}, None), ('error.jpg', None, 'timeout')], 'zh')
+        self.file.refresh_from_db()
+        self.assertEqual((self.file.num_exclude, self.file.num_include, self.file.num_error), (2, 2, 1))
+        self.assertEqual((self.file.num_processed, self.file.status), (5, 5))
+        self.assertEqual(Image.objects.get(uri='error.jpg').error, 'timeout')
+        self.assertEqual(ImageAnnotation.objects.filter(file=self.file).count(), 3)
+
+    def test_duplicate_result(self):
+        # 이미 분류된 이미지에 같은 결과가 다시 와도 (재시도 등) 수를 다시 더하지 않음
+        result_list = [('zh.jpg', {'textAnnotations': [{'locale': 'zh', 'description': '中文'}]}, None)]
+        save_filter_result(self.file.id, result_list, 'zh')
+        save_filter_result(self.file.id, result_list, 'zh')
+        self.file.refresh_from_db()
+        self.assertEqual((self.file.num_exclude, self.file.num_processed), (2, 2))
+        self.file.refresh_image_count()
+        self.assertEqual((self.file.num_exclude, self.file.num_processed), (2, 2))
+
+
+VISION_RESULT = {
+    'textAnnotations': [
+        {'locale': 'zh', 'description': '中文',
+         'boundingPoly': {'vertices': [{'x': 0, 'y': 0}, {'x': 10, 'y': 0}, {'x': 10, 'y': 10}]}},
+        {'description': '中文', 'boundingPoly': {'vertices': [{'x': 0, 'y': 0}, {'x': 10, 'y': 10}]}}],
+    'fullTextAnnotation': {'pages': [{'property': {'detectedLanguages': [{'languageCode': 'zh', 'confidence': 1}]},
+                                      'width': 100, 'height': 100, 'blocks': [{'blockType': 'TEXT'}]}],
+                           'text': '中文'},
+}
+
+
+class FakeOcrBackend(OcrBackend):
+    def __init__(self):
+        self.uri_list = []
+
+    def iter_text_detection(self, item_list):
+        for key, uri in item_list:
+            self.uri_list.append(uri)
+            yield key, VISION_RESULT, None
+
+    def iter_text_detection_content(self, item_list):
+        for key, content in item_list:
+            self.uri_list.append(key)
+            yield key, VISION_RESULT, None
+
+
+@override_settings(IMAGEFILTER_OCR_CACHE=True, IMAGEFILTER_OCR_CACHE_TTL=60 * 60, IMAGEFILTER_OCR_CACHE_MAX_ENTRIES=2)
+class OcrCacheTest(TestCase):
+    def test_compact_result(self):
+        ocr_cache.set_cached_result([('https://Example.com/a.jpg#top', VISION_RESULT, None)])
+        # http/https, host 대소문자, fragment 가 달라도 같은 캐시
+        data_dict = ocr_cache.get_cached_result(['http://example.com/a.jpg'])['http://example.com/a.jpg']
+        self.assertEqual(data_dict, {
+            'textAnnotations': [{'locale': 'zh', 'description': '中文'}],
+            'fullTextAnnotation': {'pages': [{'property': {'detectedLanguages': [
+                {'languageCode': 'zh', 'confidence': 1}]}}]}})
+        self.assertEqual(classify_filter_result(data_dict, None, 'zh'), classify_filter_result(VISION_RESULT, None, 'zh'))
+        self.assertEqual(summarize_filter_result(data_dict), summarize_filter_result(VISION_RESULT))
+        self.assertEqual(OcrCache.objects.get().num_hit, 1)
+
+    def test_error_not_cached(self):
+        ocr_cache.set_cached_result([('a.jpg', {'error': {'code': 3, 'message': 'bad image'}}, None),
+                                     ('b.jpg', {'unknown': 1}, None), ('c.jpg', None, None), ('d.jpg', {}, None)])
+        self.assertEqual(ocr_cache.get_cached_result(['a.jpg', 'b.jpg', 'c.jpg', 'd.jpg']), {'d.jpg': {}})
+
+    def test_ttl(self):
+        ocr_cache.set_cached_result([('a.jpg', VISION_RESULT, 'hash-a'), ('b.jpg', {}, None)])
+        OcrCache.objects.filter(uri='a.jpg').update(created_dt=timezone.now() - timedelta(hours=2))
+        self.assertEqual(list(ocr_cache.get_cached_result(['a.jpg', 'b.jpg'])), ['b.jpg'])
+        self.assertIsNone(ocr_cache.get_cached_result_by_content('hash-a'))
+        ocr_cache.prune_cache()
+        self.assertEqual(list(OcrCache.objects.values_list('uri', flat=True)), ['b.jpg'])
+
+    def test_prune_max_entries(self):
+        ocr_cache.set_cached_result([('{}.jpg'.format(no), {}, None) for no in range(4)])
+        for no in range(4):
+            OcrCache.objects.filter(uri='{}.jpg'.format(no)).update(last_hit_dt=timezone.now() - timedelta(minutes=no))
+        ocr_cache.prune_cache()
+        # 최근 사용한 IMAGEFILTER_OCR_CACHE_MAX_ENTRIES 개만 남김
+        self.assertEqual(sorted(OcrCache.objects.values_list('uri', flat=True)), ['0.jpg', '1.jpg'])
+
+
+@override_settings(IMAGEFILTER_OCR_CACHE=True, IMAGEFILTER_FETCH_INLINE=False, IMAGEFILTER_PREFILTER=False)
+class FilterImageCacheTest(FileTestMixin, TestCase):
+    def test_hit_and_miss(self):
+        product = Product.objects.create(file=self.file, product_code='A1', name='상품1', status=0)
+        for uri in ['cached.jpg', 'cached.jpg', 'new.jpg']:
+            Image.objects.create(product=product, file=self.file, uri=uri, type=2)
+        File.objects.filter(id=self.file.id).update(status=4, num_image=3)
+        ocr_cache.set_cached_result([('cached.jpg', VISION_RESULT, None)])
+
+        backend = FakeOcrBackend()
+        filter_image_batch(self.file.id, ['cached.jpg', 'new.jpg'], 'zh', backend)
+        self.assertEqual(backend.uri_list, ['new.jpg'])
+        self.file.refresh_from_db()
+        self.assertEqual((self.file.num_cache_hit, self.file.num_cache_miss), (1, 1))
+        self.assertEqual((self.file.num_exclude, self.file.num_processed, self.file.status), (3, 3, 5))
+        # 캐시 결과는 파일마다 다시 저장하지 않고, 새로 인식한 결과만 저장 (캐시에도 추가)
+        self.assertEqual(list(ImageAnnotation.objects.filter(file=self.file).values_list('uri', flat=True)),
+                         ['new.jpg'])
+        self.assertEqual(Image.objects.filter(uri='cached.jpg').first().get_annotation()['textAnnotations'],
+                         [{'locale': 'zh', 'description': '中文'}])
+        self.assertEqual(OcrCache.objects.count(), 2)
+
+
+class WriteFilteredExcelTest(WorkbookTestMixin, TestCase):
+    def read_xls(self, path):
+        workbook = xlrd.open_workbook(path)
+        sheet = workbook.sheet_by_index(0)
+        return workbook, [sheet.row(idx) for idx in range(sheet.nrows)]
+
+    def test_streaming(self):
+        header = HEADER + ['유효기간']
+        path = self.create_workbook([header,
+                                     ['A1', '상품1', 1000, '<img src="a.jpg"><img src="b.jpg">', datetime(2020, 1, 2)],
+                                     [1234, '상품2', 2000, '<img src="c.jpg">', None],
+                                     ['A3', '상품3', 3000, None, datetime(2021, 3, 4, 5, 6)]])
+        new_path = os.path.join(self.tmp_dir, 'test_filtered.xls')
+        write_filtered_excel_streaming(path, new_path, {'A1': '<img src="b.jpg">', '1234': ''})
+
+        workbook, row_list = self.read_xls(new_path)
+        self.assertEqual([cell.value for cell in row_list[0]], header)
+        self.assertEqual([cell.value for cell in row_list[1][:4]], ['A1', '상품1', 1000, '<img src="b.jpg">'])
+        # 숫자 상품코드도 같은 상품으로 찾고, 바뀌지 않은 셀은 원본 그대로
+        self.assertEqual([cell.value for cell in row_list[2][:4]], [1234, '상품2', 2000, ''])
+        self.assertEqual([cell.value for cell in row_list[3][:3]], ['A3', '상품3', 3000])
+        self.assertEqual(row_list[3][3].ctype, xlrd.XL_CELL_EMPTY)
+        # 날짜는 날짜 셀로 유지
+        self.assertEqual(row_list[1][4].ctype, xlrd.XL_CELL_DATE)
+        self.assertEqual(xlrd.xldate_as_datetime(row_list[1][4].value, workbook.datemode), datetime(2020, 1, 2))
+        self.assertEqual(xlrd.xldate_as_datetime(row_list[3][4].value, workbook.datemode), datetime(2021, 3, 4, 5, 6))
+
+    def test_missing_column(self):
+        path = self.create_workbook([['고객사상품코드', '상품명'], ['A1', '상품1']])
+        with self.assertRaises(ExcelFormatException):
+            write_filtered_excel_streaming(path, os.path.join(self.tmp_dir, 'test_filtered.xls'), {})
+
+
+class GenerateIncrementalTest(WorkbookTestMixin, FileTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        media_root = os.path.join(self.tmp_dir, 'media')
+        override = override_settings(MEDIA_ROOT=media_root)
+        override.enable()
+        self.addCleanup(override.disable)
+        os.makedirs(os.path.join(media_root, 'imagefilter'))
+        header = HEADER + ['유효기간']
+        workbook = openpyxl.Workbook()
+        for row in [header, ['A1', '상품1', 1000, '<img src="a.jpg"><img src="b.jpg">', datetime(2020, 1, 2)],
+                    [1234, '상품2', 2000, '<img src="c.jpg"><img src="d.jpg">', datetime(2021, 3, 4, 5, 6)]]:
+            workbook.active.append(row)
+        workbook.save(os.path.join(media_root, 'imagefilter', 'test.xlsx'))
+        File.objects.filter(id=self.file.id).update(original='imagefilter/test.xlsx')
+
+        for code, uri_list in [('A1', [('a.jpg', 3), ('b.jpg', 4)]), ('1234', [('c.jpg', 4), ('d.jpg', 4)])]:
+            product = Product.objects.create(file=self.file, product_code=code, name='상품', status=0,
+                                             original_description=''.join('<img src="{}"/>'.format(uri)
+                                                                          for uri, _ in uri_list))
+            for uri, type in uri_list:
+                Image.objects.create(product=product, file=self.file, uri=uri, type=type)
+        render_product_description(Q(file_id=self.file.id))
+        generate_product_description_callback([True], self.file.id)
+
+    def read_filtered(self):
+        self.file.refresh_from_db()
+        self.assertEqual(self.file.status, 7)
+        workbook = xlrd.open_workbook(self.file.filtered.path)
+        sheet = workbook.sheet_by_index(0)
+        self.assertEqual([sheet.cell_type(row_idx, 4) for row_idx in (1, 2)], [xlrd.XL_CELL_DATE] * 2)
+        self.assertEqual([xlrd.xldate_as_datetime(sheet.cell_value(row_idx, 4), workbook.datemode)
+                          for row_idx in (1, 2)], [datetime(2020, 1, 2), datetime(2021, 3, 4, 5, 6)])
+        return [sheet.cell_value(row_idx, 3) for row_idx in (1, 2)]
+
+    def test_incremental(self):
+        self.assertEqual(self.read_filtered(), ['<img src="b.jpg"/>', '<img src="c.jpg"><img src="d.jpg">'])
+
+        # 두번째 상품의 이미지만 제외로 변경
+        Image.objects.filter(uri='c.jpg').update(type=3)
+        Product.objects.filter(product_code='1234').update(dirty=True)
+        generate_product_description_incremental(self.file.id)
+        self.assertEqual(self.read_filtered(), ['<img src="b.jpg"/>', '<img src="d.jpg"/>'])
+        self.assertFalse(Product.objects.filter(dirty=True).exists())
+
+        # 이전 결과 파일을 다시 읽고 써도 날짜/다른 상품은 그대로
+        Product.objects.filter(product_code='A1').update(dirty=True)
+        generate_product_description_incremental(self.file.id)
+        self.assertEqual(self.read_filtered(), ['<img src="b.jpg"/>', '<img src="d.jpg"/>'])
+
+
+class ImageListCursorTest(FileTestMixin, TestCase):
+    def test_parse_image_cursor(self):
+        self.assertEqual(parse_image_cursor('12_345'), (12, 345))
+        for after in ['', '12', '12_', 'a_1', '1_2_3', '12-345']:
+            self.assertIsNone(parse_image_cursor(after))
+
+    def test_keyset_pagination(self):
+        image_id_list = []
+        for product_no in range(3):
+            product = Product.objects.create(file=self.file, product_code=str(product_no), name='상품', status=0)
+            for image_no in range(25):
+                image = Image.objects.create(product=product, file=self.file, uri='{}.jpg'.format(image_no))
+                image_id_list.append((product.id, image.id))
+        self.file.num_image = len(image_id_list)
+        self.file.save()
+        self.client.force_login(self.user)
+
+        url = '/dashboard/imagefilter/file/{}/image/'.format(self.file.id)
+        page_list = []
+        query = ''
+        while query is not None:
+            response = self.client.get('{}?{}'.format(url, query))
+            self.assertEqual(response.status_code, 200)
+            page_list.append([(row.record.product_id, row.record.id) for row in response.context['table'].rows])
+            query = response.context['next_query']
+        self.assertEqual([len(page) for page in page_list], [50, 25])
+        self.assertEqual([key for page in page_list for key in page], sorted(image_id_list, reverse=True))
+
+        # 잘못된 cursor 는 첫 페이지
+        response = self.client.get('{}?after=abc'.format(url))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([(row.record.product_id, row.record.id) for row in response.context['table'].rows],
+                         page_list[0])
+
+
+class ImageUriHashTest(FileTestMixin, TestCase):
+    def test_long_uri(self):
+        # btree 에 넣을 수 없는 긴 uri (data: uri) 도 등록/분류
+        uri = 'data:image/png;base64,' + 'A' * 10000
+        product = Product.objects.create(file=self.file, product_code='A1', name='상품1', status=0,
+                                         original_description='<img src="{}"><img src="a.jpg">'.format(uri))
+        self.assertTrue(extract_image_range(self.file.id, product.id, product.id + 1))
+        self.assertEqual(Image.objects.get(uri=uri).uri_hash, ocr_cache.get_uri_hash(uri))
+        File.objects.filter(id=self.file.id).update(status=4, num_image=2)
+
+        self.assertEqual(sorted(claim_image_uri(self.file.id, 10)), sorted([uri, 'a.jpg']))
+        save_filter_result(self.file.id, [(uri, {}, None), ('a.jpg', {}, None)], 'zh')
+        self.assertEqual(list(Image.objects.values_list('type', flat=True)), [4, 4])
+
+    def test_backfill(self):
+        product = Product.objects.create(file=self.file, product_code='A1', name='상품1', status=0)
+        for uri in ['a.jpg', 'b.jpg', 'a.jpg']:
+            Image.objects.create(product=product, file=self.file, uri=uri)
+        Image.objects.update(uri_hash=None)
+        self.assertEqual(self.file.backfill_image_uri_hash(), 3)
+        self.assertEqual(self.file.backfill_image_uri_hash(), 0)
+        for image in Image.objects.all():
+            self.assertEqual(image.uri_hash, ocr_cache.get_uri_hash(image.uri))
+
+
+class FetchImageTest(TestCase):
+    def test_local_uri(self):
+        # 업로드된 파일의 uri 로 worker 의 로컬 파일을 읽지 않음
+        for uri in ['file:///etc/hostname', 'FILE:///etc/hostname', 'ftp://example.com/a.jpg', 'data:image/png;base64,AA']:
+            image = fetch.ImageFetcher().fetch(uri)
+            self.assertIsNotNone(image.error)
+            self.assertIsNone(image.content)
+
+    def test_protocol_relative_uri(self):
+        # scheme 이 없는 uri 는 http 로 요청하고, 결과는 원래 uri 로 반환 (save_filter_result 가 uri 로 반영)
+        content = create_png(np.full((100, 100), 255))
+        response = mock.MagicMock()
+        response.__enter__.return_value = response
+        response.iter_content.return_value = iter([content])
+        fetcher = fetch.ImageFetcher()
+        with mock.patch.object(fetcher.session, 'get', return_value=response) as get:
+            image = fetcher.fetch('//img.example.com/a.png')
+        self.assertEqual(get.call_args[0][0], 'http://img.example.com/a.png')
+        self.assertIsNone(image.error)
+        self.assertEqual((image.uri, image.content, image.width), ('//img.example.com/a.png', content, 100))
+
+        with mock.patch.object(fetcher.session, 'get', side_effect=ConnectionError('timeout')):
+            image = fetcher.fetch('//img.example.com/b.png')
+        self.assertEqual((image.uri, image.error), ('//img.example.com/b.png', 'timeout'))
+
+
+def create_png(pixel):
+    output = BytesIO()
+    PILImage.fromarray(pixel.astype(np.uint8)).save(output, format='PNG')
+    return output.getvalue()
+
+
+class FakeFetcher(object):
+    def __init__(self, image_dict):
+        self.image_dict = image_dict
+
+    def iter_fetch(self, uri_list):
+        for uri in uri_list:
+            yield self.image_dict[uri]
+
+
+@override_settings(IMAGEFILTER_OCR_CACHE=False, IMAGEFILTER_FETCH_INLINE=True, IMAGEFILTER_PREFILTER=True,
+                   IMAGEFILTER_FETCH_MIN_SIZE=32)
+class FilterImageContentTest(FileTestMixin, TestCase):
+    def test_prefilter_count(self):
+        text = create_png(np.random.RandomState(0).randint(0, 256, (100, 100)))
+        image_dict = {
+            'tiny.png': fetch.FetchedImage('tiny.png', format='PNG', width=10, height=10),
+            'blank.png': fetch.FetchedImage('blank.png', content=create_png(np.full((100, 100), 255)), format='PNG',
+                                            width=100, height=100),
+            'text.png': fetch.FetchedImage('text.png', content=text, format='PNG', width=100, height=100),
+            'error.png': fetch.FetchedImage('error.png', error='timeout'),
+        }
+        product = Product.objects.create(file=self.file, product_code='A1', name='상품1', status=0)
+        for uri in image_dict:
+            Image.objects.create(product=product, file=self.file, uri=uri, type=2)
+        File.objects.filter(id=self.file.id).update(status=4, num_image=len(image_dict))
+
+        backend = FakeOcrBackend()
+        with mock.patch.object(fetch, 'get_fetcher', return_value=FakeFetcher(image_dict)):
+            filter_image_batch(self.file.id, list(image_dict), 'zh', backend)
+        # 받지 못한 이미지는 uri 로 다시 요청
+        self.assertEqual(backend.uri_list, [image_dict['text.png'].content_hash, 'error.png'])
+        self.file.refresh_from_db()
+        # 작은 이미지도 사전 분류 이미지 수에 포함
+        self.assertEqual((self.file.num_prefilter, self.file.num_prefilter_skip), (3, 2))
+        self.assertEqual(self.file.prefilter_skip_rate(), 66.7)
+        self.assertEqual(dict(Image.objects.values_list('uri', 'type')),
+                         {'tiny.png': 4, 'blank.png': 4, 'text.png': 3, 'error.png': 3})
+        self.assertEqual(self.file.status, 5)
+
+
+class ClaimImageTest(FileTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        product = Product.objects.create(file=self.file, product_code='A1', name='상품1', status=0)
+        for uri in ['a.jpg', 'b.jpg', 'a.jpg', 'c.jpg', 'd.jpg']:
+            Image.objects.create(product=product, file=self.file, uri=uri)
+        File.objects.filter(id=self.file.id).update(status=4, num_image=5)
+
+    def test_claim(self):
+        # 같은 uri 의 이미지는 함께 가져가고, 가져간 이미지는 다시 가져가지 않음
+        claimed = []
+        uri_list = claim_image_uri(self.file.id, 2)
+        while uri_list:
+            self.assertFalse(set(uri_list) & set(claimed))
+            claimed.extend(uri_list)
+            uri_list = claim_image_uri(self.file.id, 2)
+        self.assertEqual(sorted(claimed), ['a.jpg', 'b.jpg', 'c.jpg', 'd.jpg'])
+        self.assertFalse(Image.objects.filter(Q(type=2) & Q(claim_dt__isnull=True)).exists())
+        self.assertEqual(Image.objects.filter(type=2).count(), 5)
+
+        release_image_uri(self.file.id, ['a.jpg'])
+        self.assertEqual(sorted(Image.objects.filter(type=0).values_list('uri', flat=True)), ['a.jpg', 'a.jpg'])
+        self.assertEqual(claim_image_uri(self.file.id, 10), ['a.jpg'])
+
+    @override_settings(IMAGEFILTER_FILTER_STALE_TIMEOUT=60)
+    def test_resume(self):
+        old_dt = timezone.now() - timedelta(minutes=5)
+        Image.objects.filter(uri='a.jpg').update(type=2, claim_dt=old_dt)
+        save_filter_result(self.file.id, [('a.jpg', {}, None)], 'zh')
+        # 종료된 worker 가 잡고 있던 batch, 최근에 가져간 batch, claim_dt 컬럼 추가 전에 가져간 batch
+        Image.objects.filter(uri='b.jpg').update(type=2, claim_dt=old_dt)
+        Image.objects.filter(uri='c.jpg').update(type=2, claim_dt=timezone.now())
+        Image.objects.filter(uri='d.jpg').update(type=2, claim_dt=None)
+
+        # 진행중인 분류는 이어서 할 수 없음
+        File.objects.filter(id=self.file.id).update(filter_progress_dt=timezone.now())
+        self.assertFalse(resume_filter_image_async(self.file.id)['result'])
+        self.assertEqual(Image.objects.filter(type=0).count(), 0)
+
+        File.objects.filter(id=self.file.id).update(filter_progress_dt=old_dt)
+        self.assertTrue(resume_filter_image_async(self.file.id)['result'])
+        self.file.refresh_from_db()
+        self.assertEqual((self.file.filter_run, self.file.num_include, self.file.num_processed), (1, 2, 2))
+        self.assertGreater(self.file.filter_progress_dt, old_dt)
+        self.assertEqual(dict(Image.objects.values_list('uri', 'type')), {'a.jpg': 4, 'b.jpg': 0, 'c.jpg': 2, 'd.jpg': 0})
+        self.assertEqual(sorted(claim_image_uri(self.file.id, 10)), ['b.jpg', 'd.jpg'])
+
+
+@override_settings(IMAGEFILTER_OCR_CACHE=False, IMAGEFILTER_FETCH_INLINE=False, IMAGEFILTER_PREFILTER=False,
+                   IMAGEFILTER_CLAIM_SIZE=2, IMAGEFILTER_FILTER_CONCURRENCY=3)
+class FilterImageRunTest(FileTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        product = Product.objects.create(file=self.file, product_code='A1', name='상품1', status=0)
+        for uri in ['a.jpg', 'b.jpg', 'c.jpg']:
+            Image.objects.create(product=product, file=self.file, uri=uri)
+        File.objects.filter(id=self.file.id).update(status=4, num_image=3, filter_run=2)
+        self.backend = FakeOcrBackend()
+        for patcher in [mock.patch.object(ocr, 'get_backend', return_value=self.backend),
+                        mock.patch.object(rate_limit, 'acquire', return_value=0)]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_start(self):
+        with mock.patch.object(filter_image_claim, 'apply_async') as apply_async:
+            filter_image(self.file.id, 'zh', 1)
+            self.assertFalse(apply_async.called)
+            filter_image(self.file.id, 'zh', 2)
+        self.assertEqual([call[0][0] for call in apply_async.call_args_list], [(self.file.id, 'zh', 2)] * 3)
+
+    def test_superseded(self):
+        # 다시 요청되기 전 실행의 task 는 분류하지 않고 다시 큐에 넣지도 않음
+        with mock.patch.object(filter_image_claim, 'apply_async') as apply_async:
+            filter_image_claim(self.file.id, 'zh', 1)
+        self.assertFalse(apply_async.called)
+        self.assertEqual(self.backend.uri_list, [])
+        self.assertEqual(Image.objects.filter(type=0).count(), 3)
+
+    def test_requeue_until_done(self):
+        num_task = 0
+        with mock.patch.object(filter_image_claim, 'apply_async') as apply_async:
+            filter_image_claim(self.file.id, 'zh', 2)
+            while apply_async.called:
+                self.assertEqual(apply_async.call_args[0][0], (self.file.id, 'zh', 2))
+                apply_async.reset_mock()
+                num_task += 1
+                filter_image_claim(self.file.id, 'zh', 2)
+        self.assertEqual(sorted(self.backend.uri_list), ['a.jpg', 'b.jpg', 'c.jpg'])
+        self.file.refresh_from_db()
+        self.assertEqual((self.file.num_filter_batch, num_task), (2, 2))
+        self.assertEqual((self.file.num_processed, self.file.status), (3, 5))
+
+    def test_rate_limited(self):
+        # 분당 이미지 수를 넘으면 batch 를 돌려놓고 나중에 다시 시도 (진행 일시는 갱신)
+        old_dt = timezone.now() - timedelta(minutes=5)
+        File.objects.filter(id=self.file.id).update(filter_progress_dt=old_dt)
+        with mock.patch.object(rate_limit, 'acquire', return_value=30), \
+                mock.patch.object(filter_image_claim, 'apply_async') as apply_async:
+            filter_image_claim(self.file.id, 'zh', 2)
+        self.assertEqual(apply_async.call_args[1]['countdown'], 30)
+        self.assertEqual(Image.objects.filter(type=0).count(), 3)
+        self.assertEqual(self.backend.uri_list, [])
+        self.file.refresh_from_db()
+        self.assertGreater(self.file.filter_progress_dt, old_dt)
+        self.assertFalse(self.file.is_filter_stale())
+
+    def test_rate_limit_error(self):
+        # redis 오류로 분류하지 못한 batch 는 다시 분류 전으로
+        with mock.patch.object(rate_limit, 'acquire', side_effect=redis.ConnectionError('redis down')), \
+                mock.patch.object(filter_image_claim, 'apply_async') as apply_async:
+            with self.assertRaises(redis.ConnectionError):
+                filter_image_claim(self.file.id, 'zh', 2)
+        self.assertFalse(apply_async.called)
+        self.assertEqual(Image.objects.filter(type=2).count(), 0)
+        self.assertEqual(Image.objects.filter(type=0).count(), 3)
+
+
+@override_settings(IMAGEFILTER_UPLOAD_CHUNK_SIZE=1024)
+class FileUploadTest(WorkbookTestMixin, FileTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        override = override_settings(MEDIA_ROOT=os.path.join(self.tmp_dir, 'media'))
+        override.enable()
+        self.addCleanup(override.disable)
+        self.client.force_login(self.user)
+        rows = [HEADER] + [['A{}'.format(no), '상품{}'.format(no), 1000, '<img src="{}.jpg">'.format(no)]
+                           for no in range(200)]
+        with open(self.create_workbook(rows), 'rb') as f:
+            self.content = f.read()
+
+    def start_upload(self, file_name='C:\\업로드\\상품.xlsx'):
+        response = self.client.post('/dashboard/imagefilter/file/upload/',
+                                    {'title': 'test', 'file_name': file_name, 'size': len(self.content)})
+        self.assertEqual(response.status_code, 200)
+        context = response.json()
+        self.assertEqual(context['num_chunk'], (len(self.content) + 1023) // 1024)
+        return context['upload_id'], context['num_chunk']
+
+    def put_chunk(self, upload_id, index, data, checksum=None):
+        return self.client.put('/dashboard/imagefilter/file/upload/{}/chunk/{}/'.format(upload_id, index), data=data,
+                               content_type='application/octet-stream',
+                               HTTP_X_CHUNK_SHA256=checksum or hashlib.sha256(data).hexdigest())
+
+    def upload_chunks(self, upload_id, num_chunk):
+        # 순서와 관계없이 받음
+        for index in reversed(range(num_chunk)):
+            data = self.content[index * 1024:(index + 1) * 1024]
+            self.assertEqual(self.put_chunk(upload_id, index, data).status_code, 200)
+
+    def complete(self, upload_id):
+        return self.client.post('/dashboard/imagefilter/file/upload/{}/'.format(upload_id))
+
+    def test_upload(self):
+        upload_id, num_chunk = self.start_upload()
+        data = self.content[:1024]
+        # 손상된 조각은 받지 않음
+        self.assertEqual(self.put_chunk(upload_id, 0, data, checksum='0' * 64).status_code, 400)
+        self.assertEqual(self.put_chunk(upload_id, 0, data[:-1], checksum=hashlib.sha256(data).hexdigest()).status_code,
+                         400)
+        self.assertEqual(self.put_chunk(upload_id, num_chunk, data).status_code, 400)
+        self.assertEqual(self.put_chunk(upload_id, 0, data).status_code, 200)
+        response = self.complete(upload_id)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['missing_chunks'], list(range(1, num_chunk)))
+
+        self.upload_chunks(upload_id, num_chunk)
+        # 이미 받은 조각을 다시 보내다 손상되어도 먼저 받은 조각은 그대로
+        self.assertEqual(self.put_chunk(upload_id, 0, b'x' * 1024, checksum=hashlib.sha256(data).hexdigest()).status_code,
+                         400)
+        response = self.client.get('/dashboard/imagefilter/file/upload/{}/'.format(upload_id))
+        self.assertEqual(response.json()['missing_chunks'], [])
+
+        response = self.complete(upload_id)
+        self.assertEqual(response.status_code, 200)
+        file = File.objects.get(id=response.json()['file_id'])
+        self.assertEqual((file.status, file.user, file.original.name.rsplit('/', 1)[-1]), (1, self.user, '상품.xlsx'))
+        with open(file.original.path, 'rb') as f:
+            self.assertEqual(f.read(), self.content)
+        # 다시 완료를 요청해도 같은 파일
+        self.assertEqual(self.complete(upload_id).json()['file_id'], file.id)
+        self.assertEqual(self.put_chunk(upload_id, 0, data).status_code, 400)
+        # 임시 파일 정리
+        self.assertEqual(os.listdir(os.path.dirname(FileUpload.objects.get(id=upload_id).get_part_path())), [])
+
+    def test_not_approved(self):
+        upload_id, num_chunk = self.start_upload()
+        Company.objects.filter(id=self.user.company_id).update(is_approved=False)
+        self.assertEqual(self.put_chunk(upload_id, 0, self.content[:1024]).status_code, 403)
+        self.assertEqual(FileUpload.objects.get(id=upload_id).received_chunks, [])
+
+    def test_same_name(self):
+        # 같은 이름의 파일은 서로 덮어쓰지 않음
+        path_list = []
+        for _ in range(2):
+            upload_id, num_chunk = self.start_upload()
+            self.upload_chunks(upload_id, num_chunk)
+            path_list.append(File.objects.get(id=self.complete(upload_id).json()['file_id']).original.path)
+        self.assertNotEqual(path_list[0], path_list[1])
+        for path in path_list:
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read(), self.content)
@@ -1,16 +1,23 @@
 from django.urls import path
 
 from imagefilter.views import ImageFileListView, ImageFileCreateView, ImageFileActionView, ProductListView, \
-    ProductDetailView, ImageListView, ImageTypeChangeView
+    ProductDetailView, ImageListView, ImageTypeChangeView, FileTimelineView, FileProgressView, \
+    MetricsView, FileUploadView, FileUploadDetailView, FileUploadChunkView
 
 app_name = 'imagefilter'
 
 urlpatterns = [
     path('file/', ImageFileListView.as_view(), name='list'),
     path('file/create/', ImageFileCreateView.as_view(), name='create'),
+    path('file/upload/', FileUploadView.as_view(), name='upload'),
+    path('file/upload/<int:upload_id>/', FileUploadDetailView.as_view(), name='upload_detail'),
+    path('file/upload/<int:upload_id>/chunk/<int:index>/', FileUploadChunkView.as_view(), name='upload_chunk'),
     path('file/action/', ImageFileActionView.as_view(), name='action'),
+    path('file/progress/', FileProgressView.as_view(), name='progress'),
+    path('file/<int:file_id>/timeline/', FileTimelineView.as_view(), name='timeline'),
     path('file/<int:file_id>/product/', ProductListView.as_view(), name='product_list'),
     path('file/<int:file_id>/product/<int:product_id>/', ProductDetailView.as_view(), name='product_detail'),
     path('file/<int:file_id>/image/', ImageListView.as_view(), name='image_list'),
     path('image/<int:image_id>/', ImageTypeChangeView.as_view(), name='image_type_change'),
+    path('metrics/', MetricsView.as_view(), name='metrics'),
 ]
\ No newline at end of file
@@ -0,0 +1,60 @@
+def classify_filter_result(data_dict, error, excluded_locales):
+    # vision api 결과로 (이미지 분류결과, 에러) 를 반환
+    if isinstance(excluded_locales, str):
+        excluded_locales = [excluded_locales]
+    if data_dict is None:
+        return 1, str(error)
+
+    text_annotations = data_dict.get('textAnnotations', None)
+    api_error = data_dict.get('error', None)
+    if text_annotations:  # 텍스트 인식 성공
+        locale = text_annotations[0].get('locale', None)
+        if locale in excluded_locales:
+            return 3, None
+        return 4, None
+    elif api_error:
+        return 1, api_error.get('message', '관리자 문의')
+    elif data_dict == {}:
+        # vision api가 빈 dictionary를 반환하면 글자가 없다고 판단한 것
+        return 4, None
+    elif 'prefilter' in data_dict:
+        # OCR 전 단계에서 글자가 없다고 판단한 것
+        return 4, None
+    return 1, '관리자 문의'
+
+
+def summarize_filter_result(data_dict):
+    # 분류에 필요한 값만 남긴 (대표 언어, 글자 수, 언어 분포) 반환
+    if data_dict is None:
+        return None, None, None
+    text_annotations = data_dict.get('textAnnotations', None)
+    if not text_annotations:
+        return None, 0, None
+    locale = text_annotations[0].get('locale', None)
+    text_length = len(text_annotations[0].get('description', ''))
+
+    languages = {}
+    for page in data_dict.get('fullTextAnnotation', {}).get('pages', []):
+        for language in page.get('property', {}).get('detectedLanguages', []):
+            code = language.get('languageCode', None)
+            if code:
+                languages[code] = round(languages.get(code, 0) + language.get('confidence', 0), 3)
+    if not languages and locale:
+        languages = {locale: 1}
+    return locale, text_length, languages
+
+
+def compact_filter_result(data_dict):
+    # classify_filter_result, summarize_filter_result 에 필요한 값만 남긴 결과 (OCR 캐시 저장용)
+    # 단어별 위치(boundingPoly) 등 나머지 값은 버림 (분류 실패한 결과는 캐시하지 않으므로 에러는 남기지 않음)
+    text_annotations = data_dict.get('textAnnotations', None)
+    if not text_annotations:
+        return {'prefilter': data_dict['prefilter']} if 'prefilter' in data_dict else {}
+    compact = {'textAnnotations': [{key: text_annotations[0][key] for key in ('locale', 'description')
+                                    if key in text_annotations[0]}]}
+    page_list = [{'property': {'detectedLanguages': page['property']['detectedLanguages']}}
+                 for page in data_dict.get('fullTextAnnotation', {}).get('pages', [])
+                 if page.get('property', {}).get('detectedLanguages')]
+    if page_list:
+        compact['fullTextAnnotation'] = {'pages': page_list}
+    return compact
@@ -0,0 +1,34 @@
+import lxml.html
+from bs4 import BeautifulSoup as bs
+
+from imagefilter import exceptions
+
+
+def extract_image_uri(description):
+    # 상세설명의 <img src> 목록을 문서 순서대로 반환 (lxml 우선, 실패하면 BeautifulSoup)
+    if not description:
+        return []
+    description = str(description)
+    try:
+        return _extract_image_uri_lxml(description)
+    except Exception:
+        pass
+    try:
+        soup = bs(description, 'html.parser')
+        return [image.attrs['src'] for image in soup.find_all('img') if image.attrs.get('src')]
+    except Exception:
+        raise exceptions.ExtractImageException('이미지 추출 실패')
+
+
+def _extract_image_uri_lxml(description):
+    root = lxml.html.fromstring(description)
+    return [str(src) for src in root.xpath('//img/@src') if src]
+
+
+def remove_image(description, uri_set):
+    # src가 uri_set에 있는 <img>를 한번의 파싱으로 모두 제거
+    soup = bs(description, 'html.parser')
+    for image in soup.find_all('img'):
+        if image.get('src') in uri_set:
+            image.decompose()
+    return str(soup)
@@ -0,0 +1,104 @@
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# 크기/포맷을 확인하기 위해 한번에 읽는 바이트 수
+CHUNK_SIZE = 16 * 1024
+
+
+class FetchedImage(object):
+    def __init__(self, uri, content=None, format=None, width=None, height=None, error=None):
+        self.uri = uri
+        self.content = content
+        self.format = format
+        self.width = width
+        self.height = height
+        self.error = error
+        self.content_hash = hashlib.sha256(content).hexdigest() if content is not None else None
+
+    def is_tiny(self):
+        # 여백/트래킹용 작은 이미지
+        min_size = settings.IMAGEFILTER_FETCH_MIN_SIZE
+        return self.width is not None and (self.width < min_size or self.height < min_size)
+
+
+class ImageFetcher(object):
+    # host 별 connection pool (IMAGEFILTER_FETCH_PER_HOST 개까지, 초과 요청은 대기)
+    # 연결 실패/429/5xx 는 backoff 후 재시도
+    def __init__(self):
+        retry = Retry(total=settings.IMAGEFILTER_FETCH_RETRY, backoff_factor=0.5,
+                      status_forcelist=[429, 500, 502, 503, 504])
+        adapter = HTTPAdapter(pool_connections=settings.IMAGEFILTER_FETCH_WORKERS,
+                              pool_maxsize=settings.IMAGEFILTER_FETCH_PER_HOST, pool_block=True, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def iter_fetch(self, uri_list):
+        with ThreadPoolExecutor(max_workers=settings.IMAGEFILTER_FETCH_WORKERS) as executor:
+            for image in executor.map(self.fetch, uri_list):
+                yield image
+
+    def fetch(self, uri):
+        # uri 는 업로드된 파일의 상세설명에서 가져온 값이므로 http/https 만 요청 (file:// 등 로컬 경로 차단)
+        # 결과는 분류 결과를 uri 로 반영하므로 요청한 주소가 아닌 원래 uri 로 반환
+        try:
+            split = urlsplit(uri)
+            request_uri = uri
+            if not split.scheme:
+                request_uri = 'http:' + uri
+            elif split.scheme.lower() not in ('http', 'https'):
+                return FetchedImage(uri, error='지원하지 않는 uri ({})'.format(split.scheme))
+            with self.session.get(request_uri, stream=True, timeout=settings.IMAGEFILTER_FETCH_TIMEOUT) as response:
+                response.raise_for_status()
+                return self.read(uri, response.iter_content(CHUNK_SIZE))
+        except Exception as e:
+            return FetchedImage(uri, error=str(e))
+
+    def read(self, uri, chunk_iter):
+        # 앞부분만 읽어서 포맷/크기를 확인하고, 작은 이미지는 나머지를 받지 않는다.
+        from PIL import ImageFile
+        parser = ImageFile.Parser()
+        content = []
+        size = 0
+        for chunk in chunk_iter:
+            content.append(chunk)
+            size += len(chunk)
+            if size > settings.IMAGEFILTER_FETCH_MAX_BYTES:
+                return FetchedImage(uri, error='이미지 용량 초과')
+            if parser.image is None:
+                try:
+                    parser.feed(chunk)
+                except Exception:
+                    return FetchedImage(uri, error='이미지 형식 오류')
+                if parser.image is not None:
+                    width, height = parser.image.size
+                    image = FetchedImage(uri, format=parser.image.format, width=width, height=height)
+                    if image.is_tiny():
+                        return image
+        if parser.image is None:
+            return FetchedImage(uri, error='이미지 형식 오류')
+        width, height = parser.image.size
+        return FetchedImage(uri, content=b''.join(content), format=parser.image.format, width=width, height=height)
+
+
+_fetcher = None
+
+
+def get_fetcher():
+    global _fetcher
+    if _fetcher is None:
+        _fetcher = ImageFetcher()
+    return _fetcher
+
+
+def fetch_image(uri):
+    image = get_fetcher().fetch(uri)
+    if image.error:
+        raise ValueError(image.error)
+    return image.content
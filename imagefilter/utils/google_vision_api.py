@@ -1,15 +1,143 @@
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
 from django.conf import settings
+from google.api_core.exceptions import DeadlineExceeded, InternalServerError, ResourceExhausted, ServiceUnavailable
 from google.cloud import vision_v1
 from google.protobuf.json_format import MessageToDict
 
 from google.oauth2 import service_account
 
+from imagefilter.utils import metrics
 
-def text_detection_uri(uri):
+# batch_annotate_images 한번에 보낼 수 있는 최대 이미지 수
+MAX_BATCH_SIZE = 16
+# 잠시 후 다시 보내면 성공할 수 있는 오류 (그 외 오류는 batch 전체를 오류로 반환)
+RETRY_EXCEPTIONS = (ResourceExhausted, ServiceUnavailable, DeadlineExceeded, InternalServerError)
+
+
+def get_client():
     credentials = service_account.Credentials.from_service_account_file(settings.GOOGLE_VISION_API_CREDENTIAL_PATH)
-    client = vision_v1.ImageAnnotatorClient(credentials=credentials)
+    return vision_v1.ImageAnnotatorClient(credentials=credentials)
+
+
+def text_detection_uri(uri):
+    client = get_client()
     image = vision_v1.types.Image()
     image.source.image_uri = uri
     response = client.document_text_detection(image=image)
     data_dict = MessageToDict(response)
     return data_dict
+
+
+class RateLimiter(object):
+    # 분당 이미지 수 quota를 넘지 않도록 요청 간격을 조절 (여러 thread에서 공유)
+    def __init__(self, per_minute):
+        self.interval = 60.0 / per_minute if per_minute else 0
+        self.lock = threading.Lock()
+        self.next_time = time.monotonic()
+
+    def acquire(self, amount=1):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_time - now
+            self.next_time = max(self.next_time, now) + self.interval * amount
+        if delay > 0:
+            time.sleep(delay)
+
+
+def build_text_detection_request(source):
+    # source : uri 또는 이미지 bytes (직접 받은 이미지는 content 로 전송)
+    image = vision_v1.types.Image()
+    if isinstance(source, bytes):
+        image.content = source
+    else:
+        image.source.image_uri = source
+    features = [vision_v1.types.Feature(type=vision_v1.enums.Feature.Type.TEXT_DETECTION)]
+    return vision_v1.types.AnnotateImageRequest(image=image, features=features)
+
+
+def batch_text_detection(client, source_list, rate_limiter=None):
+    # uri(또는 이미지 bytes) 목록을 한번의 batch_annotate_images 호출로 보내고 [(data_dict, error), ...] 를 순서대로 반환
+    requests = [build_text_detection_request(source) for source in source_list]
+    metrics.observe('imagefilter_vision_batch_size', len(requests), buckets=metrics.SIZE_BUCKETS)
+    retry = 0
+    while True:
+        if rate_limiter:
+            rate_limiter.acquire(len(requests))
+        try:
+            with metrics.Timer() as timer:
+                response = client.batch_annotate_images(requests)
+        except RETRY_EXCEPTIONS as e:
+            # quota 초과 / 일시적인 서버 오류 : 지수 backoff 후 재시도
+            metrics.inc('imagefilter_vision_retry_total')
+            if retry >= settings.IMAGEFILTER_VISION_MAX_RETRY:
+                metrics.inc('imagefilter_vision_error_total',
+                            reason='quota' if isinstance(e, ResourceExhausted) else type(e).__name__)
+                return [(None, str(e)) for _ in source_list]
+            time.sleep(settings.IMAGEFILTER_VISION_BACKOFF * (2 ** retry) * (1 + random.random()))
+            retry += 1
+        except Exception as e:
+            metrics.inc('imagefilter_vision_error_total', reason=type(e).__name__)
+            return [(None, str(e)) for _ in source_list]
+        else:
+            metrics.observe('imagefilter_vision_request_seconds', timer.seconds)
+            break
+
+    result_list = []
+    for annotate_response in response.responses:
+        try:
+            result_list.append((MessageToDict(annotate_response), None))
+        except Exception as e:
+            result_list.append((None, str(e)))
+    return result_list
+
+
+def iter_text_detection(client, item_list, batch_size=None, max_in_flight=None):
+    # item_list : [(key, uri 또는 이미지 bytes), ...]
+    # batch_size 단위로 나눈 요청을 최대 max_in_flight 개까지 동시에 보내고, 끝나는 순서대로 (key, data_dict, error) 반환
+    batch_size = min(batch_size or settings.IMAGEFILTER_VISION_BATCH_SIZE, MAX_BATCH_SIZE)
+    max_in_flight = max_in_flight or settings.IMAGEFILTER_VISION_MAX_IN_FLIGHT
+    rate_limiter = RateLimiter(settings.IMAGEFILTER_VISION_IMAGES_PER_MINUTE)
+
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        pending = {}
+        for batch in _iter_batch(item_list, batch_size):
+            if len(pending) >= max_in_flight:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    for result in _zip_batch_result(pending.pop(future), future.result()):
+                        yield result
+            future = executor.submit(batch_text_detection, client, [source for _, source in batch], rate_limiter)
+            pending[future] = batch
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                for result in _zip_batch_result(pending.pop(future), future.result()):
+                    yield result
+
+
+def _iter_batch(item_list, batch_size):
+    # 이미지 bytes 를 보낼때는 요청 크기 제한을 넘지 않도록 batch 를 나눈다.
+    batch = []
+    batch_bytes = 0
+    for key, source in item_list:
+        source_bytes = len(source) if isinstance(source, bytes) else 0
+        if batch and (len(batch) >= batch_size or
+                      batch_bytes + source_bytes > settings.IMAGEFILTER_VISION_MAX_REQUEST_BYTES):
+            yield batch
+            batch = []
+            batch_bytes = 0
+        batch.append((key, source))
+        batch_bytes += source_bytes
+    if batch:
+        yield batch
+
+
+def _zip_batch_result(batch, result_list):
+    for (key, _), (data_dict, error) in zip(batch, result_list):
+        yield key, data_dict, error
@@ -0,0 +1,108 @@
+import logging
+import re
+import time
+
+import redis
+from django.utils import timezone
+
+from imagefilter.models import FileStage
+from imagefilter.utils.rate_limit import get_client
+
+logger = logging.getLogger(__name__)
+
+# 모든 worker의 지표를 redis hash 하나에 모아서 prometheus text 형식으로 출력
+METRICS_KEY = 'imagefilter:metrics'
+
+HELP = {
+    'imagefilter_stage_seconds': ('histogram', '파일 단계별 처리 시간(초)'),
+    'imagefilter_stage_items_total': ('counter', '파일 단계별 처리 건수 (상품/이미지)'),
+    'imagefilter_vision_request_seconds': ('histogram', 'vision api batch 요청 시간(초)'),
+    'imagefilter_vision_batch_size': ('histogram', 'vision api batch 당 이미지 수'),
+    'imagefilter_vision_retry_total': ('counter', 'vision api quota 초과/일시 오류 재시도 횟수'),
+    'imagefilter_vision_error_total': ('counter', 'vision api 요청 실패 횟수'),
+    'imagefilter_ocr_cache_total': ('counter', 'OCR 캐시 조회 결과 (hit/miss)'),
+    'imagefilter_classified_total': ('counter', '분류결과별 이미지 수'),
+}
+
+SECONDS_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600)
+SIZE_BUCKETS = (1, 2, 4, 8, 16)
+
+
+def _name(metric, labels):
+    if not labels:
+        return metric
+    return '{}{{{}}}'.format(metric, ','.join('{}="{}"'.format(key, labels[key]) for key in sorted(labels)))
+
+
+def _execute(command_list):
+    # 지표 저장 실패가 작업을 중단시키지 않도록 redis 오류는 로그만 남김
+    try:
+        pipe = get_client().pipeline(transaction=False)
+        for field, amount in command_list:
+            pipe.hincrbyfloat(METRICS_KEY, field, amount)
+        pipe.execute()
+    except redis.RedisError as e:
+        logger.warning('metrics : %s', e)
+
+
+def inc(metric, amount=1, **labels):
+    if amount:
+        _execute([(_name(metric, labels), amount)])
+
+
+def observe(metric, value, buckets=SECONDS_BUCKETS, **labels):
+    # 해당하지 않는 구간도 0을 더해서 모든 구간이 출력되게 함
+    command_list = [(_name(metric + '_bucket', dict(labels, le=str(le))), int(value <= le)) for le in buckets]
+    command_list.append((_name(metric + '_bucket', dict(labels, le='+Inf')), 1))
+    command_list.append((_name(metric + '_sum', labels), value))
+    command_list.append((_name(metric + '_count', labels), 1))
+    _execute(command_list)
+
+
+class Timer(object):
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, *args):
+        self.seconds = time.monotonic() - self.start
+
+
+def render():
+    # prometheus text exposition format
+    data = {key.decode('utf-8'): float(value) for key, value in get_client().hgetall(METRICS_KEY).items()}
+    line_list = []
+    for metric, (metric_type, help) in HELP.items():
+        line_list.append('# HELP {} {}'.format(metric, help))
+        line_list.append('# TYPE {} {}'.format(metric, metric_type))
+        for field in sorted(data, key=_sort_key):
+            if field.split('{')[0] in (metric, metric + '_bucket', metric + '_sum', metric + '_count'):
+                line_list.append('{} {}'.format(field, _format_value(data[field])))
+    return '\n'.join(line_list) + '\n'
+
+
+def _sort_key(field):
+    # histogram 구간은 숫자 순서로
+    le = re.search(r'le="([^"]+)"', field)
+    return re.sub(r'le="[^"]+"', '', field), float(le.group(1)) if le else 0
+
+
+def _format_value(value):
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+def start_stage(file_id, stage):
+    FileStage.objects.update_or_create(file_id=file_id, stage=stage,
+                                       defaults={'start_dt': timezone.now(), 'end_dt': None, 'num_item': None})
+
+
+def finish_stage(file_id, stage, num_item=None):
+    # 단계 종료 시각/처리 건수를 기록하고 처리 시간을 지표에 반영 (여러 task가 동시에 끝내도 한번만 반영)
+    end_dt = timezone.now()
+    if not FileStage.objects.filter(file_id=file_id, stage=stage, end_dt__isnull=True).update(
+            end_dt=end_dt, num_item=num_item):
+        return
+    seconds = (end_dt - FileStage.objects.get(file_id=file_id, stage=stage).start_dt).total_seconds()
+    logger.info('file %s %s : %.1fs, %s건', file_id, stage, seconds, num_item)
+    observe('imagefilter_stage_seconds', seconds, stage=stage)
+    inc('imagefilter_stage_items_total', num_item or 0, stage=stage)
@@ -0,0 +1,103 @@
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from imagefilter.utils import google_vision_api
+from imagefilter.utils.fetch import fetch_image
+
+
+_backend_dict = {}
+
+
+def get_backend():
+    # worker process 마다 한번만 생성 (batch task 마다 인증/연결을 새로 만들지 않음)
+    path = settings.IMAGEFILTER_OCR_BACKEND
+    if path not in _backend_dict:
+        _backend_dict[path] = import_string(path)()
+    return _backend_dict[path]
+
+
+class OcrBackend(ABC):
+    # item_list : [(key, uri), ...] 를 받아서 (key, data_dict, error) 를 반환
+    # data_dict 는 vision api 의 MessageToDict 결과와 같은 형태 (classify_filter_result 에서 그대로 사용)
+    @abstractmethod
+    def iter_text_detection(self, item_list):
+        pass
+
+    # item_list : [(key, 이미지 bytes), ...] (IMAGEFILTER_FETCH_INLINE 에서 직접 받은 이미지)
+    @abstractmethod
+    def iter_text_detection_content(self, item_list):
+        pass
+
+
+class GoogleVisionBackend(OcrBackend):
+    def __init__(self):
+        self.client = google_vision_api.get_client()
+
+    def iter_text_detection(self, item_list):
+        return google_vision_api.iter_text_detection(self.client, item_list)
+
+    def iter_text_detection_content(self, item_list):
+        return google_vision_api.iter_text_detection(self.client, item_list)
+
+
+class TesseractBackend(OcrBackend):
+    # 로컬 tesseract 로 글자를 인식하고, 인식된 글자의 문자 종류로 언어를 판단
+    # pytesseract 는 이미지마다 tesseract 프로세스를 실행하므로 thread 수만큼 CPU를 병렬로 사용한다.
+    # (celery prefork worker 안에서는 multiprocessing pool 을 만들 수 없음)
+    def __init__(self):
+        import pytesseract
+        from PIL import Image as PILImage
+        self.pytesseract = pytesseract
+        self.pil_image = PILImage
+
+    def iter_text_detection(self, item_list):
+        return self._iter_map(self.text_detection_uri, item_list)
+
+    def iter_text_detection_content(self, item_list):
+        return self._iter_map(self.text_detection_content, item_list)
+
+    def _iter_map(self, func, item_list):
+        with ThreadPoolExecutor(max_workers=settings.IMAGEFILTER_TESSERACT_WORKERS) as executor:
+            for (key, _), (data_dict, error) in zip(item_list, executor.map(func, [source for _, source in item_list])):
+                yield key, data_dict, error
+
+    def text_detection_uri(self, uri):
+        try:
+            return self.text_detection(fetch_image(uri)), None
+        except Exception as e:
+            return None, str(e)
+
+    def text_detection_content(self, content):
+        try:
+            return self.text_detection(content), None
+        except Exception as e:
+            return None, str(e)
+
+    def text_detection(self, content):
+        image = self.pil_image.open(BytesIO(content)).convert('RGB')
+        text = self.pytesseract.image_to_string(image, lang=settings.IMAGEFILTER_TESSERACT_LANG).strip()
+        if not text:
+            # vision api 와 같이 글자가 없으면 빈 dictionary
+            return {}
+        return {'textAnnotations': [{'locale': detect_locale(text), 'description': text}]}
+
+
+def detect_locale(text):
+    # 문자 종류(유니코드 범위)별 글자 수가 가장 많은 언어
+    count = {'zh': 0, 'ko': 0, 'ja': 0, 'en': 0}
+    for char in text:
+        code = ord(char)
+        if 0xAC00 <= code <= 0xD7A3 or 0x3130 <= code <= 0x318F:
+            count['ko'] += 1
+        elif 0x3040 <= code <= 0x30FF:
+            count['ja'] += 1
+        elif 0x4E00 <= code <= 0x9FFF or 0x3400 <= code <= 0x4DBF:
+            count['zh'] += 1
+        elif char.isascii() and char.isalpha():
+            count['en'] += 1
+    locale = max(count, key=count.get)
+    return locale if count[locale] else 'und'
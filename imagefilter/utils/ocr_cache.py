@@ -0,0 +1,95 @@
+import hashlib
+from datetime import timedelta
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.db.models import F, Q
+from django.utils import timezone
+
+from imagefilter.models import OcrCache, compress_json, decompress_json
+from imagefilter.utils.classify import classify_filter_result, compact_filter_result
+
+# 한번에 조회할 uri 수 (IN 조건 크기 제한)
+LOOKUP_CHUNK_SIZE = 1000
+
+
+def normalize_uri(uri):
+    # http/https, host 대소문자, fragment 차이는 같은 이미지로 본다.
+    split = urlsplit(uri.strip())
+    normalized = '//{}{}'.format(split.netloc.lower(), split.path)
+    if split.query:
+        normalized = '{}?{}'.format(normalized, split.query)
+    return normalized
+
+
+def get_uri_hash(uri):
+    return hashlib.sha256(normalize_uri(uri).encode('utf-8')).hexdigest()
+
+
+def get_content_hash(content):
+    return hashlib.sha256(content).hexdigest()
+
+
+def _valid_filter():
+    return Q(created_dt__gte=timezone.now() - timedelta(seconds=settings.IMAGEFILTER_OCR_CACHE_TTL))
+
+
+def get_cached_result(uri_list):
+    # {uri: data_dict} 반환, 사용된 캐시는 최근 사용일시/횟수를 갱신 (LRU)
+    if not settings.IMAGEFILTER_OCR_CACHE:
+        return {}
+    hash_dict = {}
+    for uri in uri_list:
+        hash_dict.setdefault(get_uri_hash(uri), []).append(uri)
+    hash_list = list(hash_dict.keys())
+
+    result = {}
+    for pos in range(0, len(hash_list), LOOKUP_CHUNK_SIZE):
+        chunk = hash_list[pos:pos + LOOKUP_CHUNK_SIZE]
+        cache_list = OcrCache.objects.values_list('uri_hash', 'data').filter(
+            Q(uri_hash__in=chunk) & _valid_filter())
+        hit_list = []
+        for uri_hash, data in cache_list:
+            hit_list.append(uri_hash)
+            data_dict = decompress_json(data)
+            for uri in hash_dict[uri_hash]:
+                result[uri] = data_dict
+        if hit_list:
+            OcrCache.objects.filter(uri_hash__in=hit_list).update(last_hit_dt=timezone.now(), num_hit=F('num_hit') + 1)
+    return result
+
+
+def get_cached_result_by_content(content_hash):
+    if not settings.IMAGEFILTER_OCR_CACHE or not content_hash:
+        return None
+    cache = OcrCache.objects.filter(Q(content_hash=content_hash) & _valid_filter()).first()
+    if cache is None:
+        return None
+    OcrCache.objects.filter(id=cache.id).update(last_hit_dt=timezone.now(), num_hit=F('num_hit') + 1)
+    return cache.get_data()
+
+
+def set_cached_result(result_list):
+    # result_list : [(uri, data_dict, content_hash), ...]
+    # 분류에 성공한 결과만 분류에 필요한 값을 압축해서 저장하고, 이미 있는 uri는 무시
+    # (전체 결과는 파일별 ImageAnnotation 에만 저장)
+    if not settings.IMAGEFILTER_OCR_CACHE:
+        return
+    cache_dict = {}
+    for uri, data_dict, content_hash in result_list:
+        if data_dict is None or classify_filter_result(data_dict, None, [])[0] == 1:
+            continue
+        uri_hash = get_uri_hash(uri)
+        cache_dict[uri_hash] = OcrCache(uri_hash=uri_hash, uri=uri, content_hash=content_hash,
+                                        data=compress_json(compact_filter_result(data_dict)))
+    OcrCache.objects.bulk_create(cache_dict.values(), ignore_conflicts=True)
+
+
+def prune_cache():
+    # 만료된 캐시를 지우고, 최대 개수를 넘으면 오래 사용되지 않은 순서로 삭제
+    OcrCache.objects.filter(~_valid_filter()).delete()
+    max_entries = settings.IMAGEFILTER_OCR_CACHE_MAX_ENTRIES
+    boundary = OcrCache.objects.order_by('-last_hit_dt').values_list('last_hit_dt', flat=True)[max_entries:max_entries + 1]
+    boundary = list(boundary)
+    if boundary:
+        OcrCache.objects.filter(last_hit_dt__lte=boundary[0]).delete()
@@ -0,0 +1,46 @@
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+import numpy as np
+from django.conf import settings
+
+from imagefilter.utils.fetch import fetch_image
+
+
+def iter_prefilter(uri_list):
+    # 이미지를 동시에 받아서 글자가 없는 것이 확실한 이미지를 골라낸다.
+    # (uri, edge_ratio) 반환, 받지 못했거나 분석하지 못한 이미지는 edge_ratio 가 None (OCR 로 보냄)
+    with ThreadPoolExecutor(max_workers=settings.IMAGEFILTER_PREFILTER_WORKERS) as executor:
+        for uri, edge_ratio in zip(uri_list, executor.map(get_edge_ratio_uri, uri_list)):
+            yield uri, edge_ratio
+
+
+def is_no_text(edge_ratio):
+    return edge_ratio is not None and edge_ratio < settings.IMAGEFILTER_PREFILTER_MAX_EDGE_RATIO
+
+
+def get_edge_ratio_uri(uri):
+    try:
+        return get_edge_ratio(fetch_image(uri))
+    except Exception:
+        return None
+
+
+def get_edge_ratio_content(content):
+    try:
+        return get_edge_ratio(content)
+    except Exception:
+        return None
+
+
+def get_edge_ratio(content):
+    # 축소한 흑백 이미지에서 밝기 변화가 큰 픽셀의 비율 (글자는 경계가 촘촘하고 뚜렷함)
+    from PIL import Image as PILImage
+    image = PILImage.open(BytesIO(content)).convert('L')
+    size = settings.IMAGEFILTER_PREFILTER_SIZE
+    image.thumbnail((size, size))
+    pixel = np.asarray(image, dtype=np.int16)
+    if pixel.shape[0] < 2 or pixel.shape[1] < 2:
+        return 0.0
+    gradient = np.abs(np.diff(pixel, axis=1))[:-1, :] + np.abs(np.diff(pixel, axis=0))[:, :-1]
+    return float((gradient > settings.IMAGEFILTER_PREFILTER_EDGE_THRESHOLD).mean())
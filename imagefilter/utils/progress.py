@@ -0,0 +1,77 @@
+import logging
+import time
+
+import redis
+
+from imagefilter.utils.rate_limit import get_client
+
+logger = logging.getLogger(__name__)
+
+# 파일별 진행상황 (단계, 처리 건수, 전체 건수)을 redis hash에 기록해서 목록 화면이 DB 조회 없이 가져감
+PROGRESS_KEY = 'imagefilter:progress:{}'
+PROGRESS_TTL = 60 * 60 * 24
+
+
+def _execute(func):
+    # 진행상황 기록 실패가 작업을 중단시키지 않도록 redis 오류는 로그만 남김
+    try:
+        pipe = get_client().pipeline()
+        func(pipe)
+        pipe.execute()
+    except redis.RedisError as e:
+        logger.warning('progress : %s', e)
+
+
+def start_progress(file_id, stage, total=None):
+    def func(pipe):
+        name = PROGRESS_KEY.format(file_id)
+        pipe.delete(name)
+        pipe.hmset(name, {'stage': stage, 'processed': 0, 'total': total if total is not None else '',
+                          'updated': time.time()})
+        pipe.expire(name, PROGRESS_TTL)
+    _execute(func)
+
+
+def set_progress(file_id, stage, processed, total=None):
+    def func(pipe):
+        name = PROGRESS_KEY.format(file_id)
+        pipe.hmset(name, {'stage': stage, 'processed': processed, 'total': total if total is not None else '',
+                          'updated': time.time()})
+        pipe.expire(name, PROGRESS_TTL)
+    _execute(func)
+
+
+def add_progress(file_id, amount):
+    # 여러 task가 동시에 더해도 되도록 HINCRBY 사용 (단계/전체 건수는 start_progress 에서 지정)
+    def func(pipe):
+        name = PROGRESS_KEY.format(file_id)
+        pipe.hincrby(name, 'processed', amount)
+        pipe.hset(name, 'updated', time.time())
+    _execute(func)
+
+
+def get_progress(file_id_list):
+    # {file_id: {'stage', 'processed', 'total', 'percent'}} (기록이 없는 파일은 제외)
+    try:
+        pipe = get_client().pipeline()
+        for file_id in file_id_list:
+            pipe.hgetall(PROGRESS_KEY.format(file_id))
+        data_list = pipe.execute()
+    except redis.RedisError as e:
+        logger.warning('progress : %s', e)
+        return {}
+    progress_dict = {}
+    for file_id, data in zip(file_id_list, data_list):
+        if not data:
+            continue
+        data = {key.decode('utf-8'): value.decode('utf-8') for key, value in data.items()}
+        processed = int(data.get('processed') or 0)
+        total = int(data['total']) if data.get('total') else None
+        progress_dict[file_id] = {
+            'stage': data.get('stage'),
+            'processed': processed,
+            'total': total,
+            'percent': min(int(processed * 100 / total), 100) if total else None,
+        }
+    return progress_dict
+
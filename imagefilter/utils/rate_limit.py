@@ -0,0 +1,38 @@
+import time
+
+import redis
+from django.conf import settings
+
+_client = None
+
+
+def get_client():
+    global _client
+    if _client is None:
+        _client = redis.Redis.from_url(settings.IMAGEFILTER_REDIS_URL)
+    return _client
+
+
+def acquire(limit_list, amount):
+    # limit_list : [(key, 분당 허용량), ...] (허용량이 없으면 제한 없음)
+    # 모든 worker가 redis의 1분 단위 카운터를 공유하며, 하나라도 초과하면 되돌리고 다음 1분까지 남은 초를 반환 (허용되면 0)
+    limit_list = [(key, limit) for key, limit in limit_list if limit]
+    if not limit_list:
+        return 0
+    window = int(time.time() // 60)
+    name_list = ['imagefilter:rate:{}:{}'.format(key, window) for key, _ in limit_list]
+
+    pipe = get_client().pipeline()
+    for name in name_list:
+        pipe.incrby(name, amount)
+        pipe.expire(name, 120)
+    count_list = pipe.execute()[::2]
+    # 허용량보다 큰 batch도 구간의 첫 요청이면 허용
+    if all(count <= limit or count == amount for count, (_, limit) in zip(count_list, limit_list)):
+        return 0
+
+    pipe = get_client().pipeline()
+    for name in name_list:
+        pipe.decrby(name, amount)
+    pipe.execute()
+    return 60 - time.time() % 60
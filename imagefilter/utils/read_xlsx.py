@@ -1,3 +1,306 @@
-path = '/Users/cuhong/PycharmProjects/amc/rawlabs/imagefilter/utils/rawlabs-image-filter-b49886e323a4.json'
+import difflib
+import posixpath
+import zipfile
+from xml.etree import ElementTree
 
+import openpyxl
+import xlrd
+from django.conf import settings
+from openpyxl.utils import column_index_from_string, get_column_letter
 
+from imagefilter import exceptions
+
+PRODUCT_COLUMN = {'고객사상품코드': 'product_code', '상품명': 'name', '상품상세설명': 'original_description'}
+# 비어있으면 등록할 수 없는 항목과 최대 길이 (Product.product_code, Product.name)
+REQUIRED_COLUMN = ['고객사상품코드', '상품명']
+MAX_LENGTH = 500
+
+
+def iter_product_rows(path, columns=PRODUCT_COLUMN):
+    # 워크북 전체를 메모리에 올리지 않고 한 행씩 dict로 돌려준다.
+    # 등록할 수 없는 행(필수 항목 누락, 길이 초과, 상품코드 중복)은 행 번호와 함께 ExcelFormatException
+    rows = iter_sheet_rows(path)
+    header = check_header(rows, columns)
+    column_index = {header.index(column): name for column, name in columns.items()}
+    required_list = [(column, header.index(column), columns[column]) for column in REQUIRED_COLUMN if column in columns]
+    code_dict = {}
+
+    for row_no, row in enumerate(rows, start=2):
+        data = {name: normalize_cell(row[idx]) if idx < len(row) else None for idx, name in column_index.items()}
+        if all(value is None for value in data.values()):
+            continue
+        error_dict = {}
+        for column, idx, name in required_list:
+            if data[name] is None:
+                error_dict[column] = '{}열 {}행 값이 없습니다.'.format(get_column_letter(idx + 1), row_no)
+            elif len(str(data[name])) > MAX_LENGTH:
+                error_dict[column] = '{}열 {}행 {}자를 넘습니다.'.format(get_column_letter(idx + 1), row_no, MAX_LENGTH)
+        code = data.get('product_code')
+        if code is not None:
+            if str(code) in code_dict:
+                error_dict.setdefault('고객사상품코드', '{}행 상품코드가 {}행과 중복됩니다.'.format(
+                    row_no, code_dict[str(code)]))
+            code_dict[str(code)] = row_no
+        if error_dict:
+            raise exceptions.ExcelFormatException(_format_error(error_dict), error_dict)
+        yield data
+
+
+def probe_schema(path, columns=PRODUCT_COLUMN, num_row=None):
+    # 헤더와 처음 num_row개 상품 행만 읽어서 형식을 확인하고 파일을 닫는다. (파일 전체를 읽기 전에 빠르게 실패)
+    # 문제가 있으면 항목별 진단 {항목: 메시지} 를 담은 ExcelFormatException
+    num_row = num_row or settings.IMAGEFILTER_SCHEMA_PROBE_ROWS
+    rows = iter(read_sheet_head(path, num_row + 1))
+    header = check_header(rows, columns)
+    column_index = {column: header.index(column) for column in columns}
+    row_list = []
+    for row_no, row in rows:
+        row = [normalize_cell(value) for value in row]
+        if not all(row[idx] is None if idx < len(row) else True for idx in column_index.values()):
+            row_list.append((row_no, row))
+    if not row_list:
+        raise exceptions.ExcelFormatException('상품이 없습니다.')
+
+    error_dict = {}
+    for column, idx in column_index.items():
+        value_list = [(row_no, row[idx] if idx < len(row) else None) for row_no, row in row_list]
+        error_list = []
+        if column in REQUIRED_COLUMN:
+            empty_list = [row_no for row_no, value in value_list if value is None]
+            if empty_list:
+                error_list.append('값이 없습니다. ({}행)'.format(_join_row_no(empty_list)))
+            long_list = [row_no for row_no, value in value_list if value is not None and len(str(value)) > MAX_LENGTH]
+            if long_list:
+                error_list.append('{}자를 넘습니다. ({}행)'.format(MAX_LENGTH, _join_row_no(long_list)))
+        if column == '고객사상품코드':
+            row_dict = {}
+            for row_no, value in value_list:
+                if value is not None:
+                    row_dict.setdefault(str(value), []).append(row_no)
+            duplicate_list = [row_no for row_no_list in row_dict.values() if len(row_no_list) > 1
+                              for row_no in row_no_list]
+            if duplicate_list:
+                error_list.append('중복된 값이 있습니다. ({}행)'.format(_join_row_no(sorted(duplicate_list))))
+        if error_list:
+            error_dict[column] = '{}열 {}'.format(get_column_letter(idx + 1), ', '.join(error_list))
+    if error_dict:
+        raise exceptions.ExcelFormatException(_format_error(error_dict), error_dict)
+    return header
+
+
+def check_header(rows, columns):
+    try:
+        header = next(rows)
+    except StopIteration:
+        raise exceptions.ExcelFormatException('빈 파일입니다.')
+    header = list(header)
+    error_dict = diagnose_header(header, columns)
+    if error_dict:
+        raise exceptions.ExcelFormatException(_format_error(error_dict), error_dict)
+    return header
+
+
+def diagnose_header(header, columns):
+    # 없는 항목마다 원인을 추정 (공백이 섞인 이름, 비슷한 이름)
+    name_list = [str(value) for value in header if value is not None]
+    error_dict = {}
+    for column in columns:
+        if column in header:
+            continue
+        stripped_list = [name for name in name_list if ''.join(name.split()) == column]
+        similar_list = difflib.get_close_matches(column, name_list, n=1, cutoff=0.6)
+        if stripped_list:
+            error_dict[column] = '항목 이름에 공백이 있습니다. ({!r}, {}열)'.format(
+                stripped_list[0], _column_letter(header, stripped_list[0]))
+        elif similar_list:
+            error_dict[column] = '항목이 없습니다. 비슷한 항목 : {!r} ({}열)'.format(
+                similar_list[0], _column_letter(header, similar_list[0]))
+        else:
+            error_dict[column] = '항목이 없습니다.'
+    return error_dict
+
+
+def _column_letter(header, name):
+    return get_column_letter([str(value) for value in header].index(name) + 1)
+
+
+def _join_row_no(row_no_list, limit=10):
+    text = ', '.join(str(row_no) for row_no in row_no_list[:limit])
+    if len(row_no_list) > limit:
+        text += ' 외 {}건'.format(len(row_no_list) - limit)
+    return text
+
+
+def _format_error(error_dict):
+    return '\n'.join('[{}] {}'.format(column, message) for column, message in error_dict.items())
+
+
+def read_sheet_head(path, num_row):
+    # 첫 행(헤더)과 이후 값이 있는 num_row - 1 개 행을 [header, (행 번호, row), ...] 로 반환
+    # xlsx는 공유 문자열(sharedStrings.xml) 전체를 읽는 openpyxl 대신 필요한 위치까지만 직접 읽는다.
+    # (상세설명 html이 대부분 공유 문자열이라 큰 파일은 openpyxl load_workbook 만으로 수 초 이상 걸림)
+    try:
+        if path.lower().endswith('.xls'):
+            head = []
+            rows = iter_sheet_rows(path)
+            try:
+                for row_no, row in enumerate(rows, start=1):
+                    if any(value not in (None, '') for value in row):
+                        head.append((row_no, list(row)))
+                    if len(head) >= num_row:
+                        break
+            finally:
+                rows.close()
+        else:
+            head = _read_xlsx_head(path, num_row)
+    except exceptions.ExcelFormatException:
+        raise
+    except Exception as e:
+        raise exceptions.ExcelFormatException(str(e))
+    if not head:
+        return []
+    return [head[0][1]] + head[1:]
+
+
+def _read_xlsx_head(path, num_row):
+    with zipfile.ZipFile(path) as archive:
+        row_list = []
+        shared_index = set()
+        with archive.open(_first_sheet_path(archive)) as f:
+            for _, element in ElementTree.iterparse(f):
+                if _local_name(element.tag) != 'row':
+                    continue
+                row = _parse_xlsx_row(element, shared_index, row_list[-1][0] if row_list else 0)
+                element.clear()
+                if row[1]:
+                    row_list.append(row)
+                    if len(row_list) >= num_row:
+                        break
+        shared_dict = _read_shared_strings(archive, shared_index)
+    head = []
+    for row_no, cell_list in row_list:
+        row = [None] * (max(column for column, _ in cell_list) + 1)
+        for column, value in cell_list:
+            row[column] = shared_dict.get(value[1]) if isinstance(value, tuple) else value
+        head.append((row_no, row))
+    return head
+
+
+def _first_sheet_path(archive):
+    # workbook.xml 의 첫 시트를 workbook.xml.rels 에서 찾아서 zip 안의 경로로 변환
+    workbook = ElementTree.fromstring(archive.read('xl/workbook.xml'))
+    sheet = next(element for element in workbook.iter() if _local_name(element.tag) == 'sheet')
+    relation_id = next(value for key, value in sheet.attrib.items() if _local_name(key) == 'id')
+    relations = ElementTree.fromstring(archive.read('xl/_rels/workbook.xml.rels'))
+    target = next(element.get('Target') for element in relations if element.get('Id') == relation_id)
+    return target.lstrip('/') if target.startswith('/') else posixpath.normpath(posixpath.join('xl', target))
+
+
+def _parse_xlsx_row(element, shared_index, last_row_no):
+    # 공유 문자열은 ('s', 번호) 로 남겨두고 나중에 한번에 찾는다.
+    row_no = int(element.get('r') or last_row_no + 1)
+    cell_list = []
+    column = -1
+    for cell in element:
+        if _local_name(cell.tag) != 'c':
+            continue
+        reference = cell.get('r')
+        column = column_index_from_string(reference.rstrip('0123456789')) - 1 if reference else column + 1
+        cell_type = cell.get('t', 'n')
+        if cell_type == 'inlineStr':
+            value = ''.join(text.text or '' for text in cell.iter() if _local_name(text.tag) == 't')
+        else:
+            value = next((child.text for child in cell if _local_name(child.tag) == 'v'), None)
+            if value is None:
+                continue
+            if cell_type == 's':
+                shared_index.add(int(value))
+                value = ('s', int(value))
+            elif cell_type == 'n':
+                value = float(value) if any(char in value for char in '.eE') else int(value)
+            elif cell_type == 'b':
+                value = value == '1'
+        if value == '':
+            continue
+        cell_list.append((column, value))
+    return row_no, cell_list
+
+
+def _read_shared_strings(archive, shared_index):
+    # 필요한 번호 중 가장 큰 번호까지만 읽음
+    shared_dict = {}
+    if not shared_index:
+        return shared_dict
+    max_index = max(shared_index)
+    with archive.open('xl/sharedStrings.xml') as f:
+        index = 0
+        for _, element in ElementTree.iterparse(f):
+            if _local_name(element.tag) != 'si':
+                continue
+            if index in shared_index:
+                # 윗주(rPh)를 제외한 텍스트 (rich text는 여러 r/t 로 나뉨)
+                shared_dict[index] = ''.join(text.text or '' for child in element
+                                             if _local_name(child.tag) != 'rPh'
+                                             for text in child.iter() if _local_name(text.tag) == 't')
+            element.clear()
+            if index >= max_index:
+                break
+            index += 1
+    return shared_dict
+
+
+def _local_name(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+def iter_sheet_rows(path):
+    if path.lower().endswith('.xls'):
+        rows = _iter_xls_rows(path)
+    else:
+        rows = _iter_xlsx_rows(path)
+    try:
+        for row in rows:
+            yield row
+    except exceptions.ExcelFormatException:
+        raise
+    except Exception as e:
+        raise exceptions.ExcelFormatException(str(e))
+    finally:
+        # 중간에 읽기를 멈춰도 워크북을 바로 닫도록
+        rows.close()
+
+
+def _iter_xlsx_rows(path):
+    # read_only 모드는 시트 xml을 iterparse로 읽기 때문에 행 수와 관계없이 메모리가 일정하다.
+    workbook = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+        sheet = workbook.worksheets[0]
+        for row in sheet.iter_rows(values_only=True):
+            yield row
+    finally:
+        workbook.close()
+
+
+def _iter_xls_rows(path):
+    # xlrd는 날짜 셀을 숫자(serial)로 돌려주므로 datetime으로 바꿔서 xlsx와 같은 값으로 맞춤
+    # (이전 결과 파일을 다시 쓸 때 날짜가 숫자로 바뀌지 않도록)
+    workbook = xlrd.open_workbook(path, on_demand=True)
+    try:
+        sheet = workbook.sheet_by_index(0)
+        for idx in range(sheet.nrows):
+            row = sheet.row_values(idx)
+            for col_idx, ctype in enumerate(sheet.row_types(idx)):
+                if ctype == xlrd.XL_CELL_DATE:
+                    row[col_idx] = xlrd.xldate_as_datetime(row[col_idx], workbook.datemode)
+            yield row
+    finally:
+        workbook.release_resources()
+
+
+def normalize_cell(value):
+    # xlrd는 숫자를 모두 float으로 돌려주므로 상품코드가 '1234.0'으로 저장되지 않도록 정리
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if value == '':
+        return None
+    return value
@@ -0,0 +1,88 @@
+import hashlib
+import os
+import shutil
+import tempfile
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db.models import Q
+from django.utils import timezone
+
+from imagefilter.models import File, FileUpload
+
+READ_SIZE = 64 * 1024
+
+
+def create_part_file(upload):
+    # 전체 크기의 빈 파일을 만들어두고 조각은 순서와 관계없이 자기 위치에 기록
+    path = upload.get_part_path()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.truncate(upload.size)
+
+
+def write_chunk(upload, index, stream, checksum):
+    # 요청 본문을 READ_SIZE 씩 읽어서 조각별 임시 파일에 기록하므로 조각 크기와 관계없이 메모리 사용량이 일정
+    # 길이와 sha256이 맞는 조각만 임시 파일의 해당 위치에 복사하고 True 반환
+    # (이미 받은 조각을 다시 보내다 손상되어도 먼저 받은 조각은 그대로 남음)
+    # 같은 조각을 다시 보내는 요청이 동시에 와도 서로의 데이터를 덮어쓰지 않도록 조각 파일은 요청마다 따로 만듦
+    length = upload.get_chunk_length(index)
+    part_path = upload.get_part_path()
+    fd, chunk_path = tempfile.mkstemp(dir=os.path.dirname(part_path),
+                                      prefix='{}.{}.'.format(os.path.basename(part_path), index))
+    digest = hashlib.sha256()
+    num_byte = 0
+    try:
+        with os.fdopen(fd, 'w+b') as chunk:
+            while num_byte < length:
+                data = stream.read(min(READ_SIZE, length - num_byte))
+                if not data:
+                    break
+                digest.update(data)
+                chunk.write(data)
+                num_byte += len(data)
+            if num_byte != length or digest.hexdigest() != checksum:
+                return False
+            chunk.seek(0)
+            with open(part_path, 'r+b') as f:
+                f.seek(index * upload.chunk_size)
+                shutil.copyfileobj(chunk, f, READ_SIZE)
+    finally:
+        os.remove(chunk_path)
+    return True
+
+
+def move_to_file(upload):
+    # 임시 파일을 File.original 경로(upload_to)로 옮김 (같은 파일시스템이므로 복사 없음)
+    # (FileUploadForm 에서 정리하기 전에 등록된 업로드도 있으므로 파일 이름만 사용)
+    # 같은 이름의 업로드가 동시에 끝나도 서로 덮어쓰지 않도록 빈 파일을 O_EXCL 로 만들어 이름을 먼저 차지한 뒤 교체
+    field = File._meta.get_field('original')
+    file_name = os.path.basename(upload.file_name.replace('\\', '/'))
+    while True:
+        name = default_storage.get_available_name(field.generate_filename(None, file_name),
+                                                  max_length=field.max_length)
+        path = default_storage.path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            os.close(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL))
+        except FileExistsError:
+            continue
+        break
+    os.replace(upload.get_part_path(), path)
+    return name
+
+
+def delete_part_file(upload):
+    try:
+        os.remove(upload.get_part_path())
+    except FileNotFoundError:
+        pass
+
+
+def prune_upload():
+    # 보관 시간이 지나도록 완료되지 않은 업로드와 임시 파일 정리
+    expire_dt = timezone.now() - timedelta(seconds=settings.IMAGEFILTER_UPLOAD_EXPIRE)
+    for file_upload in FileUpload.objects.filter(Q(file__isnull=True) & Q(updated_dt__lt=expire_dt)):
+        delete_part_file(file_upload)
+        file_upload.delete()
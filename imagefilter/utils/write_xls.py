@@ -0,0 +1,28 @@
+import datetime
+
+import xlwt
+
+# xlwt는 기록한 행을 workbook에 쌓아두므로 일정 행마다 flush 해서 메모리를 비운다.
+FLUSH_ROW_SIZE = 1000
+
+
+def write_xls(path, header, rows, sheet_name='Sheet1'):
+    workbook = xlwt.Workbook(encoding='utf-8')
+    sheet = workbook.add_sheet(sheet_name)
+    date_style = xlwt.easyxf(num_format_str='YYYY-MM-DD HH:MM:SS')
+    _write_row(sheet, 0, header, date_style)
+    for row_idx, row in enumerate(rows, start=1):
+        _write_row(sheet, row_idx, row, date_style)
+        if row_idx % FLUSH_ROW_SIZE == 0:
+            sheet.flush_row_data()
+    workbook.save(path)
+
+
+def _write_row(sheet, row_idx, row, date_style):
+    for col_idx, value in enumerate(row):
+        if value is None:
+            continue
+        if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+            sheet.write(row_idx, col_idx, value, date_style)
+        else:
+            sheet.write(row_idx, col_idx, value)
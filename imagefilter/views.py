@@ -2,8 +2,10 @@ import json
 
 from django.contrib.auth import get_user_model
 from django.contrib.auth.mixins import LoginRequiredMixin
-from django.db.models import Count, Q
-from django.http import HttpResponseRedirect, HttpResponse
+from django.db import transaction
+from django.db.models import Count, F, Q
+from django.conf import settings
+from django.http import HttpResponseRedirect, HttpResponse, HttpResponseForbidden
 from django.shortcuts import render, get_object_or_404
 from django.urls import reverse_lazy
 from django.utils.safestring import mark_safe
@@ -14,9 +16,11 @@ import django_tables2 as tables
 from django_filters import FilterSet
 from django_filters.views import FilterView
 
-from imagefilter.actions import check_file_async, filter_image_async, delete_file, generate_file
-from imagefilter.forms import FileCreateForm
-from imagefilter.models import File, Product, Image
+from imagefilter.actions import check_file_async, filter_image_async, resume_filter_image_async, delete_file, \
+    generate_file, complete_upload
+from imagefilter.forms import FileCreateForm, FileUploadForm
+from imagefilter.models import File, FileStage, FileUpload, Product, Image, IMAGE_TYPE_COUNT_FIELD
+from imagefilter.utils import metrics, progress, upload
 
 User = get_user_model()
 
@@ -32,11 +36,8 @@ class ImageFileListView(LoginRequiredMixin, ListView):
             filter = Q(user__in=company_user_list)
         else:
             filter = Q(user=user)
-        return File.objects.filter(filter).annotate(
-            num_include=Count('product__image', filter=Q(product__image__type=4)),
-            num_exclude=Count('product__image', filter=Q(product__image__type=3)),
-            num_error=Count('product__image', filter=Q(product__image__type=1)),
-            num_processed=Count('product__image', filter=Q(product__image__type__in=[1, 3, 4]))).select_related('user')
+        # 이미지 수는 분류/변경 시 File에 갱신되는 값을 그대로 사용
+        return File.objects.filter(filter).select_related('user')
 
 
 class ImageFileCreateView(LoginRequiredMixin, View):
@@ -59,6 +60,67 @@ class ImageFileCreateView(LoginRequiredMixin, View):
             return render(request, template_name='dashboard/imagefilter/file/create.html', context={'form': form})
 
 
+def json_response(context, status=200):
+    return HttpResponse(json.dumps(context), content_type='application/json', status=status)
+
+
+class FileUploadView(LoginRequiredMixin, View):
+    # 조각 업로드 시작 : title, file_name, size 를 받아 upload_id 와 조각 크기/개수를 돌려줌
+    def post(self, request):
+        if not request.user.company.is_approved:
+            return json_response({'result': False, 'message': '승인되지 않은 회사입니다.'}, status=403)
+        form = FileUploadForm(request.POST)
+        if not form.is_valid():
+            return json_response({'result': False, 'message': ' '.join(
+                error for error_list in form.errors.values() for error in error_list)}, status=400)
+        file_upload = form.save(commit=False)
+        file_upload.user = request.user
+        file_upload.chunk_size = settings.IMAGEFILTER_UPLOAD_CHUNK_SIZE
+        file_upload.save()
+        upload.create_part_file(file_upload)
+        return json_response({'result': True, 'upload_id': file_upload.id, 'chunk_size': file_upload.chunk_size,
+                              'num_chunk': file_upload.num_chunk})
+
+
+class FileUploadDetailView(LoginRequiredMixin, View):
+    # GET : 받지 못한 조각 목록 (이어 올리기), POST : 업로드 완료
+    def get(self, request, upload_id):
+        file_upload = get_object_or_404(FileUpload, id=upload_id, user=request.user)
+        return json_response({'result': True, 'chunk_size': file_upload.chunk_size, 'num_chunk': file_upload.num_chunk,
+                              'missing_chunks': file_upload.get_missing_chunks(), 'file_id': file_upload.file_id})
+
+    def post(self, request, upload_id):
+        if not request.user.company.is_approved:
+            return json_response({'result': False, 'message': '승인되지 않은 회사입니다.'}, status=403)
+        get_object_or_404(FileUpload, id=upload_id, user=request.user)
+        context = complete_upload(upload_id)
+        return json_response(context, status=200 if context['result'] else 400)
+
+
+class FileUploadChunkView(LoginRequiredMixin, View):
+    # 조각 하나를 요청 본문(application/octet-stream)으로 받음, X-Chunk-Sha256 헤더의 sha256과 다르면 거절
+    def put(self, request, upload_id, index):
+        if not request.user.company.is_approved:
+            return json_response({'result': False, 'message': '승인되지 않은 회사입니다.'}, status=403)
+        file_upload = get_object_or_404(FileUpload, id=upload_id, user=request.user)
+        if file_upload.file_id:
+            return json_response({'result': False, 'message': '이미 완료된 업로드입니다.'}, status=400)
+        if not 0 <= index < file_upload.num_chunk:
+            return json_response({'result': False, 'message': '잘못된 조각 번호'}, status=400)
+        checksum = request.META.get('HTTP_X_CHUNK_SHA256', '').lower()
+        if not checksum:
+            return json_response({'result': False, 'message': 'X-Chunk-Sha256 헤더가 없습니다.'}, status=400)
+        if not upload.write_chunk(file_upload, index, request, checksum):
+            return json_response({'result': False, 'message': '조각이 손상되었습니다. 다시 보내주세요.'}, status=400)
+        # 여러 조각을 동시에 받으므로 잠그고 추가
+        with transaction.atomic():
+            file_upload = FileUpload.objects.select_for_update().get(id=upload_id)
+            if index not in file_upload.received_chunks:
+                file_upload.received_chunks.append(index)
+                file_upload.save(update_fields=['received_chunks', 'updated_dt'])
+        return json_response({'result': True, 'num_missing': len(file_upload.get_missing_chunks())})
+
+
 class ImageFileActionView(LoginRequiredMixin, View):
     def post(self, request):
         if not request.user.company.is_approved:
@@ -73,6 +135,8 @@ class ImageFileActionView(LoginRequiredMixin, View):
             context = check_file_async(file_id)
         elif action == 'filterImage':
             context = filter_image_async(file_id)
+        elif action == 'resumeFilterImage':
+            context = resume_filter_image_async(file_id)
         elif action == 'generateFile':
             context = generate_file(file_id)
         elif action == 'delete':
@@ -82,6 +146,39 @@ class ImageFileActionView(LoginRequiredMixin, View):
         return HttpResponse(json.dumps(context), content_type='application/json')
 
 
+class FileTimelineView(LoginRequiredMixin, View):
+    def get(self, request, file_id):
+        file = get_object_or_404(File, id=file_id)
+        if not file.has_permission(self.request.user):
+            return HttpResponseRedirect(reverse_lazy('landing:permission_denied'))
+        stage_list = FileStage.objects.filter(file=file)
+        return render(request, template_name='dashboard/imagefilter/file/timeline.html',
+                      context={'file': file, 'stage_list': stage_list})
+
+
+class FileProgressView(LoginRequiredMixin, View):
+    # 목록 화면의 진행률 polling 용 (worker가 redis에 기록한 값을 그대로 반환)
+    # gunicorn sync worker를 점유하지 않도록 기다리지 않고 바로 응답 (주기는 화면에서 조절)
+    def get(self, request):
+        file_id_list = [int(file_id) for file_id in request.GET.getlist('file_id') if file_id.isdigit()]
+        file_list = [file for file in File.objects.filter(id__in=file_id_list).select_related('user')
+                     if file.has_permission(request.user)]
+        progress_dict = progress.get_progress([file.id for file in file_list])
+        context = {'files': {}}
+        for file in file_list:
+            context['files'][file.id] = dict(progress_dict.get(file.id, {}), status=file.status)
+        return HttpResponse(json.dumps(context), content_type='application/json')
+
+
+class MetricsView(View):
+    # prometheus scrape 용 (관리자 또는 Authorization: Bearer <IMAGEFILTER_METRICS_TOKEN>)
+    def get(self, request):
+        token = settings.IMAGEFILTER_METRICS_TOKEN
+        if not (request.user.is_staff or (token and request.META.get('HTTP_AUTHORIZATION') == 'Bearer ' + token)):
+            return HttpResponseForbidden()
+        return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
 class ProductTable(tables.Table):
     class Meta:
         model = Product
@@ -183,6 +280,8 @@ class ImageTable(tables.Table):
         attrs = {'class': 'table table-striped bg-white'}
         fields = ('product', 'uri', 'type', 'action')
         sequence = ('product', 'type', 'uri', 'action')
+        # keyset 페이지네이션 순서(-product, -id)를 유지하기 위해 컬럼 정렬은 사용하지 않음
+        orderable = False
 
     uri = tables.Column(verbose_name='이미지')
     type = tables.Column()
@@ -199,7 +298,7 @@ class ImageTable(tables.Table):
     def render_product(self, record):
         html = """<a href="{url}">[{code}] {name}</a>""".format(url=reverse_lazy('dashboard:imagefilter:product_detail',
                                                                                  kwargs={
-                                                                                     'file_id': record.product.file.id,
+                                                                                     'file_id': record.product.file_id,
                                                                                      'product_id': record.product.id}),
                                                                 code=record.product.product_code,
                                                                 name=record.product.name)
@@ -247,12 +346,24 @@ class ImageTypeFilter(FilterSet):
         fields = ['type']
 
 
+def parse_image_cursor(after):
+    # 'product_id_image_id' -> (product_id, image_id), 형식이 틀리면 None
+    try:
+        product_id, image_id = [int(value) for value in after.split('_')]
+    except ValueError:
+        return None
+    return product_id, image_id
+
+
 class ImageListView(LoginRequiredMixin, tables.views.SingleTableMixin, FilterView):
     table_class = ImageTable
     model = Image
     template_name = 'dashboard/imagefilter/image/list.html'
 
     filterset_class = ImageTypeFilter
+    # OFFSET 대신 (product_id, id) 기준 keyset 페이지네이션
+    table_pagination = False
+    per_page = 50
 
     def get_queryset(self):
         product = self.request.GET.get('product', None)
@@ -261,10 +372,51 @@ class ImageListView(LoginRequiredMixin, tables.views.SingleTableMixin, FilterVie
         file = get_object_or_404(File, id=file_id)
         if not file.has_permission(self.request.user):
             return HttpResponseRedirect(reverse_lazy('landing:permission_denied'))
-        filter = Q(product__file=file)
-        if product:
+        self.file = file
+        file.backfill_image_file()
+        filter = Q(file=file)
+        if product and product.isdigit():
             filter.add(Q(product_id=int(product)), Q.AND)
-        return Image.objects.filter(filter)
+        # 목록에 필요한 컬럼만 조회 (분석 결과 컬럼 제외)
+        return Image.objects.filter(filter).select_related('product'). \
+            only('id', 'uri', 'type', 'error', 'file_id', 'product__id', 'product__file_id', 'product__product_code',
+                 'product__name').order_by('-product_id', '-id')
+
+    def get_table_data(self):
+        image_list = super().get_table_data()
+        # 잘못된 cursor 는 무시하고 첫 페이지를 보여줌
+        cursor = parse_image_cursor(self.request.GET.get('after', ''))
+        if cursor:
+            product_id, image_id = cursor
+            image_list = image_list.filter(Q(product_id__lt=product_id) | (Q(product_id=product_id) & Q(id__lt=image_id)))
+        image_list = list(image_list[:self.per_page + 1])
+
+        self.next_query = None
+        if len(image_list) > self.per_page:
+            image_list = image_list[:self.per_page]
+            query = self.request.GET.copy()
+            query['after'] = '{}_{}'.format(image_list[-1].product_id, image_list[-1].id)
+            self.next_query = query.urlencode()
+        return image_list
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        query = self.request.GET.copy()
+        query.pop('after', None)
+        context['first_query'] = query.urlencode()
+        context['next_query'] = self.next_query
+        context['num_image'] = self.get_num_image()
+        return context
+
+    def get_num_image(self):
+        # 상품 필터가 없으면 File에 저장된 이미지 수를 사용
+        type = self.request.GET.get('type', '')
+        if not self.request.GET.get('product', None):
+            if type == '':
+                return self.file.num_image
+            if type.isdigit() and int(type) in IMAGE_TYPE_COUNT_FIELD:
+                return getattr(self.file, IMAGE_TYPE_COUNT_FIELD[int(type)])
+        return self.object_list.count()
 
 
 class ImageTypeChangeView(LoginRequiredMixin, View):
@@ -284,7 +436,19 @@ class ImageTypeChangeView(LoginRequiredMixin, View):
             context = {'result': False, 'message': '잘못된 타입.'}
             return HttpResponse(json.dumps(context), content_type='application/json')
         else:
-            image.type = type
-            image.save()
+            with transaction.atomic():
+                # 같은 이미지를 동시에 바꾸면 파일 이미지 수가 두번 바뀌지 않도록 잠근 뒤 현재 분류를 다시 확인
+                image = Image.objects.select_for_update().get(id=image_id)
+                if image.type in [0, 2]:
+                    context = {'result': False, 'message': '분류 전, 분류중 파일은 변경할 수 없습니다.'}
+                    return HttpResponse(json.dumps(context), content_type='application/json')
+                if image.type != type:
+                    # 파일 재생성 시 이 상품만 다시 만들도록 표시
+                    Product.objects.filter(id=image.product_id).update(dirty=True)
+                    File.objects.filter(id=image.product.file_id).update(
+                        **{IMAGE_TYPE_COUNT_FIELD[image.type]: F(IMAGE_TYPE_COUNT_FIELD[image.type]) - 1,
+                           IMAGE_TYPE_COUNT_FIELD[type]: F(IMAGE_TYPE_COUNT_FIELD[type]) + 1})
+                    image.type = type
+                    image.save(update_fields=['type'])
             context = {'result': True, 'message': '성공.'}
             return HttpResponse(json.dumps(context), content_type='application/json')
@@ -116,6 +116,21 @@ CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TIMEZONE = TIME_ZONE
 CELERY_WORKER_DISABLE_RATE_LIMITS = True
 CELERY_IGNORE_RESULT = True
+CELERY_BEAT_SCHEDULE = {
+    'prune-ocr-cache': {'task': 'imagefilter.tasks.prune_ocr_cache', 'schedule': 60 * 60 * 24},
+    'prune-file-upload': {'task': 'imagefilter.tasks.prune_file_upload', 'schedule': 60 * 60},
+}
+# 단계별 큐 (worker는 -Q 로 처리할 큐를 지정, server/celeryd.conf)
+# 작은 파일은 단계와 관계없이 IMAGEFILTER_PRIORITY_QUEUE 로 보냄 (imagefilter.tasks.get_file_queue)
+# 그 외 task (캐시/업로드 정리 등) 는 기본 celery 큐
+CELERY_TASK_ROUTES = {
+    'imagefilter.tasks.create_product_and_image': {'queue': 'ingest'},
+    'imagefilter.tasks.check_file_header': {'queue': 'ingest'},
+    'imagefilter.tasks.extract_image*': {'queue': 'ingest'},
+    'imagefilter.tasks.filter_image': {'queue': 'ocr'},
+    'imagefilter.tasks.filter_image_claim': {'queue': 'ocr'},
+    'imagefilter.tasks.generate_*': {'queue': 'generate'},
+}
 
 GOOGLE_VISION_API_CREDENTIAL_PATH = env.GOOGLE_VISION_API_CREDENTIAL_PATH
 
@@ -128,3 +143,72 @@ EMAIL_HOST_PASSWORD = env.GMAIL_PASSWORD
 EMAIL_PORT = 587
 EMAIL_USE_TLS = True
 DEFAULT_FROM_EMAIL = EMAIL_HOST_USER
+
+
+# Imagefilter
+# 엑셀 파일을 한 행씩 읽어서 상품을 등록 (False면 pandas로 전체를 읽음)
+IMAGEFILTER_STREAMING_INGEST = True
+IMAGEFILTER_INGEST_BATCH_SIZE = 1000
+# 이미지 추출 task 하나가 처리할 상품 id 구간 크기 / 이미지 bulk insert 크기
+IMAGEFILTER_EXTRACT_CHUNK_SIZE = 2000
+IMAGEFILTER_IMAGE_BULK_SIZE = 5000
+# Google Vision API batch 크기(최대 16) / 동시 요청 batch 수 / 분당 이미지 quota / RESOURCE_EXHAUSTED 재시도
+IMAGEFILTER_VISION_BATCH_SIZE = 16
+IMAGEFILTER_VISION_MAX_IN_FLIGHT = 4
+IMAGEFILTER_VISION_IMAGES_PER_MINUTE = 1800
+IMAGEFILTER_VISION_MAX_RETRY = 5
+IMAGEFILTER_VISION_BACKOFF = 1.0
+# 이미지 bytes 를 보낼때 batch 요청 하나의 최대 크기 (api 제한 10MB)
+IMAGEFILTER_VISION_MAX_REQUEST_BYTES = 8 * 1024 * 1024
+# 분류 결과를 모아서 bulk_update 하는 크기
+IMAGEFILTER_RESULT_BULK_SIZE = 500
+# 분류 task가 한번에 가져가는 uri 수 / 진행이 없으면 중단된 것으로 보는 시간(초)
+IMAGEFILTER_CLAIM_SIZE = 200
+IMAGEFILTER_FILTER_STALE_TIMEOUT = 60 * 10
+# 파일 하나를 동시에 분류하는 batch task 수
+IMAGEFILTER_FILTER_CONCURRENCY = 8
+# 전체/업체별 분당 OCR 이미지 수 (redis 카운터를 모든 worker가 공유, 초과하면 batch를 다음 1분으로 미룸)
+IMAGEFILTER_REDIS_URL = CELERY_BROKER_URL
+IMAGEFILTER_OCR_IMAGES_PER_MINUTE = IMAGEFILTER_VISION_IMAGES_PER_MINUTE
+IMAGEFILTER_COMPANY_IMAGES_PER_MINUTE = 600
+# 이미지 수(이미지 추출 전에는 파일 크기)가 작은 파일은 우선처리 큐로
+IMAGEFILTER_PRIORITY_QUEUE = 'priority'
+IMAGEFILTER_PRIORITY_MAX_IMAGES = 2000
+IMAGEFILTER_PRIORITY_MAX_BYTES = 1024 * 1024
+# /dashboard/imagefilter/metrics/ 인증 토큰 (prometheus), 없으면 관리자만 조회
+IMAGEFILTER_METRICS_TOKEN = getattr(env, 'METRICS_TOKEN', None)
+# 파일 검증 전에 형식을 확인할 상품 행 수 (imagefilter.utils.read_xlsx.probe_schema)
+IMAGEFILTER_SCHEMA_PROBE_ROWS = 20
+# 조각 업로드 (/dashboard/imagefilter/file/upload/) 조각 크기 / 최대 파일 크기 / 완료되지 않은 업로드 보관 시간(초)
+IMAGEFILTER_UPLOAD_CHUNK_SIZE = 4 * 1024 * 1024
+IMAGEFILTER_UPLOAD_MAX_BYTES = 1024 * 1024 * 1024
+IMAGEFILTER_UPLOAD_EXPIRE = 60 * 60 * 24
+# OCR 결과 캐시 (uri 기준) 유효기간(초) / 최대 개수
+IMAGEFILTER_OCR_CACHE = True
+IMAGEFILTER_OCR_CACHE_TTL = 60 * 60 * 24 * 30
+IMAGEFILTER_OCR_CACHE_MAX_ENTRIES = 1000000
+# 필터링된 파일을 원본에서 한 행씩 읽어서 생성 (False면 pandas로 전체를 읽음)
+IMAGEFILTER_STREAMING_GENERATE = True
+# 상세설명 생성 task 하나가 처리할 상품 id 구간 크기
+IMAGEFILTER_GENERATE_CHUNK_SIZE = 500
+# 글자 인식 backend (GoogleVisionBackend / TesseractBackend)
+IMAGEFILTER_OCR_BACKEND = 'imagefilter.utils.ocr.GoogleVisionBackend'
+IMAGEFILTER_TESSERACT_LANG = 'chi_sim+kor+eng'
+IMAGEFILTER_TESSERACT_WORKERS = 4
+IMAGEFILTER_FETCH_TIMEOUT = 10
+# OCR 전에 이미지를 직접 받아서 bytes 로 전송 (내용 기준 캐시, 작은 이미지 제외)
+# 받지 못한 이미지는 uri 로 다시 요청
+IMAGEFILTER_FETCH_INLINE = False
+IMAGEFILTER_FETCH_WORKERS = 32
+IMAGEFILTER_FETCH_PER_HOST = 8
+IMAGEFILTER_FETCH_RETRY = 2
+IMAGEFILTER_FETCH_MAX_BYTES = 20 * 1024 * 1024
+IMAGEFILTER_FETCH_CHUNK_SIZE = 128
+# 가로 또는 세로가 MIN_SIZE 픽셀 미만이면 글자 없음(포함)으로 처리
+IMAGEFILTER_FETCH_MIN_SIZE = 32
+# OCR 전에 이미지를 받아서 경계(edge) 픽셀 비율이 MAX_EDGE_RATIO 미만이면 글자 없음(포함)으로 처리
+IMAGEFILTER_PREFILTER = False
+IMAGEFILTER_PREFILTER_WORKERS = 16
+IMAGEFILTER_PREFILTER_SIZE = 256
+IMAGEFILTER_PREFILTER_EDGE_THRESHOLD = 48
+IMAGEFILTER_PREFILTER_MAX_EDGE_RATIO = 0.02